@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import logging.config
+import multiprocessing
 import sys
+import time
 
 import app_config
 
@@ -12,7 +14,8 @@ LOG_CONFIG = {
     'disable_existing_loggers': False,
     'formatters': {
         'simple': {
-            'format': '%(asctime)s %(name)s:%(funcName)s:%(lineno)d %(threadName)s %(levelname)-7s %(message)s',
+            'format': '%(asctime)s %(name)s:%(funcName)s:%(lineno)d %(threadName)s'
+                      ' %(levelname)-7s %(message)s',
         },
     },
     'handlers': {
@@ -74,6 +77,8 @@ def redirect_stdout_stderr():
 
 
 def main():
+    start_time = time.monotonic()
+
     # Set up logging before any other imports to have the best change of debugging
     # start up problems.
     logging.config.dictConfig(LOG_CONFIG)
@@ -84,16 +89,24 @@ def main():
 
     # Need to create config after wx.App() constructor
     app_config.create_config()
+    from pdf.backend import select_backend
+    try:
+        select_backend(app_config.conf.Read(app_config.PDF_BACKEND_KEY))
+    except RuntimeError:
+        logging.getLogger().exception('ignoring PDF backend setting')
 
     import ui.MainFrame
     frame = ui.MainFrame(None,
                          title=app_config.APP_NAME,
-                         size=ui.MainFrame.DEFAULT_SIZE)
+                         size=ui.MainFrame.DEFAULT_SIZE,
+                         start_time=start_time)
     frame.Show()
     app.MainLoop()
 
 
 if __name__ == '__main__':
+    # Needed for worker processes (e.g. parallel CSV loading) in the packaged application
+    multiprocessing.freeze_support()
     try:
         main()
     except Exception:
@@ -17,12 +17,19 @@ APP_COPYRIGHT = f'© 2020, {APP_AUTHOR}, All Rights Reserved'
 DEFAULT_DOC_DIR_KEY = 'default_dir'
 DEFAULT_CSV_DIR_KEY = 'csv_dir'
 GMAIL_TOKEN_KEY = 'gmail_token'
+# PDF backend (see pdf.backend): 'rml', or 'platypus', which renders faster. The
+# CLASSINVOICES_PDF_BACKEND environment variable overrides it.
+PDF_BACKEND_KEY = 'pdf_backend'
 
 LOG_PATH = os.path.join(tempfile.gettempdir(), 'ClassInvoices.log')
 
+# Most bytes the directory of rendered invoice PDFs may hold (see get_invoice_cache_path())
+INVOICE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
 DEFAULTS = {
     DEFAULT_DOC_DIR_KEY: os.path.expanduser('~/Documents/'),
     DEFAULT_CSV_DIR_KEY: os.path.expanduser('~/Documents/'),
+    PDF_BACKEND_KEY: 'rml',
 }
 
 conf = None
@@ -41,6 +48,13 @@ def create_config():
         conf.Flush()
 
 
+def get_invoice_cache_path():
+    """Return the directory of rendered invoice PDFs (see pdf.cache), in the user's cache
+    directory of the platform, e.g. ~/Library/Caches on macOS."""
+    cache_dir = wx.StandardPaths.Get().GetUserDir(wx.StandardPaths.Dir_Cache)
+    return os.path.join(cache_dir, APP_NAME, 'invoices')
+
+
 def substitute_app_values(string):
     """Replace all "{APP_*}" substitutions found in string with the value of the global variable."""
     app_parameters = [item for item in globals() if item.startswith('APP_')]
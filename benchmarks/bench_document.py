@@ -0,0 +1,89 @@
+"""Load time of documents in the current format (model.document) against the version 1.0
+pickle format, for a synthetic enrollment.
+
+Run from the repository root:  python -m benchmarks.bench_document [num_families]
+"""
+import os
+import pickle
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+from benchmarks.synthetic import write_registration_csv
+from model.document import read_document, write_document
+from model.family import get_classes, get_family_summary, load_families
+
+
+def make_document(families):
+    return {
+        'version': 1.0,
+        'position': (0, 0),
+        'size': (1080, 700),
+        'application_panel': {
+            'sash_proportion': 0.5,
+            'enrollment': {
+                'families': families,
+                'pdf_tab': {'term': 'Fall 2020', 'note': 'Thank you!'},
+                'email_tab': {'subject': 'Invoice', 'body': 'Attached.', 'cc': 0},
+                'selected_tab': 0,
+            },
+            'fee_schedule': [[c, 'Teacher', Decimal('10.00')] for c in sorted(get_classes(families))],
+        },
+    }
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        doc = make_document(load_families(csv_path))
+        # Version 1.0 documents held families as plain dicts
+        legacy_families = {
+            family_id: {k: [dict(p) for p in v] if isinstance(v, list) else v
+                        for k, v in family.items()}
+            for family_id, family in doc['application_panel']['enrollment']['families'].items()}
+        legacy_doc = make_document(legacy_families)
+
+        pickle_path = os.path.join(tempdir, 'legacy.classinvoice')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(legacy_doc, f)
+        doc_path = os.path.join(tempdir, 'current.classinvoice')
+        _, write_time = timed(lambda: write_document(doc_path, doc))
+
+        def load_pickle():
+            with open(pickle_path, 'rb') as f:
+                return pickle.load(f)
+
+        def open_document():
+            """What the UI needs to show a document: stats, family list and classes."""
+            data = read_document(doc_path)
+            families = data['application_panel']['enrollment']['families']
+            for family_id in families:
+                get_family_summary(families, family_id)
+            get_classes(families)
+            return families
+
+        _, pickle_time = timed(load_pickle)
+        _, migrate_time = timed(lambda: read_document(pickle_path))
+        families, open_time = timed(open_document)
+        _, load_all_time = timed(families.load_all)
+
+        print(f'{num_families} families')
+        print(f'  pickle (v1.0):       {os.path.getsize(pickle_path) / 1e6:6.1f} MB,'
+              f' load {pickle_time:6.3f} s, migrate {migrate_time:6.3f} s')
+        print(f'  document (v2.0):     {os.path.getsize(doc_path) / 1e6:6.1f} MB,'
+              f' write {write_time:6.3f} s')
+        print(f'    open and display:  {open_time:6.3f} s')
+        print(f'    read all families: {load_all_time:6.3f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Round-trips and time to create a draft email for every family and then send the drafts,
+with mail.gmail.create_drafts() and send_drafts() and the real googleapiclient, against a
+local fake Gmail server with a simulated network latency (benchmarks.fake_gmail_server),
+one call per HTTP request against batch HTTP requests. Some calls fail once with a rate
+limit error, and it is checked that they are retried and every email is sent.
+
+Run from the repository root:
+    python -m benchmarks.bench_gmail_drafts [num_families] [latency_s] [fail_every]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_gmail_send import Progress
+from benchmarks.fake_gmail_server import FakeGmailServer
+from benchmarks.synthetic import write_registration_csv
+from mail import gmail
+from model.family import get_classes, load_families
+
+
+def create_and_send(families, class_map, latency, fail_every):
+    with FakeGmailServer(latency=latency, fail_every=fail_every) as server:
+        gmail.build_gmail_service = lambda credentials: server.build_service()
+        errors = []
+        start = time.perf_counter()
+        drafts = gmail.create_drafts('Invoice', 'Please find your invoice attached.', 'bcc',
+                                     families, class_map, 'Thank you!', 'Fall', Progress(),
+                                     errors=errors)
+        create_time = time.perf_counter() - start
+        create_requests = server.num_requests
+        start = time.perf_counter()
+        gmail.send_drafts(drafts, Progress(), errors=errors)
+        send_time = time.perf_counter() - start
+        send_requests = server.num_requests - create_requests
+        return (len(drafts), create_time, create_requests, len(server.sent), send_time,
+                send_requests, len(server.failed), errors)
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    fail_every = int(sys.argv[3]) if len(sys.argv) > 3 else 17
+    gmail.get_invoice_cache = lambda: None
+    gmail.get_gmail_credentials = lambda: None
+    gmail.BATCH_RETRY_DELAY = 0.1
+    logging.disable(logging.WARNING)  # The retries
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+
+    print(f'{num_families} families, {latency * 1e3:.0f} ms per request,'
+          f' every {fail_every}th call fails once, without the quota:')
+    gmail.GMAIL_QUOTA_UNITS_PER_SECOND = 1e9
+    for batch_size in (1, gmail.GMAIL_BATCH_SIZE):
+        gmail.GMAIL_BATCH_SIZE = batch_size
+        (num_drafts, create_time, create_requests, num_sent, send_time, send_requests,
+         num_failed, errors) = create_and_send(families, class_map, latency, fail_every)
+        print(f'  {batch_size:2} calls per request: created {num_drafts} drafts in'
+              f' {create_time:6.2f} s with {create_requests:4} requests, sent {num_sent} in'
+              f' {send_time:6.2f} s with {send_requests:4} requests;'
+              f' {num_failed} calls retried, {len(errors)} errors')
+
+    gmail.GMAIL_QUOTA_UNITS_PER_SECOND = 250
+    few_families = dict(list(families.items())[:10])
+    (num_drafts, create_time, create_requests, num_sent, send_time, send_requests,
+     _num_failed, errors) = create_and_send(few_families, class_map, latency, 0)
+    # The quota starts full, with a second's worth of units
+    min_send_time = (num_drafts * gmail.DRAFTS_SEND_QUOTA_UNITS
+                     / gmail.GMAIL_QUOTA_UNITS_PER_SECOND - 1)
+    print(f'With the quota of {gmail.GMAIL_QUOTA_UNITS_PER_SECOND} units/s: created'
+          f' {num_drafts} drafts in {create_time:.2f} s with {create_requests} requests, sent'
+          f' {num_sent} in {send_time:.2f} s (at least {min_send_time:.2f} s) with'
+          f' {send_requests} requests, {len(errors)} errors')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Wall time of emailing every family its invoice with mail.gmail.send_emails(), which
+renders the invoices while it sends them (mail.pipeline.InvoicePipeline), against the time
+to render them all and the time to send them all, which one after the other is what a run
+took before. Sends go to a local fake Gmail server with a simulated network latency
+(benchmarks.fake_gmail_server). Also runs the pipeline with worker processes rendering.
+
+Run from the repository root:
+    python -m benchmarks.bench_gmail_pipeline [num_families] [latency_s]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_gmail_send import Progress
+from benchmarks.fake_gmail_server import FakeGmailServer
+from benchmarks.synthetic import write_registration_csv
+from mail import gmail, pipeline
+from model.family import get_classes, load_families
+from pdf.cache import invoice_key
+from pdf.generate import create_invoice_objects
+from pdf.parallel_render import render_invoice_pdfs
+
+
+class MemoryCache:
+    """Stand-in for pdf.cache.InvoiceCache, in memory."""
+
+    def __init__(self, pdfs=None):
+        self.pdfs = dict(pdfs or {})
+
+    def get(self, key):
+        return self.pdfs.get(key)
+
+    def put(self, key, data):
+        self.pdfs[key] = data
+
+
+def send_all(families, class_map, latency, cache, max_render_workers=None):
+    """Return the seconds it took to send, and the number of emails the server got."""
+    gmail.get_invoice_cache = lambda: cache
+    run = pipeline.InvoicePipeline.run
+    if max_render_workers is not None:
+        def run_with_workers(self, jobs):
+            self.max_render_workers = max_render_workers
+            return run(self, jobs)
+        pipeline.InvoicePipeline.run = run_with_workers
+    try:
+        with FakeGmailServer(latency=latency) as server:
+            gmail.build_gmail_service = lambda credentials: server.build_service()
+            start = time.perf_counter()
+            gmail.send_emails('Invoice', 'Please find your invoice attached.', 'bcc', families,
+                              class_map, 'Thank you!', 'Fall', Progress())
+            return time.perf_counter() - start, len(server.sent)
+    finally:
+        pipeline.InvoicePipeline.run = run
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    gmail.get_gmail_credentials = lambda: None
+    gmail.GMAIL_QUOTA_UNITS_PER_SECOND = 1e9
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+    term = 'Fall'
+    invoices = list(create_invoice_objects(families, class_map, 'Thank you!').values())
+    render_invoice_pdfs(invoices[:1], term)  # Warm up the imports and the renderer
+
+    start = time.perf_counter()
+    pdfs = render_invoice_pdfs(invoices, term)
+    render_time = time.perf_counter() - start
+    rendered = MemoryCache({invoice_key(invoice, term): pdf
+                            for invoice, pdf in zip(invoices, pdfs)})
+    send_time, num_sent = send_all(families, class_map, latency, rendered)
+
+    print(f'{len(invoices)} invoices, {latency * 1e3:.0f} ms per request, {os.cpu_count()} CPUs,'
+          f' {gmail.GMAIL_WORKERS} sending threads, without the quota:')
+    print(f'  render only:             {render_time:6.2f} s')
+    print(f'  send only (pre-rendered): {send_time:6.2f} s, {num_sent} emails')
+    print(f'  one after the other:     {render_time + send_time:6.2f} s')
+    for max_render_workers, label in ((1, 'render thread'), (2, '2 render processes')):
+        elapsed, num_sent = send_all(families, class_map, latency, MemoryCache(),
+                                     max_render_workers)
+        print(f'  pipelined, {label + ":":20}{elapsed:6.2f} s, {num_sent} emails'
+              f' (max(render, send) = {max(render_time, send_time):.2f} s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Time to email every family its invoice with mail.gmail.send_emails() and the real
+googleapiclient, against a local fake Gmail server with a simulated network latency
+(benchmarks.fake_gmail_server), with one sending thread and with several. Also checks
+that every email arrived, that sends keep within the Gmail quota, and that cancelling
+stops the sending.
+
+Run from the repository root:  python -m benchmarks.bench_gmail_send [num_families] [latency_s]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_gmail_server import FakeGmailServer
+from benchmarks.synthetic import write_registration_csv
+from mail import gmail
+from model.family import get_classes, load_families
+
+
+class Progress:
+    """Stand-in for wx.ProgressDialog, which is cancelled after cancel_after updates."""
+
+    def __init__(self, cancel_after=None):
+        self.cancel_after = cancel_after
+        self.num_updates = 0
+
+    def GetMessage(self):
+        return 'Emailing invoice for family: '
+
+    def WasCancelled(self):
+        return self.cancel_after is not None and self.num_updates >= self.cancel_after
+
+    def Update(self, value, newmsg=''):
+        self.num_updates += 1
+
+
+def send_all(families, class_map, latency, max_workers, quota, progress=None):
+    """Return the seconds it took to send, the number of emails the server got, the most
+    requests it handled at once, and the most emails sent in any one second."""
+    gmail.GMAIL_QUOTA_UNITS_PER_SECOND = quota
+    with FakeGmailServer(latency=latency) as server:
+        gmail.build_gmail_service = lambda credentials: server.build_service()
+        errors = []
+        start = time.perf_counter()
+        gmail.send_emails('Invoice', 'Please find your invoice attached.', 'bcc', families,
+                          class_map, 'Thank you!', 'Fall', progress or Progress(), errors=errors,
+                          max_workers=max_workers)
+        elapsed = time.perf_counter() - start
+        times = server.send_times
+        max_per_second = max((sum(1 for t in times if s <= t < s + 1) for s in times), default=0)
+        return elapsed, len(server.sent), server.max_active, max_per_second
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    gmail.get_invoice_cache = lambda: None
+    gmail.get_gmail_credentials = lambda: None
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+    unlimited = 1e9
+
+    print(f'{num_families} families, {latency * 1e3:.0f} ms per request, without the quota:')
+    for max_workers in (1, gmail.GMAIL_WORKERS, 2 * gmail.GMAIL_WORKERS):
+        elapsed, num_sent, max_active, _ = send_all(families, class_map, latency, max_workers,
+                                                    unlimited)
+        print(f'  {max_workers} threads: {elapsed:7.2f} s, {num_sent / elapsed:6.1f} emails/s,'
+              f' {num_sent} emails sent, up to {max_active} requests at once')
+
+    quota = gmail.GMAIL_QUOTA_UNITS_PER_SECOND = 250
+    few = dict(list(families.items())[:20])
+    elapsed, num_sent, _, max_per_second = send_all(few, class_map, latency, gmail.GMAIL_WORKERS,
+                                                    quota)
+    print(f'With the quota of {quota} units/s: {num_sent} emails in {elapsed:.2f} s,'
+          f' at most {max_per_second} in any second'
+          f' ({quota / gmail.MESSAGES_SEND_QUOTA_UNITS:g} per second after a first burst)')
+
+    _, num_sent, _, _ = send_all(families, class_map, latency, gmail.GMAIL_WORKERS, unlimited,
+                                 Progress(cancel_after=10))
+    print(f'Cancelled after 10 progress updates: {num_sent} of {num_families} emails sent')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Per-invoice render latency of single-family documents, as rendered for each email of a
+bulk send, with generate_invoice_pdf() against a warm InvoiceRenderer, for each PDF backend.
+Also checks that both give the same PDFs, including after other documents are rendered in
+between, which resets ReportLab's global state.
+
+Run from the repository root:  python -m benchmarks.bench_invoice_renderer [num_families]
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_registration_csv
+from model.family import get_classes, get_students, load_families
+from pdf.backend import BACKEND_MODULES, get_backend
+from pdf.generate import create_invoice_object
+
+
+def render_all(render, invoices):
+    pdfs = []
+    start = time.perf_counter()
+    for invoice in invoices:
+        pdf = io.BytesIO()
+        render(invoice, pdf)
+        pdfs.append(pdf.getvalue())
+    return pdfs, (time.perf_counter() - start) / len(invoices)
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+    note = 'Please pay by the first class.\nThank you!'
+    term = 'Fall'
+    invoices = [create_invoice_object(family, class_map, note)
+                for family in families.values() if get_students(family)]
+
+    for name in BACKEND_MODULES:
+        backend = get_backend(name)
+        cold_pdfs, cold_time = render_all(
+            lambda invoice, pdf: backend.generate_invoice_pdf(invoice, term, pdf), invoices)
+        renderer = backend.InvoiceRenderer(term)
+        warm_pdfs, warm_time = render_all(renderer.render, invoices)
+        get_backend(name).generate_master(families, class_map, term, io.BytesIO())
+        after_pdfs, _after_time = render_all(renderer.render, invoices[:10])
+        identical = warm_pdfs == cold_pdfs and after_pdfs == cold_pdfs[:10]
+        print(f'{name:8}: generate_invoice_pdf {cold_time * 1e3:6.2f} ms,'
+              f' InvoiceRenderer {warm_time * 1e3:6.2f} ms per invoice'
+              f' ({"identical" if identical else "DIFFERENT"} PDFs)')
+
+
+if __name__ == '__main__':
+    main()
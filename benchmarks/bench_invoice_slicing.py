@@ -0,0 +1,82 @@
+"""Time to get each family's invoice PDF for emailing, by copying its pages out of the
+combined invoices PDF rendered for the preview (pdf.slicing), against rendering it again
+with a warm InvoiceRenderer. The preview is rendered by two worker processes and merged,
+as for a large run. Also checks that every invoice is found in the merged preview, and that
+both have the same text on every page.
+
+Run from the repository root:  python -m benchmarks.bench_invoice_slicing [num_families]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import pymupdf
+
+from benchmarks.synthetic import write_registration_csv
+from model.family import get_classes, load_families
+from pdf.backend import get_backend
+from pdf.cache import get_invoice_pdf
+from pdf.generate import create_invoice_objects
+from pdf.parallel_render import generate_invoices_parallel
+from pdf.slicing import read_invoice_pages
+
+
+class NoProgress:
+    def WasCancelled(self):
+        return False
+
+    def Update(self, value, newmsg=''):
+        pass
+
+
+def get_text(pdf):
+    with pymupdf.open(stream=pdf, filetype='pdf') as document:
+        return [page.get_text() for page in document]
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    note = 'Please pay by the first class.\nThank you!'
+    term = 'Fall'
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        families = load_families(csv_path)
+        class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                     for n, class_name in enumerate(sorted(get_classes(families)))}
+        invoices = create_invoice_objects(families, class_map, note)
+
+        path = os.path.join(tempdir, 'invoices.pdf')
+        start = time.perf_counter()
+        generate_invoices_parallel(NoProgress(), families, class_map, note, term, path,
+                                   max_workers=2, invoices=invoices)
+        preview_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pages = read_invoice_pages(path, invoices, term)
+        num_found = len(pages.pages)
+        sliced = [get_invoice_pdf(invoice, term, pages=pages) for invoice in invoices.values()]
+        slice_time = time.perf_counter() - start
+        pages.close()
+
+        renderer = get_backend().InvoiceRenderer(term)
+        start = time.perf_counter()
+        rendered = [get_invoice_pdf(invoice, term, renderer=renderer)
+                    for invoice in invoices.values()]
+        render_time = time.perf_counter() - start
+
+    same = all(get_text(a) == get_text(b) for a, b in zip(sliced, rendered))
+    print(f'{len(invoices)} invoices, previewed in {preview_time:.2f} s,'
+          f' {num_found} found in the preview')
+    print(f'  copied from the preview: {slice_time:6.3f} s ({slice_time / len(invoices) * 1e3:5.2f} ms each,'
+          f' {sum(map(len, sliced)) / len(sliced) / 1e3:.1f} kB)')
+    print(f'  rendered again:          {render_time:6.3f} s ({render_time / len(invoices) * 1e3:5.2f} ms each,'
+          f' {sum(map(len, rendered)) / len(rendered) / 1e3:.1f} kB)')
+    print(f'  {"same" if same else "DIFFERENT"} text on every page')
+    if num_found != len(invoices) or not same:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Time to save a one-fee edit to a synthetic document: rewriting the whole document against
+appending a record to its journal (model.journal).
+
+Run from the repository root:  python -m benchmarks.bench_journal [num_families]
+"""
+import os
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+from benchmarks.bench_document import make_document
+from benchmarks.synthetic import write_registration_csv
+from model.changes import FamilyChanges
+from model.document import write_document
+from model.family import load_families
+from model.journal import Journal
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    repeat = 20
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        doc = make_document(load_families(csv_path))
+        fee_schedule = doc['application_panel']['fee_schedule']
+        path = os.path.join(tempdir, 'bench.classinvoice')
+
+        start = time.perf_counter()
+        for n in range(repeat):
+            fee_schedule[0][2] = Decimal(n)
+            write_document(path, doc)
+        full_time = (time.perf_counter() - start) / repeat
+
+        journal = Journal.create(path, write_document(path, doc), doc)
+        start = time.perf_counter()
+        for n in range(repeat):
+            fee_schedule[0][2] = Decimal(n + 1)
+            journal.append(doc, FamilyChanges({}, {}, {}), saved=True)
+        journal_time = (time.perf_counter() - start) / repeat
+
+        print(f'{num_families} families, one fee changed per save')
+        print(f'  rewrite document: {full_time * 1000:8.1f} ms per save')
+        print(f'  append journal:   {journal_time * 1000:8.1f} ms per save,'
+              f' {(journal.size - journal.start) / repeat:.0f} bytes per record')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Fee computation for a whole district, with fees in integer cents (model.money) against
+the previous Decimal arithmetic: the invoice objects of every family, and the memory of
+the class map. Also checks that every total is the same.
+
+Run from the repository root:  python -m benchmarks.bench_money [num_families]
+"""
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+
+from benchmarks.synthetic import write_registration_csv
+from model.columns import Column
+from model.family import get_classes, get_parents, get_students, load_families
+from model.money import format_cents, to_cents
+from model.parse import validate_currency
+from pdf.generate import create_invoice_object
+
+
+def create_invoice_object_decimal(family, class_map, note):
+    """The fee math of the previous create_invoice_object(), with Decimal fees."""
+    invoice = {'family_id': family['id'], 'last_name': family['last_name']}
+    invoice['parent'] = [[parent[Column.LAST_NAME] + ', ' + parent[Column.FIRST_NAME],
+                          parent[Column.EMAIL]] for parent in get_parents(family)]
+    payable = {}
+    invoice['students'] = {}
+    invoice['total'] = Decimal(0.00)
+    invoice['note'] = note
+    for student in get_students(family):
+        name = student[Column.LAST_NAME] + ', ' + student[Column.FIRST_NAME]
+        invoice['students'][name] = []
+        for class_name in student[Column.CLASSES]:
+            teacher, fee = class_map[class_name]
+            fee += Decimal('0.00')
+            invoice['students'][name].append([class_name, teacher, fee])
+            invoice['total'] += fee
+            try:
+                payable[teacher] += fee
+            except KeyError:
+                payable[teacher] = fee
+    invoice['payable'] = payable
+    return invoice
+
+
+def class_map_size(make_class_map):
+    """Return the bytes allocated by a class map, and its pickled size, as sent to the
+    worker processes rendering invoices."""
+    tracemalloc.start()
+    class_map = make_class_map()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, len(pickle.dumps(class_map))
+
+
+def timed(func, families, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [func(family) for family in families]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return results, best
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        families = load_families(csv_path)
+    classes = sorted(get_classes(families))
+    # Fees as the fee schedule reads them, some whole dollars and some with cents
+    fee_strs = [f'{10 + n % 40}.{n * 37 % 100:02d}' if n % 3 else str(10 + n % 40)
+                for n in range(len(classes))]
+
+    def make_decimal_class_map():
+        return {class_name: (f'Teacher {n % 25} Name', validate_currency(fee_str))
+                for n, (class_name, fee_str) in enumerate(zip(classes, fee_strs))}
+
+    def make_cents_class_map():
+        return {class_name: (f'Teacher {n % 25} Name', to_cents(validate_currency(fee_str)))
+                for n, (class_name, fee_str) in enumerate(zip(classes, fee_strs))}
+
+    decimal_map = make_decimal_class_map()
+    cents_map = make_cents_class_map()
+    invoiced = [family for family in families.values() if get_students(family)]
+    num_classes = sum(len(student[Column.CLASSES])
+                      for family in invoiced for student in get_students(family))
+    print(f'{len(invoiced)} families, {num_classes} class enrollments, {len(classes)} classes')
+
+    decimal_invoices, decimal_time = timed(
+        lambda family: create_invoice_object_decimal(family, decimal_map, 'Thank you!'), invoiced)
+    cents_invoices, cents_time = timed(
+        lambda family: create_invoice_object(family, cents_map, 'Thank you!'), invoiced)
+    same = all(str(a['total']) == format_cents(b['total'])
+               and {t: str(fee) for t, fee in a['payable'].items()}
+               == {t: format_cents(fee) for t, fee in b['payable'].items()}
+               for a, b in zip(decimal_invoices, cents_invoices))
+    print(f'invoice objects   Decimal {decimal_time:7.3f} s   cents {cents_time:7.3f} s'
+          f'   ({decimal_time / cents_time:.2f}x)   {"same" if same else "DIFFERENT"} totals')
+
+    for name, make_class_map in (('Decimal', make_decimal_class_map),
+                                 ('cents', make_cents_class_map)):
+        size, pickled = class_map_size(make_class_map)
+        print(f'class map {name:8} {size / 1e3:8.1f} kB allocated, {pickled / 1e3:6.1f} kB pickled')
+
+
+if __name__ == '__main__':
+    main()
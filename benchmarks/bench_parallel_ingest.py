@@ -0,0 +1,52 @@
+"""Scaling of model.parallel_ingest.load_families_parallel across worker counts.
+
+Run from the repository root:  python -m benchmarks.bench_parallel_ingest [num_rows]
+
+Writes a synthetic registration CSV (5 rows per family) to a temporary directory and
+loads it serially and then with 1, 2, 4, ... workers up to the number of CPUs.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_registration_csv
+from model.family import load_families
+from model.parallel_ingest import load_families_parallel
+
+ROWS_PER_FAMILY = 5
+
+
+def worker_counts():
+    counts = []
+    n = 1
+    while n < (os.cpu_count() or 1):
+        counts.append(n)
+        n *= 2
+    counts.append(os.cpu_count() or 1)
+    return counts
+
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(path, num_rows // ROWS_PER_FAMILY)
+        print(f'{num_rows} rows, {os.path.getsize(path) / 1e6:.1f} MB, {os.cpu_count()} CPUs')
+
+        start = time.perf_counter()
+        families = load_families(path)
+        serial = time.perf_counter() - start
+        print(f'  serial load_families: {serial:6.2f} s  ({num_rows / serial:8.0f} rows/s)')
+
+        for workers in worker_counts():
+            start = time.perf_counter()
+            parallel_families = load_families_parallel(path, max_workers=workers)
+            elapsed = time.perf_counter() - start
+            assert list(parallel_families) == list(families)
+            print(f'  {workers:3d} workers:          {elapsed:6.2f} s  ({num_rows / elapsed:8.0f} rows/s,'
+                  f' speedup {serial / elapsed:4.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
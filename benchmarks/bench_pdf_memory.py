@@ -0,0 +1,71 @@
+"""Peak RSS of rendering the invoices for the viewer, the previous way, into a BytesIO that
+was then copied twice with getvalue() (once to log its size, once to write it to the
+viewer's temporary file), against rendering straight to the file. Each way runs in its own
+process, which reports its peak RSS. Unix only, as it uses the resource module.
+
+Run from the repository root:  python -m benchmarks.bench_pdf_memory [num_families]
+"""
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_registration_csv
+from model.family import get_classes, load_families
+from pdf.backend import get_backend
+
+
+class NoProgress:
+    def WasCancelled(self):
+        return False
+
+    def Update(self, value, newmsg=''):
+        pass
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux, but bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+
+def render(mode, csv_path, pdf_path):
+    families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'buffer':
+        pdf_buffer = io.BytesIO()
+        get_backend().generate_invoices(NoProgress(), families, class_map, 'Note', 'Fall', pdf_buffer)
+        size = len(pdf_buffer.getvalue())
+        with open(pdf_path, 'wb') as tmp_file:
+            tmp_file.write(pdf_buffer.getvalue())
+    else:
+        get_backend().generate_invoices(NoProgress(), families, class_map, 'Note', 'Fall', pdf_path)
+        size = os.path.getsize(pdf_path)
+    elapsed = time.perf_counter() - start
+    print(f'{mode:6}: {elapsed:6.2f} s, {size / 1e6:5.1f} MB PDF,'
+          f' peak RSS {peak_rss_mb():7.1f} MB ({peak_rss_mb() - baseline:+7.1f} MB rendering)')
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('buffer', 'file'):
+        render(*sys.argv[1:4])
+        return
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        pdf_path = os.path.join(tempdir, 'invoices.pdf')
+        print(f'{num_families} families')
+        for mode in ('buffer', 'file'):
+            subprocess.run([sys.executable, '-m', 'benchmarks.bench_pdf_memory',
+                            mode, csv_path, pdf_path], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Compare memory use and lookup latency of Person records against the Column-keyed
+dicts that model.family used to build for each person.
+
+Run from the repository root:  python -m benchmarks.bench_records [num_families]
+"""
+import sys
+import timeit
+import tracemalloc
+
+from benchmarks.synthetic import generate_rows
+from model.columns import Column
+from model.family import PARSE_TRANSFORMS, Person, transform
+
+COLUMNS = list(Column)
+
+
+def create_person_dict(row):
+    """The previous representation of a person: a dict keyed by Column."""
+    person = {}
+    for n, column in enumerate(row):
+        person[COLUMNS[n]] = column
+    for col_name, value in person.items():
+        person[col_name] = transform(col_name, value.strip(), PARSE_TRANSFORMS)
+    return person
+
+
+def create_person_record(row):
+    person = Person()
+    for n, column in enumerate(row):
+        person[COLUMNS[n]] = transform(COLUMNS[n], column.strip(), PARSE_TRANSFORMS)
+    return person
+
+
+def measure_memory(factory, rows):
+    tracemalloc.start()
+    people = [factory(row) for row in rows]
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return people, current
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 12000
+    rows = list(generate_rows(num_families))
+    print(f'{len(rows)} people in {num_families} families')
+    for label, factory in [('dict', create_person_dict), ('Person', create_person_record)]:
+        people, size = measure_memory(factory, rows)
+        build = min(timeit.repeat(lambda: [factory(row) for row in rows], number=1, repeat=3))
+        column = Column.LAST_NAME
+        lookup = min(timeit.repeat(lambda: [p[column] for p in people], number=1, repeat=5))
+        print(f'{label:>8}: {size / len(rows):7.1f} bytes/person (incl. values), '
+              f'build {build * 1e6 / len(rows):6.2f} us/person, '
+              f'[Column] lookup {lookup * 1e9 / len(rows):6.1f} ns')
+    attr = min(timeit.repeat(lambda: [p.last_name for p in people], number=1, repeat=5))
+    print(f'{"Person":>8}: attribute lookup {attr * 1e9 / len(rows):6.1f} ns')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""RML assembly time for families with many students and classes, against the previous
+builders, which concatenated strings with += and so copied them over and over.
+
+Run from the repository root:  python -m benchmarks.bench_rml [num_families] [students_per_family]
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_registration_csv
+from model.family import get_classes, load_families
+from model.money import format_cents
+from pdf.generate import (RML_HORIZONTAL_LINE, RML_INVOICE_TEMPLATE, RML_NEXT_PAGE,
+                          RML_PARAGRAPH_TEMPLATE, create_invoice_object,
+                          generate_invoice_page_rml, generate_master_rml_for_family)
+
+
+def generate_table_row_rml_concat(elements):
+    row = '<tr>\n'
+    for elt in elements:
+        row += f'<td>{elt}</td>\n'
+    row += '</tr>\n'
+    return row
+
+
+def generate_invoice_page_rml_concat(invoice, rml_file):
+    """The previous generate_invoice_page_rml()."""
+    parents_rml = ''
+    for parent in invoice['parent']:
+        parents_rml += generate_table_row_rml_concat(parent)
+    students_rml = generate_table_row_rml_concat(['Student', 'Class', 'Instructor', 'Fee'])
+    num_classes = 0
+    for student_name, classes in invoice['students'].items():
+        for class_entry in classes:
+            students_rml += generate_table_row_rml_concat([student_name]
+                                                          + class_entry[:-1]
+                                                          + ['$' + format_cents(class_entry[-1])])
+            student_name = ''
+            num_classes += 1
+    students_rml += generate_table_row_rml_concat(['Total', '', '', '$' + format_cents(invoice['total'])])
+    payables_rml = ''
+    for teacher, fee in sorted(invoice['payable'].items()):
+        if fee:
+            payables_rml += generate_table_row_rml_concat([teacher, '$' + format_cents(fee)])
+    rml_file.write(RML_INVOICE_TEMPLATE.format(parents=parents_rml,
+                                               students=students_rml,
+                                               payables=payables_rml))
+    rml_file.write(RML_HORIZONTAL_LINE)
+    for line in invoice['note'].split('\n'):
+        rml_file.write(RML_PARAGRAPH_TEMPLATE.format(style='medium', msg=line))
+    rml_file.write(RML_NEXT_PAGE)
+
+
+def timed(func, items, repeat=5):
+    """Return the RML written by func for each item, and the best time of several runs."""
+    best = None
+    for _ in range(repeat):
+        rml = io.StringIO()
+        start = time.perf_counter()
+        for item in items:
+            func(item, rml)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rml.getvalue(), best
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    students_per_family = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families, students_per_family=students_per_family,
+                               classes_per_student=20)
+        families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 25} Name', n % 50 * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+    note = 'Please pay by the first class.\nThank you!'
+    invoices = [create_invoice_object(family, class_map, note) for family in families.values()]
+
+    old_rml, old_time = timed(generate_invoice_page_rml_concat, invoices)
+    new_rml, new_time = timed(generate_invoice_page_rml, invoices)
+    _master_rml, master_time = timed(
+        lambda family, rml: generate_master_rml_for_family(family, class_map, rml),
+        list(families.values()))
+
+    print(f'{num_families} families of {students_per_family} students with 20 classes each,'
+          f' {len(new_rml) / 1e6:.1f} MB of invoice RML')
+    print(f'  invoices, += concatenation: {old_time:6.3f} s')
+    print(f'  invoices, joined fragments: {new_time:6.3f} s'
+          f' ({"identical" if new_rml == old_rml else "DIFFERENT"} RML)')
+    print(f'  master list:                {master_time:6.3f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Micro-benchmark of the per-header row parser returned by model.family.parse_headers,
+against the generic per-row loop create_person used before.
+
+Run from the repository root:  python -m benchmarks.bench_row_parser [num_families]
+"""
+import sys
+import timeit
+
+from benchmarks.synthetic import generate_rows
+from model.columns import Column
+from model.family import PARSE_TRANSFORMS, Person, parse_headers, transform, validate_person
+
+
+def create_person_generic(row, column_idx_to_name):
+    """The previous create_person: fill in the row, then transform every value in a second pass."""
+    person = {}
+    for n, column in enumerate(row):
+        col_name = column_idx_to_name[n]
+        person[col_name] = column
+    for col_name, value in person.items():
+        person[col_name] = transform(col_name, value.strip(), PARSE_TRANSFORMS)
+    validate_person(person)
+    return Person(person)
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    header = [c.value for c in Column]
+    rows = list(generate_rows(num_families))
+    column_idx_to_name = {n: Column(h) for n, h in enumerate(header)}
+    parse_row = parse_headers(header)
+    assert all(dict(parse_row(row)) == dict(create_person_generic(row, column_idx_to_name))
+               for row in rows[:100])
+
+    generic = min(timeit.repeat(lambda: [create_person_generic(row, column_idx_to_name)
+                                         for row in rows], number=1, repeat=3))
+    compiled = min(timeit.repeat(lambda: [parse_row(row) for row in rows], number=1, repeat=3))
+    print(f'{len(rows)} rows of {len(header)} columns')
+    print(f'  generic loop:  {generic * 1e6 / len(rows):6.2f} us/row ({len(rows) / generic:9.0f} rows/s)')
+    print(f'  header parser: {compiled * 1e6 / len(rows):6.2f} us/row ({len(rows) / compiled:9.0f} rows/s,'
+          f' {generic / compiled:4.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Render time of the invoices and master list with each PDF backend of pdf.backend, and a
+visual diff of their output: the pages are rasterized with PyMuPDF, and the share of pixels
+that differ is reported per document. Exits with status 1 if any page differs by more than
+the threshold, so it can be used as a check that the platypus backend still matches RML.
+
+Run from the repository root:
+    python -m benchmarks.compare_backends [num_families] [max_differing_pixels_percent]
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+
+import pymupdf
+
+from benchmarks.synthetic import write_registration_csv
+from model.family import get_classes, load_families
+from pdf.backend import BACKEND_MODULES, PLATYPUS_BACKEND, RML_BACKEND, get_backend
+
+# Resolution to rasterize pages at for the comparison
+DIFF_DPI = 72
+
+# Channel difference, out of 255, below which pixels count as the same, for antialiasing
+PIXEL_TOLERANCE = 64
+
+
+class NoProgress:
+    def WasCancelled(self):
+        return False
+
+    def Update(self, value, newmsg=''):
+        pass
+
+
+def render(backend, kind, families, class_map, note, term):
+    """Return the PDF data and the time to render it."""
+    pdf = io.BytesIO()
+    start = time.perf_counter()
+    if kind == 'invoices':
+        backend.generate_invoices(NoProgress(), families, class_map, note, term, pdf)
+    else:
+        backend.generate_master(families, class_map, term, pdf)
+    return pdf.getvalue(), time.perf_counter() - start
+
+
+def page_differences(pdf_a, pdf_b):
+    """Return the fraction of differing pixels of each page of two PDFs, with 1.0 for pages
+    only in one of them."""
+    differences = []
+    with pymupdf.open(stream=pdf_a, filetype='pdf') as doc_a, \
+            pymupdf.open(stream=pdf_b, filetype='pdf') as doc_b:
+        for n in range(max(doc_a.page_count, doc_b.page_count)):
+            if n >= doc_a.page_count or n >= doc_b.page_count:
+                differences.append(1.0)
+                continue
+            pix_a = doc_a[n].get_pixmap(dpi=DIFF_DPI, colorspace=pymupdf.csGRAY)
+            pix_b = doc_b[n].get_pixmap(dpi=DIFF_DPI, colorspace=pymupdf.csGRAY)
+            if (pix_a.width, pix_a.height) != (pix_b.width, pix_b.height):
+                differences.append(1.0)
+                continue
+            samples_a, samples_b = pix_a.samples, pix_b.samples
+            num_different = sum(abs(a - b) > PIXEL_TOLERANCE for a, b in zip(samples_a, samples_b))
+            differences.append(num_different / len(samples_a))
+    return differences
+
+
+def main():
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    threshold = float(sys.argv[2]) / 100 if len(sys.argv) > 2 else 0.01
+    with tempfile.TemporaryDirectory() as tempdir:
+        csv_path = os.path.join(tempdir, 'registrations.csv')
+        write_registration_csv(csv_path, num_families)
+        families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+    note = 'Please pay by the first class.\nThank you!'
+    term = 'Fall'
+
+    failed = False
+    for kind in ('invoices', 'master'):
+        pdfs = {}
+        for name in BACKEND_MODULES:
+            pdfs[name], elapsed = render(get_backend(name), kind, families, class_map, note, term)
+            print(f'{kind:8} {name:8}: {elapsed:6.3f} s, {len(pdfs[name]) / 1e3:8.1f} kB')
+        differences = page_differences(pdfs[RML_BACKEND], pdfs[PLATYPUS_BACKEND])
+        worst = max(range(len(differences)), key=differences.__getitem__)
+        print(f'{kind:8} {len(differences)} pages, mean {sum(differences) / len(differences):.3%}'
+              f' of pixels differ, worst page {worst + 1}: {differences[worst]:.3%}')
+        failed = failed or differences[worst] > threshold
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
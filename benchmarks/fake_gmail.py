@@ -0,0 +1,48 @@
+"""A stand-in for the Gmail API service of googleapiclient, for benchmarking mail.gmail
+without a network or Google account. It answers the calls mail.gmail makes, and counts the
+messages and bytes it was given."""
+import itertools
+import threading
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeGmailService:
+    def __init__(self, email_address='office@example.com'):
+        self.email_address = email_address
+        self.ids = itertools.count(1)
+        self.num_messages = 0
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def drafts(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest({'emailAddress': self.email_address})
+
+    def record(self, message):
+        with self.lock:
+            self.num_messages += 1
+            self.num_bytes += len(message['raw'])
+            return {'id': str(next(self.ids))}
+
+    def send(self, userId, body):
+        if 'raw' in body:
+            return FakeRequest(self.record(body))
+        return FakeRequest({'id': body['id']})  # Sending a draft
+
+    def create(self, userId, body):
+        return FakeRequest(self.record(body['message']))
@@ -0,0 +1,195 @@
+"""A local HTTP server standing in for the Gmail API, for testing and benchmarking
+mail.gmail with the real googleapiclient, without a network or Google account. It answers
+the calls mail.gmail makes, one by one or in batch HTTP requests (multipart/mixed, as
+googleapiclient's BatchHttpRequest sends them), after a simulated network latency. It
+records what it was sent, how many HTTP requests it handled, and how many at once, and can
+fail some calls once with a rate limit error, to test retries, and reject the messages to
+some addresses for good.
+
+    with FakeGmailServer(latency=0.2) as server:
+        gmail.build_gmail_service = lambda credentials: server.build_service()
+"""
+import base64
+import email.parser
+import email.utils
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Most calls Gmail accepts in one batch HTTP request
+MAX_BATCH_CALLS = 100
+
+RATE_LIMIT_ERROR = {'error': {'code': 429, 'message': 'Too many requests',
+                              'errors': [{'reason': 'rateLimitExceeded'}]}}
+
+INVALID_TO_ERROR = {'error': {'code': 400, 'message': 'Invalid To header',
+                              'errors': [{'reason': 'invalidArgument'}]}}
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def handle_api(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        with server.lock:
+            server.num_requests += 1
+            server.num_active += 1
+            server.max_active = max(server.max_active, server.num_active)
+        try:
+            time.sleep(server.latency)
+            path = self.path.split('?')[0]
+            if path == '/batch':
+                content_type, data = server.answer_batch(self.headers['Content-Type'], body)
+                status = 200
+            else:
+                status, result = server.answer(method, path, json.loads(body) if body else None)
+                content_type = 'application/json; charset=UTF-8'
+                data = json.dumps(result).encode()
+        finally:
+            with server.lock:
+                server.num_active -= 1
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeGmailServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, fail_every=None, email_address='office@example.com',
+                 reject=()):
+        """If given, every fail_every-th call that creates or sends a message fails the first
+        time with a rate limit error, and messages to any address in reject always fail."""
+        super().__init__(('127.0.0.1', 0), FakeGmailHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.reject = set(reject)
+        self.email_address = email_address
+        self.url = f'http://127.0.0.1:{self.server_address[1]}/'
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.num_calls = 0
+        self.failed = set()
+        self.num_requests = 0
+        self.num_active = 0
+        self.max_active = 0
+        # Raw messages sent, with the time each was received
+        self.sent = []
+        self.send_times = []
+        # Draft ID -> raw message of drafts not sent yet
+        self.drafts = {}
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def build_service(self):
+        """Return a Gmail service of googleapiclient which calls this server, for its calls
+        and its batch requests."""
+        import httplib2
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        document = json.loads(get_static_doc('gmail', 'v1'))
+        document['rootUrl'] = self.url
+        return build_from_document(document, http=httplib2.Http())
+
+    def fails(self, key):
+        """Return whether the call that creates or sends the message of key should fail."""
+        self.num_calls += 1
+        if self.fail_every and self.num_calls % self.fail_every == 0 and key not in self.failed:
+            self.failed.add(key)
+            return True
+        return False
+
+    def rejects(self, raw):
+        """Return whether the message, given as its raw base64 text, is to a rejected
+        address."""
+        message = email.parser.BytesParser().parsebytes(base64.urlsafe_b64decode(raw),
+                                                        headersonly=True)
+        addresses = email.utils.getaddresses(message.get_all('To', []))
+        return any(address in self.reject for _name, address in addresses)
+
+    def answer_batch(self, content_type, body):
+        """Return the content type and data of the response to a batch HTTP request."""
+        request = email.parser.BytesParser().parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        parts = request.get_payload()
+        if len(parts) > MAX_BATCH_CALLS:
+            raise ValueError(f'{len(parts)} calls in one batch, more than {MAX_BATCH_CALLS}')
+        boundary = f'batch_{uuid.uuid4().hex}'
+        response = []
+        for part in parts:
+            call = part.get_payload()
+            status_line, rest = call.split('\n', 1)
+            method, url, _protocol = status_line.split(' ')
+            call_body = re.split(r'\r?\n\r?\n', rest, maxsplit=1)[1]
+            status, result = self.answer(method, url.split('?')[0],
+                                         json.loads(call_body) if call_body.strip() else None)
+            response.append(f'--{boundary}\r\n'
+                            'Content-Type: application/http\r\n'
+                            f'Content-ID: <response-{part["Content-ID"][1:]}\r\n\r\n'
+                            f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                            'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+                            f'{json.dumps(result)}\r\n')
+        response.append(f'--{boundary}--\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(response).encode()
+
+    def answer(self, method, path, body):
+        """Return the HTTP status and JSON result of an API call."""
+        match = re.fullmatch(r'/gmail/v1/users/([^/]+)/(.+)', path)
+        if not match:
+            return 404, {'error': {'code': 404, 'message': f'Not found: {path}'}}
+        call = (method, match.group(2))
+        with self.lock:
+            message_id = str(next(self.ids))
+            if call == ('GET', 'profile'):
+                return 200, {'emailAddress': self.email_address}
+            if call == ('POST', 'messages/send'):
+                if self.rejects(body['raw']):
+                    return 400, INVALID_TO_ERROR
+                if self.fails(body['raw']):
+                    return 429, RATE_LIMIT_ERROR
+                self.sent.append(body['raw'])
+                self.send_times.append(time.monotonic())
+                return 200, {'id': message_id, 'labelIds': ['SENT']}
+            if call == ('POST', 'drafts'):
+                if self.rejects(body['message']['raw']):
+                    return 400, INVALID_TO_ERROR
+                if self.fails(body['message']['raw']):
+                    return 429, RATE_LIMIT_ERROR
+                self.drafts[message_id] = body['message']['raw']
+                return 200, {'id': message_id, 'message': {'id': message_id}}
+            if call == ('POST', 'drafts/send'):
+                if self.fails(body['id']):
+                    return 429, RATE_LIMIT_ERROR
+                try:
+                    raw = self.drafts.pop(body['id'])
+                except KeyError:
+                    return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+                self.sent.append(raw)
+                self.send_times.append(time.monotonic())
+                return 200, {'id': message_id, 'labelIds': ['SENT']}
+        return 404, {'error': {'code': 404, 'message': f'Not found: {method} {path}'}}
@@ -0,0 +1,247 @@
+"""Benchmark suite for the whole pipeline, from reading the registration CSV and fee schedule
+to rendering PDFs and building the emails, on deterministic synthetic data.
+
+Each stage runs in its own process, so that its peak RSS (resident set size) is its own. The
+results are written as JSON, with the wall time (best of the repeats), peak RSS, its increase
+over the stage's setup, and throughput of each stage, to compare releases:
+
+    python -m benchmarks.run --families 500 --output results-1.3.1.json
+
+Stages that need packages which are not installed (such as the Google API client for the
+mail stage) are reported as skipped. The PDF backend is chosen with CLASSINVOICES_PDF_BACKEND
+as in the application.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_fee_schedule_csv, write_registration_csv
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REGISTRATION_CSV = 'registrations.csv'
+FEE_SCHEDULE_CSV = 'fee_schedule.csv'
+
+
+class NoProgress:
+    def WasCancelled(self):
+        return False
+
+    def Update(self, value, newmsg=''):
+        pass
+
+    def GetMessage(self):
+        return ''
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on Linux, but bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+
+def load_inputs(data_dir):
+    from model.family import load_families
+    from model.fee_schedule import read_fee_schedule
+    from model.money import to_cents
+    families = load_families(os.path.join(data_dir, REGISTRATION_CSV))
+    fee_schedule = read_fee_schedule(os.path.join(data_dir, FEE_SCHEDULE_CSV), errors=[])
+    class_map = {class_name: (teacher, to_cents(fee)) for class_name, teacher, fee in fee_schedule}
+    return families, class_map
+
+
+# Each stage is a function of the data directory, which sets up its inputs and returns a
+# function that runs the stage and returns the number of items it processed.
+
+def stage_load_families(data_dir):
+    from model.family import load_families
+    return lambda: len(load_families(os.path.join(data_dir, REGISTRATION_CSV)))
+
+
+def stage_read_fee_schedule(data_dir):
+    from model.fee_schedule import read_fee_schedule
+    return lambda: len(read_fee_schedule(os.path.join(data_dir, FEE_SCHEDULE_CSV), errors=[]))
+
+
+def stage_create_invoice_object(data_dir):
+    from pdf.generate import create_invoice_object
+    families, class_map = load_inputs(data_dir)
+    families = list(families.values())
+
+    def run():
+        for family in families:
+            create_invoice_object(family, class_map, 'Thank you!')
+        return len(families)
+    return run
+
+
+def stage_generate_invoices(data_dir):
+    from pdf.backend import get_backend
+    families, class_map = load_inputs(data_dir)
+    pdf_path = os.path.join(data_dir, 'invoices.pdf')
+
+    def run():
+        get_backend().generate_invoices(NoProgress(), families, class_map, 'Thank you!', 'Fall',
+                                        pdf_path)
+        return len(families)
+    return run
+
+
+def stage_generate_master(data_dir):
+    from pdf.backend import get_backend
+    families, class_map = load_inputs(data_dir)
+    pdf_path = os.path.join(data_dir, 'master.pdf')
+
+    def run():
+        get_backend().generate_master(families, class_map, 'Fall', pdf_path)
+        return len(families)
+    return run
+
+
+def stage_send_emails(data_dir):
+    """Render each invoice and build and send its email with mail.gmail.send_emails(), to a
+    fake Gmail service, without the invoice cache or the Gmail quota."""
+    from benchmarks.fake_gmail import FakeGmailService
+    from mail import gmail
+    families, class_map = load_inputs(data_dir)
+    gmail.get_invoice_cache = lambda: None
+    gmail.get_gmail_credentials = lambda: None
+    gmail.GMAIL_QUOTA_UNITS_PER_SECOND = 1e9
+
+    def run():
+        service = FakeGmailService()
+        gmail.build_gmail_service = lambda credentials: service
+        gmail.send_emails('Invoice', 'Please find your invoice attached.', 'bcc', families,
+                          class_map, 'Thank you!', 'Fall', NoProgress())
+        return service.num_messages
+    return run
+
+
+STAGES = {
+    'load_families': stage_load_families,
+    'read_fee_schedule': stage_read_fee_schedule,
+    'create_invoice_object': stage_create_invoice_object,
+    'generate_invoices': stage_generate_invoices,
+    'generate_master': stage_generate_master,
+    'send_emails': stage_send_emails,
+}
+
+
+def run_stage(name, data_dir, repeat):
+    """Run a stage in this process, and return its result."""
+    try:
+        run = STAGES[name](data_dir)
+    except ImportError as e:
+        return {'stage': name, 'skipped': f'{e}'}
+    setup_rss = peak_rss_mb()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = {
+        'stage': name,
+        'wall_s': round(best, 4),
+        'items': items,
+        'items_per_s': round(items / best, 1) if best else None,
+        'peak_rss_mb': None,
+    }
+    if setup_rss is not None:
+        result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        result['peak_rss_increase_mb'] = round(peak_rss_mb() - setup_rss, 1)
+    return result
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--families', type=int, default=500)
+    parser.add_argument('--students', type=int, default=3, help='students per family')
+    parser.add_argument('--classes', type=int, default=4, help='classes per student')
+    parser.add_argument('--num-classes', type=int, default=200, help='classes in fee schedule')
+    parser.add_argument('--teachers', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--output', default='benchmark-results.json')
+    # Used by the suite to run one stage in a child process
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, args.data_dir, args.repeat)))
+        return
+
+    parameters = {
+        'families': args.families,
+        'students_per_family': args.students,
+        'classes_per_student': args.classes,
+        'num_classes': args.num_classes,
+        'teachers': args.teachers,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'pdf_backend': os.environ.get('CLASSINVOICES_PDF_BACKEND', 'rml'),
+    }
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_registration_csv(os.path.join(data_dir, REGISTRATION_CSV), args.families,
+                               students_per_family=args.students,
+                               classes_per_student=args.classes,
+                               num_classes=args.num_classes,
+                               seed=args.seed)
+        write_fee_schedule_csv(os.path.join(data_dir, FEE_SCHEDULE_CSV),
+                               num_classes=args.num_classes,
+                               num_teachers=args.teachers,
+                               seed=args.seed)
+        for name in args.stages:
+            process = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--run-stage', name,
+                                      '--data-dir', data_dir, '--repeat', str(args.repeat)],
+                                     capture_output=True, text=True)
+            if process.returncode:
+                result = {'stage': name, 'error': process.stderr.strip().splitlines()[-1]}
+            else:
+                result = json.loads(process.stdout.strip().splitlines()[-1])
+            results.append(result)
+            if 'skipped' in result:
+                print(f'{name:22} skipped: {result["skipped"]}')
+            elif 'error' in result:
+                print(f'{name:22} failed: {result["error"]}')
+            else:
+                print(f'{name:22} {result["wall_s"]:8.3f} s {result["items_per_s"]:10.1f} items/s'
+                      f'  peak RSS {result["peak_rss_mb"]} MB')
+
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'stages': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Deterministic synthetic registration data and fee schedules for benchmarks."""
+import csv
+import random
+
+from model.columns import Column
+
+FIRST_NAMES = ['Alice', 'Ben', 'Clara', 'David', 'Emma', 'Frank', 'Grace', 'Henry',
+               'Isla', 'Jack', 'Kate', 'Liam', 'Mia', 'Noah', 'Olivia', 'Peter']
+LAST_NAMES = ['Anderson', 'Brown', 'Clark', 'Davis', 'Evans', 'Foster', 'Garcia', 'Harris',
+              'Jensen', 'King', 'Lopez', 'Miller', 'Nelson', 'Owens', 'Parker', 'Reed']
+
+
+def get_class_names(num_classes):
+    return [f'Class {n:04d}' for n in range(num_classes)]
+
+
+def generate_rows(num_families, students_per_family=3, classes_per_student=4,
+                  num_classes=200, seed=0):
+    """Yield registration rows (lists of strings, in Column order) for the given number of
+    families, each with two parents and students_per_family students."""
+    rng = random.Random(seed)
+    class_names = get_class_names(num_classes)
+    for family_num in range(num_families):
+        family_id = str(1000 + family_num)
+        last_name = rng.choice(LAST_NAMES)
+        for parent_type in ('mother', 'father'):
+            first_name = rng.choice(FIRST_NAMES)
+            yield [family_id, last_name, first_name, '', '08/15/2020 10:30', 'parent',
+                   f'{first_name.lower()}.{last_name.lower()}{family_num}@example.com',
+                   parent_type, '(555) 555-1234', '', '', '', '', '', '']
+        for _ in range(students_per_family):
+            classes = rng.sample(class_names, classes_per_student)
+            yield [family_id, last_name, rng.choice(FIRST_NAMES), ', '.join(classes),
+                   '08/15/2020 10:30', 'student', '', '', '', '01/02/2010 00:00',
+                   rng.choice(['male', 'female']), str(rng.randint(1, 12)), '', 'no', 'no']
+
+
+def write_registration_csv(path, num_families, **kwargs):
+    """Write a synthetic registration CSV with a full header row."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([c.value for c in Column])
+        for row in generate_rows(num_families, **kwargs):
+            writer.writerow(row)
+
+
+def generate_fee_schedule_rows(num_classes=200, num_teachers=25, seed=0):
+    """Yield fee schedule rows (class name, teacher, fee as in the CSV) for the classes of
+    generate_rows(), spread over num_teachers teachers."""
+    rng = random.Random(seed)
+    teachers = [f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}-{n}' for n in range(num_teachers)]
+    for n, class_name in enumerate(get_class_names(num_classes)):
+        yield [class_name, teachers[n % num_teachers], f'${rng.randrange(10, 200)}.00']
+
+
+def write_fee_schedule_csv(path, **kwargs):
+    """Write a synthetic fee schedule CSV, with the header row of exported fee schedules."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Class', 'Teacher', 'Fee'])
+        for row in generate_fee_schedule_rows(**kwargs):
+            writer.writerow(row)
@@ -17,10 +17,12 @@ from googleapiclient.errors import HttpError
 from retry import retry
 
 import app_config
+from mail.pipeline import InvoicePipeline
+from mail.rate_limit import TokenBucket
 from model.columns import Column
-from model.family import get_students
-from pdf.generate import generate_one_invoice
-from util import start_thread, MyBytesIO
+from pdf.cache import get_invoice_cache
+from pdf.generate import create_invoice_objects
+from util import start_thread
 
 PROJECT_ID = 'class-invoices'
 OAUTH_CLIENT_ID = '344465743544-80i03jq6qvshuva8gsd1o6558suotq4e.apps.googleusercontent.com'
@@ -41,6 +43,34 @@ CLIENT_CONFIG = {
     }
 }
 
+# Gmail API quota units a user may use per second (as a moving average, so short bursts
+# are allowed), and the units of each method used, from
+# https://developers.google.com/gmail/api/reference/quota
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+MESSAGES_SEND_QUOTA_UNITS = 100
+DRAFTS_CREATE_QUOTA_UNITS = 10
+DRAFTS_SEND_QUOTA_UNITS = 100
+
+# Most calls to make in one batch HTTP request. Gmail takes up to 100, but recommends no more
+# than 50, as larger batches are likely to hit rate limits.
+GMAIL_BATCH_SIZE = 50
+
+# HTTP statuses of failed calls to retry (rate limits and server errors), and the reasons of
+# 403 errors that are rate limits
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+# Times to retry the failed calls of batch HTTP requests, and the seconds to wait before the
+# first retry, doubled for each one after it
+BATCH_RETRIES = 5
+BATCH_RETRY_DELAY = 1
+
+# How often, in seconds, to update the progress while waiting to retry failed calls
+PROGRESS_INTERVAL = 0.1
+
+# Number of threads sending emails or creating drafts at once, each with its own Gmail service
+GMAIL_WORKERS = 4
+
 logger = logging.getLogger(f'classinvoices.{__name__}')
 
 
@@ -128,28 +158,58 @@ def authenticate_with_google(parent, dialog_done):
 
 
 def check_for_done_loop(dialog_done):
-    """This is simply to make sure the application keeps responding and doesn't "freeze" as seen by the OS."""
+    """This is simply to make sure the application keeps responding and doesn't "freeze" as
+    seen by the OS."""
     while not dialog_done.is_set():
         time.sleep(0.3)  # prevent tight loop
         wx.YieldIfNeeded()
 
 
-def get_gmail_service():
+def get_gmail_credentials():
     try:
         try:
             # Authenticate, or use refresh token
-            return build('gmail', 'v1', credentials=authenticate(), cache_discovery=False)
+            return authenticate()
         except google.auth.exceptions.RefreshError:
             logger.exception('Token refresh failed.')
         # Since refresh failed, user probably revoked authorization. Try restarting
         # the email authentication process and have the user approve again.
-        return build('gmail', 'v1', credentials=authenticate(force_new=True))
+        return authenticate(force_new=True)
     except oauthlib.oauth2.rfc6749.errors.OAuth2Error:
         pass
     raise RuntimeError(
         'Failed to authenticate to Google for sending mail. Please try again.')
 
 
+def build_gmail_service(credentials):
+    return build('gmail', 'v1', credentials=credentials, cache_discovery=False)
+
+
+def get_gmail_service():
+    return build_gmail_service(get_gmail_credentials())
+
+
+class GmailServices:
+    """Gmail services for threads, one per thread, all with the same credentials, since
+    the HTTP connections of a googleapiclient service are not thread safe."""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.local = threading.local()
+
+    def get(self):
+        try:
+            return self.local.service
+        except AttributeError:
+            self.local.service = build_gmail_service(self.credentials)
+            return self.local.service
+
+
+def get_recipients(family):
+    return [f'"{p[Column.FIRST_NAME]} {p[Column.LAST_NAME]}" <{p[Column.EMAIL]}>'
+            for p in family['parents'] if p[Column.EMAIL]]
+
+
 def create_message_with_attachment(sender, recipients, cc, subject, body, data):
     """Create a message for an email.
 
@@ -206,115 +266,263 @@ def send_message(service, user_id, message):
     return service.users().messages().send(userId=user_id, body=message).execute()
 
 
-def send_emails(subject, body, cc, families, class_map, note, term, progress, errors=None):
-    if errors is None:
-        errors = []
-    msg_prefix = progress.GetMessage()
-    gmail_service = get_gmail_service()
-    profile = gmail_service.users().getProfile(userId='me').execute()
-    sender = profile['emailAddress']
-    for n, family in enumerate(families.values()):
-        last_name = family['last_name']
-        logger.debug(f'processing family {n}: {last_name}')
-        if progress.WasCancelled():
-            break
-        msg = f"{msg_prefix}{last_name}"
-        progress.Update(n, newmsg=msg)
-        if get_students(family):
-            pdf_buffer = MyBytesIO()
-            generate_one_invoice(family, class_map, note, term, pdf_buffer)
-            parents = family['parents']
-            recipients = [
-                f'"{p[Column.FIRST_NAME]} {p[Column.LAST_NAME]}" <{p[Column.EMAIL]}>'
-                for p in parents if p[Column.EMAIL]]
-            if recipients:
-                logger.debug(f'  sending to email addresses: {recipients}')
-                msg = create_message_with_attachment(sender=sender,
-                                                     recipients=recipients,
-                                                     cc=cc,
-                                                     subject=subject,
-                                                     body=body,
-                                                     data=pdf_buffer.getvalue())
-                send_message(gmail_service, 'me', msg)
+def get_invoice_jobs(families, class_map, note, errors, index=None):
+    """Return (family, invoice object) of the families to email an invoice, in order, and
+    report the families without an email address in errors. index is passed on to
+    create_invoice_objects()."""
+    invoices = create_invoice_objects(families, class_map, note, index)
+    jobs = []
+    for family in families.values():
+        invoice = invoices.get(family['id'])
+        if invoice is not None:
+            if get_recipients(family):
+                jobs.append((family, invoice))
             else:
-                errors.append(f'Family {last_name} has no parents with email')
+                errors.append(f'Family {family["last_name"]} has no parents with email')
+    return jobs
 
 
-def create_draft(service, user_id, message_body):
-    """Create and insert a draft email.
+def send_emails(subject, body, cc, families, class_map, note, term, progress, errors=None,
+                invoice_pages=None, max_workers=None, index=None):
+    """Email each family its invoice. If given, invoice_pages is the pdf.slicing.InvoicePages
+    of the invoices rendered for the preview, to copy the invoices from instead of rendering,
+    and index is the EnrollmentIndex of the families, already updated with class_map.
 
-    Args:
-      service: Authorized Gmail API service instance.
-      user_id: User's email address. The special value "me"
-               can be used to indicate the authenticated user.
-      message_body: The body of the email message, including headers.
-
-    Returns:
-      Draft object, including draft id and message meta data.
-    """
-    message = {'message': message_body}
-    draft = service.users().drafts().create(userId=user_id, body=message).execute()
-    return draft
-
-
-def create_drafts(subject, body, cc, families, class_map, note, term, progress, errors=None):
+    The invoices are rendered while the emails are sent (see mail.pipeline.InvoicePipeline),
+    by max_workers threads (GMAIL_WORKERS by default), each with its own Gmail service,
+    within the Gmail API quota of the user. Emails that can't be sent, after retrying as
+    execute_with_retries() does, are reported in errors. If cancelled, the emails waiting
+    are not sent."""
     if errors is None:
         errors = []
-    msg_prefix = progress.GetMessage()
-    gmail_service = get_gmail_service()
-    profile = gmail_service.users().getProfile(userId='me').execute()
+    if max_workers is None:
+        max_workers = GMAIL_WORKERS
+    services = GmailServices(get_gmail_credentials())
+    profile = services.get().users().getProfile(userId='me').execute()
     sender = profile['emailAddress']
-    drafts = []
-    for n, family in enumerate(families.values()):
-        if progress.WasCancelled():
+    quota = TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND, GMAIL_QUOTA_UNITS_PER_SECOND)
+
+    def make_message(family, pdf):
+        return create_message_with_attachment(sender=sender,
+                                              recipients=get_recipients(family),
+                                              cc=cc,
+                                              subject=subject,
+                                              body=body,
+                                              data=pdf)
+
+    def wait(seconds):
+        return not pipeline.cancelled.wait(seconds)
+
+    def send(batch):
+        service = services.get()
+        for family, message in batch:
+            logger.debug(f'  sending to email addresses: {get_recipients(family)}')
+            request = service.users().messages().send(userId='me', body=message)
+            try:
+                if execute_with_retries(request, quota, MESSAGES_SEND_QUOTA_UNITS, wait) is None:
+                    return  # Cancelled
+            except Exception as e:
+                logger.error(f'could not send email to family {family["id"]}: {e}')
+                errors.append(f'Could not send email to family {family["last_name"]}:'
+                              f' {get_error_reason(e)}')
+
+    pipeline = InvoicePipeline(term, progress, make_message, send, 'sent', max_workers,
+                               invoice_cache=get_invoice_cache(), invoice_pages=invoice_pages)
+    pipeline.run(get_invoice_jobs(families, class_map, note, errors, index))
+
+
+def is_retryable(error):
+    """Return whether the exception an API call failed with is worth retrying: a rate limit,
+    server or network error, rather than a problem with the call itself."""
+    if not isinstance(error, HttpError):
+        return isinstance(error, OSError)
+    if error.resp.status in RETRY_STATUSES:
+        return True
+    details = error.error_details if isinstance(error.error_details, list) else []
+    return error.resp.status == 403 and any(
+        isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS
+        for detail in details)
+
+
+def get_error_reason(error):
+    """Return why an API call failed with the exception error, to show the user."""
+    if isinstance(error, HttpError):
+        return error.reason
+    return str(error) or type(error).__name__
+
+
+def pause(seconds, wait=None):
+    """Wait for seconds by calling wait(seconds), if given, or else by sleeping. Returns
+    False if wait() does, e.g. when cancelled."""
+    if wait is None:
+        time.sleep(seconds)
+        return True
+    return wait(seconds)
+
+
+def take_quota(quota, quota_units, wait=None):
+    """Take quota_units from the TokenBucket quota, pausing until there are enough. Returns
+    False if cancelled while pausing."""
+    while True:
+        seconds = quota.take(quota_units)
+        if not seconds:
+            return True
+        if not pause(seconds, wait):
+            return False
+
+
+def execute_with_retries(request, quota, quota_units, wait=None):
+    """Make an API call, a googleapiclient HttpRequest of quota_units, like execute_batches()
+    makes a batch of them: paced by the quota, and retried if it fails with a rate limit,
+    server or network error. Returns the result, or None if cancelled, and raises the
+    exception the call failed with otherwise, or after the last retry."""
+    delay = BATCH_RETRY_DELAY
+    for attempt in range(BATCH_RETRIES + 1):
+        if not take_quota(quota, quota_units, wait):
+            return None
+        try:
+            return request.execute()
+        except Exception as e:
+            if attempt == BATCH_RETRIES or not is_retryable(e):
+                raise
+            logger.warning(f'retrying failed call in {delay} s: {e}')
+        if not pause(delay, wait):
+            return None
+        delay *= 2
+
+
+def execute_batches(service, requests, quota, quota_units, wait=None):
+    """Make API calls, a list of googleapiclient HttpRequests of quota_units each, in batch
+    HTTP requests of up to GMAIL_BATCH_SIZE calls. Each call takes its units from the
+    TokenBucket quota as it is added to a batch, waiting for them if needed, so the quota
+    paces the calls. Calls that fail with a rate limit, server or network error are retried
+    in later batches, up to BATCH_RETRIES times, waiting longer each time. If given, wait()
+    is called with the seconds to wait instead of sleeping, and if it returns False, e.g.
+    when cancelled, no more calls are made. Returns the result of each call, the exception
+    it failed with, or None if it was not made."""
+    results = [None] * len(requests)
+
+    def on_result(request_id, response, exception):
+        results[int(request_id)] = response if exception is None else exception
+
+    todo = list(range(len(requests)))
+    delay = BATCH_RETRY_DELAY
+    for attempt in range(BATCH_RETRIES + 1):
+        if attempt:
+            logger.warning(f'retrying {len(todo)} failed calls in {delay} s')
+            if not pause(delay, wait):
+                break
+            delay *= 2
+        cancelled = False
+        for start in range(0, len(todo), GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=on_result)
+            batch_ids = []
+            for n in todo[start:start + GMAIL_BATCH_SIZE]:
+                if not take_quota(quota, quota_units, wait):
+                    cancelled = True
+                    break
+                batch.add(requests[n], request_id=str(n))
+                batch_ids.append(n)
+            if batch_ids:
+                try:
+                    batch.execute()
+                except Exception as e:
+                    # The whole batch failed, e.g. the connection
+                    logger.warning(f'batch HTTP request of {len(batch_ids)} calls failed: {e}')
+                    for n in batch_ids:
+                        results[n] = e
+            if cancelled:
+                return results
+        todo = [n for n in todo if isinstance(results[n], Exception) and is_retryable(results[n])]
+        if not todo:
             break
-        last_name = family['last_name']
-        msg = f"{msg_prefix}{last_name}"
-        progress.Update(n, newmsg=msg)
-        if get_students(family):
-            logger.info(f'processing family {n}: {last_name}')
-            pdf_buffer = MyBytesIO()
-            generate_one_invoice(family, class_map, note, term, pdf_buffer)
-            parents = family['parents']
-            recipients = [
-                f'"{p[Column.FIRST_NAME]} {p[Column.LAST_NAME]}" <{p[Column.EMAIL]}>'
-                for p in parents if p[Column.EMAIL]]
-            if recipients:
-                logger.info(f'  sending to email addresses: {recipients}')
-                msg = create_message_with_attachment(sender=sender,
-                                                     recipients=recipients,
-                                                     cc=cc,
-                                                     subject=subject,
-                                                     body=body,
-                                                     data=pdf_buffer.getvalue())
-                draft = create_draft(gmail_service, 'me', msg)
-                drafts.append({'family': family, 'draft_id': draft['id']})
-            else:
-                errors.append(f'Family {last_name} has no parents with email')
-    return drafts
+    return results
 
 
-@retry(HttpError, tries=10, delay=1, backoff=2, jitter=(1, 3), logger=logger)
-def send_draft(service, user_id, draft_id):
-    draft = {
-        'id': draft_id
-    }
-    message = service.users().drafts().send(userId=user_id, body=draft).execute()
-    logger.debug(f'Draft with ID: {draft_id} sent successfully.')
-    logger.debug(f'Draft sent as Message with ID: {message["id"]}')
-
-
-def send_drafts(drafts, progress):
-    """Send drafts. The 'draft_id' key of each draft is an ID which must be for drafts
-    already created and now sitting in the Drafts folder of the Gmail account."""
+def create_drafts(subject, body, cc, families, class_map, note, term, progress, errors=None,
+                  invoice_pages=None, index=None):
+    """Same as send_emails(), but save the emails as drafts, which are created in batch HTTP
+    requests (see execute_batches()). Drafts that can't be created are reported in errors.
+    Returns the drafts, as dicts of the family and the draft ID."""
+    if errors is None:
+        errors = []
+    services = GmailServices(get_gmail_credentials())
+    profile = services.get().users().getProfile(userId='me').execute()
+    sender = profile['emailAddress']
+    quota = TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND, GMAIL_QUOTA_UNITS_PER_SECOND)
+    # Family ID -> ID of its draft
+    draft_ids = {}
+
+    def make_message(family, pdf):
+        return create_message_with_attachment(sender=sender,
+                                              recipients=get_recipients(family),
+                                              cc=cc,
+                                              subject=subject,
+                                              body=body,
+                                              data=pdf)
+
+    def create(batch):
+        service = services.get()
+        requests = [service.users().drafts().create(userId='me', body={'message': message})
+                    for _family, message in batch]
+        results = execute_batches(service, requests, quota, DRAFTS_CREATE_QUOTA_UNITS,
+                                  wait=lambda seconds: not pipeline.cancelled.wait(seconds))
+        for (family, _message), result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error(f'could not create draft for family {family["id"]}: {result}')
+                errors.append(f'Could not create draft for family {family["last_name"]}:'
+                              f' {get_error_reason(result)}')
+            elif result is not None:
+                draft_ids[family['id']] = result['id']
+
+    pipeline = InvoicePipeline(term, progress, make_message, create, 'saved', GMAIL_WORKERS,
+                               batch_size=GMAIL_BATCH_SIZE,
+                               invoice_cache=get_invoice_cache(), invoice_pages=invoice_pages)
+    jobs = get_invoice_jobs(families, class_map, note, errors, index)
+    pipeline.run(jobs)
+    return [{'family': family, 'draft_id': draft_ids[family['id']]}
+            for family, _invoice in jobs if family['id'] in draft_ids]
+
+
+def send_drafts(drafts, progress, errors=None):
+    """Send drafts, in batch HTTP requests (see execute_batches()). The 'draft_id' key of
+    each draft is an ID which must be for drafts already created and now sitting in the
+    Drafts folder of the Gmail account. Drafts that can't be sent are reported in errors."""
+    if errors is None:
+        errors = []
     msg_prefix = progress.GetMessage()
     gmail_service = get_gmail_service()
-    for n, draft in enumerate(drafts):
-        draft_id = draft['draft_id']
+    quota = TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND, GMAIL_QUOTA_UNITS_PER_SECOND)
+
+    def wait(seconds):
+        """Wait for the quota or to retry, keeping the progress up to date, and return False
+        if cancelled."""
+        end = time.monotonic() + seconds
+        while True:
+            progress.Update(start, newmsg=f"{msg_prefix} {start}/{len(drafts)}...")
+            if progress.WasCancelled():
+                return False
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(PROGRESS_INTERVAL, remaining))
+
+    for start in range(0, len(drafts), GMAIL_BATCH_SIZE):
         if progress.WasCancelled():
             break
-        msg = f"{msg_prefix} {n}/{len(drafts)}..."
-        progress.Update(n, newmsg=msg)
-        family_name = draft['family']['last_name']
-        logger.info(f'Sending draft ID {draft_id} for family {family_name}')
-        send_draft(gmail_service, 'me', draft_id)
+        msg = f"{msg_prefix} {start}/{len(drafts)}..."
+        progress.Update(start, newmsg=msg)
+        batch = drafts[start:start + GMAIL_BATCH_SIZE]
+        requests = [gmail_service.users().drafts().send(userId='me', body={'id': draft['draft_id']})
+                    for draft in batch]
+        for draft, result in zip(batch, execute_batches(gmail_service, requests, quota,
+                                                        DRAFTS_SEND_QUOTA_UNITS, wait)):
+            family = draft['family']
+            if isinstance(result, Exception):
+                logger.error(f'could not send draft ID {draft["draft_id"]} for family'
+                             f' {family["id"]}: {result}')
+                errors.append(f'Could not send draft for family {family["last_name"]}:'
+                              f' {get_error_reason(result)}')
+            elif result is not None:
+                logger.debug(f'Draft with ID: {draft["draft_id"]} for family {family["last_name"]}'
+                             f' sent as Message with ID: {result["id"]}')
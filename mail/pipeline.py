@@ -0,0 +1,182 @@
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+from pdf.cache import find_invoice_pdf, put_invoice_pdf
+from pdf.parallel_render import PARALLEL_RENDER_MIN_FAMILIES, render_invoice_pdfs
+
+# Invoices rendered in one task of the render workers, enough to make the overhead of handing
+# tasks to worker processes small, but few enough to get the first messages out quickly
+RENDER_CHUNK_SIZE = 4
+
+# Render tasks queued per render worker, so it does not sit idle between tasks
+RENDER_TASKS_PER_WORKER = 2
+
+# Most messages (or batches of messages) per delivering thread waiting in the queue. With the
+# render tasks under way, this bounds the memory the PDFs and messages take.
+PENDING_MESSAGES_PER_WORKER = 2
+
+# How often, in seconds, to update the progress while waiting for either stage
+PROGRESS_INTERVAL = 0.1
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+class InvoicePipeline:
+    """Renders invoices and delivers them, e.g. emails them, in two stages which run at the
+    same time, so that a run takes about as long as the slower stage, not both together.
+
+    Worker processes (one thread, for fewer than PARALLEL_RENDER_MIN_FAMILIES invoices)
+    render the invoice PDFs, unless they are in the invoice cache or invoice pages. This
+    thread turns each one into a message, with make_message(family, pdf), and puts it on a
+    bounded queue, from which num_workers threads take up to batch_size messages at a time
+    and call deliver() with a list of (family, message), which the progress calls action,
+    e.g. 'sent'. When the queue is full, rendering waits, so only a few messages per thread
+    are held in memory.
+
+    This thread also updates the progress with both stages. If cancelled, the messages not
+    delivered yet are dropped. If delivering fails, run() raises the error."""
+
+    def __init__(self, term, progress, make_message, deliver, action, num_workers, batch_size=1,
+                 invoice_cache=None, invoice_pages=None, max_render_workers=None):
+        self.term = term
+        self.progress = progress
+        self.msg_prefix = progress.GetMessage()
+        self.make_message = make_message
+        self.deliver = deliver
+        self.action = action
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.invoice_cache = invoice_cache
+        self.invoice_pages = invoice_pages
+        self.max_render_workers = max_render_workers
+        self.queue = queue.Queue(maxsize=num_workers * PENDING_MESSAGES_PER_WORKER * batch_size)
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        self.error = None
+        self.num_jobs = 0
+        self.num_rendered = 0
+        self.num_delivered = 0
+        self.last_name = ''
+
+    def run(self, jobs):
+        """Render and deliver the invoices of jobs, a list of (family, invoice object)."""
+        self.num_jobs = len(jobs)
+        render_workers = self.max_render_workers or os.cpu_count() or 1
+        if render_workers <= 1 or len(jobs) < PARALLEL_RENDER_MIN_FAMILIES:
+            render_workers = 1
+            render_pool = ThreadPoolExecutor(max_workers=1)
+        else:
+            render_pool = ProcessPoolExecutor(max_workers=render_workers)
+        logger.debug(f'delivering {len(jobs)} invoices, rendered by {render_workers} workers,'
+                     f' with {self.num_workers} threads')
+        threads = [threading.Thread(target=self.deliver_messages, daemon=True)
+                   for _ in range(self.num_workers)]
+        for thread in threads:
+            thread.start()
+        # (jobs, future) of the render tasks under way, in order
+        renders = deque()
+        next_job = 0
+        try:
+            while not self.cancelled.is_set() and (next_job < len(jobs) or renders):
+                while (next_job < len(jobs) and len(renders) < render_workers * RENDER_TASKS_PER_WORKER
+                       and not self.cancelled.is_set()):
+                    chunk = []
+                    while next_job < len(jobs) and len(chunk) < RENDER_CHUNK_SIZE:
+                        family, invoice = jobs[next_job]
+                        next_job += 1
+                        pdf = find_invoice_pdf(invoice, self.term, self.invoice_cache,
+                                               self.invoice_pages)
+                        if pdf is None:
+                            chunk.append((family, invoice))
+                        else:
+                            self.put(family, pdf)
+                    if chunk:
+                        future = render_pool.submit(render_invoice_pdfs,
+                                                    [invoice for _family, invoice in chunk],
+                                                    self.term)
+                        renders.append((chunk, future))
+                if not renders:
+                    continue
+                chunk, future = renders[0]
+                try:
+                    pdfs = future.result(timeout=PROGRESS_INTERVAL)
+                except TimeoutError:
+                    self.update_progress()
+                    continue
+                renders.popleft()
+                for (family, invoice), pdf in zip(chunk, pdfs):
+                    put_invoice_pdf(invoice, self.term, pdf, self.invoice_cache)
+                    self.put(family, pdf)
+                    if self.cancelled.is_set():
+                        break
+            self.finished.set()
+            for thread in threads:
+                while thread.is_alive():
+                    self.update_progress()
+                    thread.join(PROGRESS_INTERVAL)
+        finally:
+            # If cancelled or failed, the renders not started and messages not delivered yet
+            # are dropped
+            self.cancelled.set()
+            for _chunk, future in renders:
+                future.cancel()
+            render_pool.shutdown()
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def put(self, family, pdf):
+        """Make the message of a rendered invoice and queue it to be delivered, waiting
+        while the queue is full, unless cancelled."""
+        self.num_rendered += 1
+        self.last_name = family['last_name']
+        message = self.make_message(family, pdf)
+        while not self.cancelled.is_set():
+            self.update_progress()
+            try:
+                self.queue.put((family, message), timeout=PROGRESS_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def deliver_messages(self):
+        """Deliver queued messages, batch_size at a time, until all are, or cancelled."""
+        while not self.cancelled.is_set():
+            try:
+                batch = [self.queue.get(timeout=PROGRESS_INTERVAL)]
+            except queue.Empty:
+                if self.finished.is_set():
+                    return
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.cancelled.is_set():
+                return
+            try:
+                self.deliver(batch)
+            except Exception as e:
+                logger.exception('could not deliver invoices')
+                self.error = e
+                self.cancelled.set()
+                return
+            with self.lock:
+                self.num_delivered += len(batch)
+
+    def update_progress(self):
+        """Show the progress of both stages, and note if the progress was cancelled."""
+        # Stay below the maximum, which would close the dialog
+        value = min(self.num_delivered, max(self.num_jobs - 1, 0))
+        self.progress.Update(value, newmsg=f'{self.msg_prefix}{self.last_name}\n'
+                                           f'Rendered {self.num_rendered} of {self.num_jobs}'
+                                           f' invoices, {self.action} {self.num_delivered}')
+        if self.progress.WasCancelled():
+            self.cancelled.set()
@@ -0,0 +1,41 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Rate limiter shared by threads. Tokens accrue at rate per second, up to capacity,
+    and acquire() takes some, first waiting until there are enough. A full bucket allows a
+    burst of up to capacity tokens at once, and after that, rate tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens, cancelled=None):
+        """Take tokens, waiting until there are enough, and return True. If given, cancelled
+        is a threading.Event, and if it is set while waiting, returns False instead."""
+        while True:
+            wait = self.take(tokens)
+            if not wait:
+                return True
+            if cancelled is None:
+                time.sleep(wait)
+            elif cancelled.wait(wait):
+                return False
+
+    def take(self, tokens):
+        """Take tokens if there are enough, and return 0, or else return the seconds until
+        there will be, for callers that wait in their own way."""
+        if tokens > self.capacity:
+            raise ValueError(f'Cannot acquire {tokens} tokens, more than capacity {self.capacity}')
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
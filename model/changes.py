@@ -0,0 +1,89 @@
+import hashlib
+from collections import namedtuple
+
+from model.columns import Column
+
+
+class FamilyChanges(namedtuple('FamilyChanges', ['added', 'removed', 'changed'])):
+    """Differences between two family maps. Each field maps family ID to Family: the new
+    family for added and changed families, and the old family for removed ones."""
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def updated(self):
+        """Return a map of family ID to family of all added and changed families."""
+        families = dict(self.changed)
+        families.update(self.added)
+        return families
+
+
+def family_hash(family):
+    """Return a digest of the content of a family: its ID, name and every field of every person."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((family['id'], family['last_name'])).encode())
+    for member_type in ('parents', 'students'):
+        h.update(member_type.encode())
+        for person in family[member_type]:
+            h.update(repr(tuple(person.get(column) for column in Column)).encode())
+    return h.digest()
+
+
+def hash_families(families):
+    """Return a map of family ID to family_hash() of each family."""
+    return {family_id: family_hash(family) for family_id, family in families.items()}
+
+
+def diff_families(old_families, new_families, old_hashes=None):
+    """Compare two family maps, returning a FamilyChanges. old_hashes, if given, is the
+    result of hash_families(old_families), to save hashing the old families again."""
+    if old_hashes is None:
+        old_hashes = hash_families(old_families)
+    added = {}
+    changed = {}
+    for family_id, family in new_families.items():
+        try:
+            old_hash = old_hashes[family_id]
+        except KeyError:
+            added[family_id] = family
+            continue
+        if family_hash(family) != old_hash:
+            changed[family_id] = family
+    removed = {family_id: family for family_id, family in old_families.items()
+               if family_id not in new_families}
+    return FamilyChanges(added=added, removed=removed, changed=changed)
+
+
+def apply_changes(families, changes, hashes=None):
+    """Update the families map in place with the given FamilyChanges. Changed families keep
+    their position; added families go at the end. If given, hashes is kept up to date too."""
+    for family_id in changes.removed:
+        del families[family_id]
+        if hashes is not None:
+            del hashes[family_id]
+    for updated in (changes.changed, changes.added):
+        for family_id, family in updated.items():
+            families[family_id] = family
+            if hashes is not None:
+                hashes[family_id] = family_hash(family)
+
+
+def merge_changes(earlier, later):
+    """Return a FamilyChanges with the same effect as applying earlier, then later."""
+    added = dict(earlier.added)
+    removed = dict(earlier.removed)
+    changed = dict(earlier.changed)
+    for family_id, family in later.removed.items():
+        if added.pop(family_id, None) is None:
+            changed.pop(family_id, None)
+            removed[family_id] = family
+    for family_id, family in later.changed.items():
+        if family_id in added:
+            added[family_id] = family
+        else:
+            changed[family_id] = family
+    # A family removed earlier and added again stays in removed too, so it moves to the end
+    added.update(later.added)
+    return FamilyChanges(added=added, removed=removed, changed=changed)
@@ -0,0 +1,336 @@
+import datetime
+import json
+import logging
+import os
+import pickle
+import struct
+import uuid
+import zlib
+from collections.abc import Mapping, MutableMapping
+from decimal import Decimal
+
+from model.columns import Column
+from model.family import Family, Person, summarize_family
+
+# A document file starts with DOCUMENT_MAGIC and the offset of its header, followed by one
+# compressed JSON record per family, and ends with the compressed JSON header. The header has
+# the format version, the rest of the document data, and an index of the family records with
+# enough of a summary of each family to display the document before reading any of them.
+# Each save gets a new document ID, which lets a journal of later changes (see model.journal)
+# check that it belongs to this version of the file.
+# Values JSON can't represent are tagged, e.g. {"__decimal__": "12.00"}, and only the types in
+# VALUE_DECODERS are created when reading, so unlike the pickle files of version 1.0, opening a
+# document can't run arbitrary code.
+DOCUMENT_MAGIC = b'ClassInvoices\x00'
+DOCUMENT_VERSION = 2.0
+OFFSET_FORMAT = '>Q'
+
+# Location of the families map within the document data
+FAMILIES_PATH = ('application_panel', 'enrollment', 'families')
+
+VALUE_ENCODERS = [
+    (Decimal, '__decimal__', str),
+    (datetime.datetime, '__datetime__', datetime.datetime.isoformat),
+    (datetime.date, '__date__', datetime.date.isoformat),
+]
+VALUE_DECODERS = {
+    '__decimal__': Decimal,
+    '__datetime__': datetime.datetime.fromisoformat,
+    '__date__': datetime.date.fromisoformat,
+}
+
+# Classes a version 1.0 (pickle) document may contain, and what to create in their place
+LEGACY_PICKLE_CLASSES = {
+    ('wx._core', 'Point'): lambda *args: tuple(args),
+    ('wx._core', 'Size'): lambda *args: tuple(args),
+    ('model.columns', 'Column'): Column,
+    ('model.family', 'Person'): Person,
+    ('model.family', 'Family'): Family,
+    ('decimal', 'Decimal'): Decimal,
+    ('datetime', 'datetime'): datetime.datetime,
+    ('datetime', 'date'): datetime.date,
+}
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+def encode_value(value):
+    """Convert a value of document data into something JSON can represent."""
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, Mapping):
+        return {k: encode_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    for value_type, tag, encoder in VALUE_ENCODERS:
+        if isinstance(value, value_type):
+            return {tag: encoder(value)}
+    raise TypeError(f'Cannot save value of type {type(value).__name__}: {value!r}')
+
+
+def decode_value(value):
+    """Reverse encode_value(). Lists come back as lists, even if they were tuples."""
+    if isinstance(value, dict):
+        if len(value) == 1:
+            tag, tagged_value = next(iter(value.items()))
+            if tag in VALUE_DECODERS:
+                return VALUE_DECODERS[tag](tagged_value)
+        return {k: decode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    return value
+
+
+def encode_person(person):
+    return {column.value: encode_value(value) for column, value in person.items()}
+
+
+def decode_person(record):
+    person = Person()
+    for column_value, value in record.items():
+        person[Column(column_value)] = decode_value(value)
+    return person
+
+
+def encode_family(family):
+    return {
+        'id': family['id'],
+        'last_name': family['last_name'],
+        'parents': [encode_person(p) for p in family['parents']],
+        'students': [encode_person(p) for p in family['students']],
+    }
+
+
+def decode_family(record):
+    return Family(record['id'],
+                  record['last_name'],
+                  parents=[decode_person(p) for p in record['parents']],
+                  students=[decode_person(p) for p in record['students']])
+
+
+def pack(obj):
+    return zlib.compress(json.dumps(obj, separators=(',', ':')).encode())
+
+
+def unpack(data):
+    return json.loads(zlib.decompress(data).decode())
+
+
+def split_families(data):
+    """Return (families, data without families) of document data."""
+    data = dict(data)
+    parent = data
+    for key in FAMILIES_PATH[:-1]:
+        if key not in parent:
+            return {}, data
+        parent[key] = dict(parent[key])
+        parent = parent[key]
+    return parent.pop(FAMILIES_PATH[-1], {}), data
+
+
+def set_families(data, families):
+    parent = data
+    for key in FAMILIES_PATH[:-1]:
+        parent = parent.setdefault(key, {})
+    parent[FAMILIES_PATH[-1]] = families
+
+
+def write_document(path, data):
+    """Save document data to path, replacing the file only once it is completely written.
+    Returns the ID of the saved document."""
+    tmp_path = path + '.tmp'
+    document_id, _entries = write_document_file(tmp_path, data)
+    os.replace(tmp_path, path)
+    return document_id
+
+
+def write_document_file(path, data, folded=None):
+    """Write document data to a new file at path. folded, if given, is (journal ID, offset)
+    of the journal records already included in data. Returns (document ID, index entries)."""
+    families, data = split_families(data)
+    document_id = uuid.uuid4().hex
+    entries = []
+    classes = set()
+    with open(path, 'wb') as f:
+        f.write(DOCUMENT_MAGIC)
+        f.write(struct.pack(OFFSET_FORMAT, 0))  # Header offset, filled in below
+        for family in families.values():
+            record = pack(encode_family(family))
+            name, num_parents, num_students = summarize_family(family)
+            entries.append({
+                'id': family['id'],
+                'offset': f.tell(),
+                'length': len(record),
+                'name': name,
+                'parents': num_parents,
+                'students': num_students,
+            })
+            for student in family['students']:
+                classes.update(student[Column.CLASSES])
+            f.write(record)
+        header_offset = f.tell()
+        f.write(pack({
+            'version': DOCUMENT_VERSION,
+            'id': document_id,
+            'folded': folded,
+            'data': encode_value(data),
+            'families': entries,
+            'classes': sorted(classes),
+        }))
+        f.seek(len(DOCUMENT_MAGIC))
+        f.write(struct.pack(OFFSET_FORMAT, header_offset))
+    return document_id, entries
+
+
+def read_document(path):
+    """Read the document at path, returning its data. Families are read lazily from the file
+    as they are used. Documents of format version 1.0 are read entirely and migrated."""
+    data, _info = load_document(path)
+    return data
+
+
+def load_document(path):
+    """Same as read_document(), but return (data, info), where info has the 'id' of the
+    document and the journal records it 'folded' in, if any. info is empty for documents of
+    format version 1.0."""
+    with open(path, 'rb') as f:
+        if f.read(len(DOCUMENT_MAGIC)) != DOCUMENT_MAGIC:
+            f.seek(0)
+            return read_legacy_document(f), {}
+        header_offset, = struct.unpack(OFFSET_FORMAT, f.read(struct.calcsize(OFFSET_FORMAT)))
+        f.seek(header_offset)
+        header = unpack(f.read())
+    if header['version'] > DOCUMENT_VERSION:
+        raise RuntimeError(f'{path} was saved by a newer version of this application'
+                           f' (document version {header["version"]})')
+    data = decode_value(header['data'])
+    data['version'] = header['version']
+    set_families(data, LazyFamilies(path, header['families'], header['classes']))
+    return data, {'id': header.get('id'), 'folded': header.get('folded')}
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    """Unpickler that only creates the few types found in version 1.0 documents."""
+
+    def find_class(self, module, name):
+        try:
+            return LEGACY_PICKLE_CLASSES[(module, name)]
+        except KeyError:
+            raise pickle.UnpicklingError(f'Unexpected object in document: {module}.{name}') from None
+
+
+def read_legacy_document(f):
+    """Read a version 1.0 (pickle) document from the open file f, converting its families,
+    which may be plain dicts, to Family and Person records."""
+    data = LegacyUnpickler(f).load()
+    families, data = split_families(data)
+    migrated = {}
+    for family_id, family in families.items():
+        migrated[family_id] = Family(family['id'],
+                                     family['last_name'],
+                                     parents=[Person(p) for p in family['parents']],
+                                     students=[Person(p) for p in family['students']])
+    set_families(data, migrated)
+    logger.info(f'Read version {data.get("version")} document with {len(migrated)} families')
+    return data
+
+
+class LazyFamilies(MutableMapping):
+    """Map of family ID to Family, reading each family from the document file when first used.
+
+    Until then, summarize() and get_classes() answer from the document header. Families may
+    be added, replaced and removed like in a dict."""
+
+    def __init__(self, path, entries, classes):
+        self.path = path
+        # Index entries of families not yet read from the file
+        self.entries = {entry['id']: entry for entry in entries}
+        # All families in order; None until read from the file
+        self.families = dict.fromkeys(self.entries)
+        # Classes of all students, if no family has been changed since reading the header
+        self.classes = classes
+
+    def __getitem__(self, family_id):
+        family = self.families[family_id]
+        if family is None:
+            entry = self.entries.pop(family_id)
+            with open(self.path, 'rb') as f:
+                family = self.families[family_id] = self.read_family(f, entry)
+        return family
+
+    def __contains__(self, family_id):
+        # Without reading the family, as Mapping.__contains__ would
+        return family_id in self.families
+
+    def __setitem__(self, family_id, family):
+        self.families[family_id] = family
+        self.entries.pop(family_id, None)
+        self.classes = None
+
+    def __delitem__(self, family_id):
+        del self.families[family_id]
+        self.entries.pop(family_id, None)
+        self.classes = None
+
+    def __iter__(self):
+        return iter(self.families)
+
+    def __len__(self):
+        return len(self.families)
+
+    def __repr__(self):
+        return f'LazyFamilies({self.path!r}, {len(self.families)} families, {len(self.entries)} unread)'
+
+    def items(self):
+        self.load_all()
+        return self.families.items()
+
+    def values(self):
+        self.load_all()
+        return self.families.values()
+
+    @staticmethod
+    def read_family(f, entry):
+        f.seek(entry['offset'])
+        return decode_family(unpack(f.read(entry['length'])))
+
+    def load_all(self, family_ids=None):
+        """Read every family not read yet, or those of family_ids, in file order, opening the
+        file once."""
+        if family_ids is None:
+            entries = list(self.entries.values())
+        else:
+            entries = [self.entries[family_id] for family_id in family_ids
+                       if family_id in self.entries]
+        if not entries:
+            return
+        logger.debug(f'reading {len(entries)} families from {self.path}')
+        with open(self.path, 'rb') as f:
+            for entry in sorted(entries, key=lambda e: e['offset']):
+                self.families[entry['id']] = self.read_family(f, entry)
+                del self.entries[entry['id']]
+
+    def relocate(self, path, entries):
+        """Read families not read yet from the document at path instead, given the index
+        entries of that document, which must have the same content for those families."""
+        self.path = path
+        for entry in entries:
+            if entry['id'] in self.entries:
+                self.entries[entry['id']] = entry
+
+    def summarize(self, family_id):
+        """Same as summarize_family(self[family_id]), but without reading the family."""
+        try:
+            entry = self.entries[family_id]
+        except KeyError:
+            return summarize_family(self[family_id])
+        return entry['name'], entry['parents'], entry['students']
+
+    def get_classes(self):
+        """Return the set of classes of all students, reading the families only if needed."""
+        if self.classes is None:
+            self.classes = set()
+            for family in self.values():
+                for student in family['students']:
+                    self.classes.update(student[Column.CLASSES])
+        return set(self.classes)
@@ -0,0 +1,146 @@
+import logging
+
+from model.columns import Column
+from model.money import is_cents
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+class EnrollmentIndex:
+    """Lookup tables over the families map, kept up to date as families and fees change.
+
+    Built once from the families, the index maps each class to the students enrolled in it.
+    Once a class map (class name -> (teacher, fee in cents)) is given to update_class_map(),
+    it also maps each teacher to the families owing them fees, and each family to its total
+    fees per teacher. Call apply_changes() when families are re-imported and update_class_map()
+    whenever the fee schedule may have been edited: only the families affected are
+    recomputed."""
+
+    def __init__(self, families=None):
+        # class name -> family ID -> students of that family in the class
+        self.class_students = {}
+        # family ID -> class names of all students in the family, in row order
+        self.family_classes = {}
+        self.class_map = {}
+        # Classes whose class map entry is missing, or has a fee but no teacher
+        self.invalid_classes = set()
+        # teacher -> family ID -> number of the family's classes taught by the teacher
+        self.teacher_families = {}
+        # family ID -> teacher -> total fees owed to the teacher
+        self.family_totals = {}
+        if families is not None:
+            for family in families.values():
+                self.add_family(family)
+
+    def add_family(self, family):
+        family_id = family['id']
+        classes = []
+        for student in family['students']:
+            for class_name in student[Column.CLASSES]:
+                classes.append(class_name)
+                try:
+                    by_family = self.class_students[class_name]
+                except KeyError:
+                    by_family = self.class_students[class_name] = {}
+                    self._check_class(class_name)
+                by_family.setdefault(family_id, []).append(student)
+        self.family_classes[family_id] = classes
+        self._add_totals(family_id)
+
+    def remove_family(self, family_id):
+        self._remove_totals(family_id)
+        for class_name in set(self.family_classes.pop(family_id)):
+            by_family = self.class_students[class_name]
+            del by_family[family_id]
+            if not by_family:
+                del self.class_students[class_name]
+                self.invalid_classes.discard(class_name)
+
+    def apply_changes(self, changes):
+        """Update the index for the families added, removed or changed in a FamilyChanges."""
+        for family_id in list(changes.removed) + list(changes.changed):
+            self.remove_family(family_id)
+        for updated in (changes.changed, changes.added):
+            for family in updated.values():
+                self.add_family(family)
+
+    def update_class_map(self, class_map):
+        """Use the given class map for teacher and fee lookups, updating only the families
+        enrolled in classes whose teacher or fee differ from the previous class map."""
+        changed_classes = [class_name for class_name in self.class_students
+                           if class_map.get(class_name) != self.class_map.get(class_name)]
+        affected = set()
+        for class_name in changed_classes:
+            affected.update(self.class_students[class_name])
+        for family_id in affected:
+            self._remove_totals(family_id)
+        self.class_map = dict(class_map)
+        for class_name in changed_classes:
+            self._check_class(class_name)
+        for family_id in affected:
+            self._add_totals(family_id)
+        if changed_classes:
+            logger.debug(f'{len(changed_classes)} classes changed in class map,'
+                         f' updated {len(affected)} families')
+
+    def _check_class(self, class_name):
+        try:
+            teacher, fee = self.class_map[class_name]
+            valid = is_cents(fee) and (teacher or not fee)
+        except KeyError:
+            valid = False
+        if valid:
+            self.invalid_classes.discard(class_name)
+        else:
+            self.invalid_classes.add(class_name)
+
+    def _add_totals(self, family_id):
+        totals = {}
+        for class_name in self.family_classes[family_id]:
+            try:
+                teacher, fee = self.class_map[class_name]
+            except KeyError:
+                continue
+            if not teacher:
+                continue
+            try:
+                totals[teacher] += fee
+            except KeyError:
+                totals[teacher] = fee
+            by_family = self.teacher_families.setdefault(teacher, {})
+            by_family[family_id] = by_family.get(family_id, 0) + 1
+        self.family_totals[family_id] = totals
+
+    def _remove_totals(self, family_id):
+        for teacher in self.family_totals.pop(family_id, {}):
+            by_family = self.teacher_families[teacher]
+            del by_family[family_id]
+            if not by_family:
+                del self.teacher_families[teacher]
+
+    def get_classes(self):
+        """Return the names of all classes any student is enrolled in."""
+        return self.class_students.keys()
+
+    def students_in_class(self, class_name):
+        """Return a map of family ID to the students of that family enrolled in the class."""
+        return self.class_students.get(class_name, {})
+
+    def families_for_teacher(self, teacher):
+        """Return the IDs of families with classes taught by the teacher."""
+        return self.teacher_families.get(teacher, {}).keys()
+
+    def teacher_totals(self, family_id):
+        """Return a map of teacher to the total fees the family owes the teacher, in the order
+        the teachers first appear in the family's classes. Classes with no teacher are omitted."""
+        return self.family_totals[family_id]
+
+    def missing_fee_classes(self, family_ids=None):
+        """Return the names of classes lacking a valid teacher and fee in the class map,
+        among the classes of the given families, or of all families if None."""
+        if family_ids is None:
+            return set(self.invalid_classes)
+        missing = set()
+        for family_id in family_ids:
+            missing.update(self.invalid_classes.intersection(self.family_classes[family_id]))
+        return missing
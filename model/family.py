@@ -1,4 +1,5 @@
 import csv
+from collections.abc import Mapping
 
 from model.columns import Column
 from model.parse import parse_bool, parse_list, parse_date, parse_phone
@@ -10,18 +11,85 @@ REQUIRED_COLUMNS = [
     Column.CLASSES,
 ]
 PARSE_TRANSFORMS = {
-    Column.NEW_STUDENT: lambda value: parse_bool(value),
-    Column.PHONE: lambda value: parse_phone(value),
-    Column.NONCONSECUTIVE: lambda value: parse_bool(value),
-    Column.CLASSES: lambda value: parse_list(value),
-    Column.REGISTERED: lambda value: parse_date(value),
-    Column.BIRTHDAY: lambda value: parse_date(value),
+    Column.NEW_STUDENT: parse_bool,
+    Column.PHONE: parse_phone,
+    Column.NONCONSECUTIVE: parse_bool,
+    Column.CLASSES: parse_list,
+    Column.REGISTERED: parse_date,
+    Column.BIRTHDAY: parse_date,
 }
 VALID_MEMBER_TYPES = ['parent', 'student']
 VALID_PARENT_TYPES = ['mother', 'father']
 VALID_GENDERS = ['male', 'female']
 
 
+class Person(Mapping):
+    """One row of the registration CSV: a parent or a student.
+
+    Fields are stored in slots named after the CSV header of each column (e.g. Column.FIRST_NAME
+    is stored as person.first_name), which is much more compact than a dict per person. The
+    record can still be read like the dict it replaces, keyed by Column, so existing code
+    using person[Column.EMAIL] keeps working. Columns missing from the CSV are simply not
+    set, and raise KeyError when looked up, just as they would with a dict."""
+
+    __slots__ = tuple(column.value for column in Column)
+
+    def __init__(self, values=None):
+        if values is not None:
+            for column, value in values.items():
+                setattr(self, column.value, value)
+
+    def __getitem__(self, column):
+        try:
+            # _value_ is the plain attribute behind Enum.value, and much faster to read
+            return getattr(self, column._value_)
+        except AttributeError:
+            raise KeyError(column) from None
+
+    def __setitem__(self, column, value):
+        setattr(self, column._value_, value)
+
+    def __iter__(self):
+        for column in Column:
+            if hasattr(self, column._value_):
+                yield column
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'Person({dict(self)!r})'
+
+
+class Family(Mapping):
+    """A family: its ID, display last name, and lists of parent and student Person records.
+
+    Readable like the dict it replaces, i.e. family['students']."""
+
+    __slots__ = ('id', 'last_name', 'parents', 'students')
+
+    def __init__(self, family_id, last_name, parents=None, students=None):
+        self.id = family_id
+        self.last_name = last_name
+        self.parents = [] if parents is None else parents
+        self.students = [] if students is None else students
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return (f'Family({self.id!r}, {self.last_name!r}, parents={self.parents!r},'
+                f' students={self.students!r})')
+
+
 def get_parents(family):
     return family['parents']
 
@@ -31,19 +99,58 @@ def get_students(family):
 
 
 def transform(col_name, value, transforms):
-    try:
-        transform_func = transforms[col_name]
-    except KeyError:
+    transform_func = transforms.get(col_name)
+    if transform_func is None:
         return value
     return transform_func(value)
 
 
 def parse_headers(row):
+    """Validate the header row of a registration CSV, and return a function to parse
+    each following row of the CSV into a Person."""
     validate_header_row(row)
-    column_idx_to_name = {}
-    for n, header in enumerate(row):
-        column_idx_to_name[n] = Column(header)
-    return column_idx_to_name
+    return make_row_parser([Column(header) for header in row])
+
+
+def make_row_parser(columns):
+    """Return a function that parses a CSV row, with the given columns, into a Person.
+
+    The attribute to set and the transform to apply for each column are looked up once,
+    here, so parsing a row is just a single pass over its values."""
+    plain_fields = []
+    transformed_fields = []
+    for n, column in enumerate(columns):
+        transform_func = PARSE_TRANSFORMS.get(column)
+        if transform_func is None:
+            plain_fields.append((n, column.value))
+        else:
+            transformed_fields.append((n, column.value, transform_func))
+    num_columns = len(columns)
+
+    def parse_row(row):
+        if len(row) < num_columns:
+            # Short rows only have values for the first columns
+            return parse_short_row(row)
+        person = Person()
+        for n, attr in plain_fields:
+            setattr(person, attr, row[n].strip())
+        for n, attr, transform_func in transformed_fields:
+            setattr(person, attr, transform_func(row[n].strip()))
+        validate_person(person)
+        return person
+
+    def parse_short_row(row):
+        person = Person()
+        for n, attr in plain_fields:
+            if n < len(row):
+                setattr(person, attr, row[n].strip())
+        for n, attr, transform_func in transformed_fields:
+            if n < len(row):
+                setattr(person, attr, transform_func(row[n].strip()))
+        validate_person(person)
+        return person
+
+    return parse_row
 
 
 def validate_header_row(row):
@@ -56,44 +163,86 @@ def validate_header_row(row):
 
 
 def add_to_family(person, families):
-    family_id = person[Column.FAMILY_ID]
+    family_id = person.family_id
     try:
-        if person[Column.MEMBER_TYPE].lower() == 'parent':
-            families[family_id]['parents'].append(person)
-        else:
-            families[family_id]['students'].append(person)
+        family = families[family_id]
     except KeyError:
-        families[family_id] = {
-            'id': family_id,
-            'last_name': person[Column.LAST_NAME],
-            'parents': [],
-            'students': [],
-        }
-        add_to_family(person, families)
+        family = families[family_id] = Family(family_id, person.last_name)
+    if person.member_type.lower() == 'parent':
+        family.parents.append(person)
+    else:
+        family.students.append(person)
+
+
+def summarize_family(family):
+    """Return (name, number of parents, number of students) of a family, where name is
+    all the last names in the family, separated by '/'."""
+    last_names = set()
+    for person in family['parents'] + family['students']:
+        last_names.add(person[Column.LAST_NAME])
+    return '/'.join(sorted(last_names)), len(family['parents']), len(family['students'])
+
+
+def get_family_summary(families, family_id):
+    """Same as summarize_family(families[family_id]), but if the families were opened from a
+    document, answer from the document's summary rather than reading the family."""
+    if hasattr(families, 'summarize'):
+        return families.summarize(family_id)
+    return summarize_family(families[family_id])
 
 
 def get_classes(families):
+    if hasattr(families, 'get_classes'):
+        # Families opened from a document know their classes without reading every family
+        return families.get_classes()
     classes = set()
     for family in families.values():
         for student in family['students']:
-            classes = classes.union(student[Column.CLASSES])
+            classes.update(student[Column.CLASSES])
     return classes
 
 
 def load_families(path):
-    first_row = True
     families = {}
-    column_idx_to_name = None
+    for family in iter_families(path):
+        families[family.id] = family
+    return families
+
+
+def find_last_rows(path):
+    """Return a map of the family_id of each family in the registration CSV at path to the
+    number of its last row, counting from 0 after the header. Only reads the family_id
+    column; the header and the rows are validated when parsed by iter_families()."""
     with open(path, 'r') as f:
         reader = csv.reader(f)
-        for row in reader:
-            if first_row:
-                # This is the first row, process headers
-                column_idx_to_name = parse_headers(row)
-                first_row = False
-            else:
-                parse_person(row, column_idx_to_name, families)
-    return families
+        header = next(reader, None)
+        if header is None or Column.FAMILY_ID.value not in header:
+            return {}
+        n = header.index(Column.FAMILY_ID.value)
+        return {row[n].strip(): row_num for row_num, row in enumerate(reader) if n < len(row)}
+
+
+def iter_families(path):
+    """Read the registration CSV at path, yielding each Family as soon as it is complete.
+
+    A first pass over the file finds the last row of each family (see find_last_rows()), so
+    each family is yielded once, right after its last row, whether or not the rows are
+    grouped by family_id. Only families with rows still to come are held: for a file grouped
+    by family, one at a time."""
+    last_rows = find_last_rows(path)
+    open_families = {}  # Families that will get more rows
+    with open(path, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        parse_row = parse_headers(header)
+        for row_num, row in enumerate(reader):
+            person = parse_row(row)
+            add_to_family(person, open_families)
+            if last_rows.get(person.family_id) == row_num:
+                yield open_families.pop(person.family_id)
+    yield from open_families.values()
 
 
 def export_family_as_csv_rows(family):
@@ -112,22 +261,13 @@ def export_families(path, families):
                 writer.writerow(export_family_as_csv_rows(person))
 
 
-def parse_person(row, column_idx_to_name, families):
-    person = create_person(row, column_idx_to_name)
+def parse_person(row, parse_row, families):
+    """Parse a row with the parse_row function returned by parse_headers, and add the
+    resulting person to their family."""
+    person = parse_row(row)
     add_to_family(person, families)
 
 
-def create_person(row, column_idx_to_name):
-    person = {}
-    for n, column in enumerate(row):
-        col_name = column_idx_to_name[n]
-        person[col_name] = column
-    for col_name, value in person.items():
-        person[col_name] = transform(col_name, value.strip(), PARSE_TRANSFORMS)
-    validate_person(person)
-    return person
-
-
 def validate_person(person):
     if person[Column.MEMBER_TYPE] and person[Column.MEMBER_TYPE] not in VALID_MEMBER_TYPES:
         raise RuntimeError("Invalid person: bad " + Column.MEMBER_TYPE.value +
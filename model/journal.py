@@ -0,0 +1,333 @@
+import json
+import logging
+import os
+import struct
+import threading
+import uuid
+
+from model.document import (FAMILIES_PATH, LazyFamilies, decode_family, decode_value,
+                            encode_family, encode_value, load_document, pack, set_families,
+                            unpack, write_document_file)
+
+JOURNAL_SUFFIX = '.journal'
+RECORD_LENGTH_FORMAT = '>I'
+
+# Compact the journal into the document once it is larger than COMPACT_MIN_BYTES and
+# larger than COMPACT_RATIO times the document
+COMPACT_MIN_BYTES = 1024 * 1024
+COMPACT_RATIO = 0.5
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+def flatten(data, prefix=()):
+    """Return a map of key path to JSON of each value in the nested dicts of document data,
+    except for the families."""
+    values = {}
+    for key, value in data.items():
+        path = prefix + (key,)
+        if path == FAMILIES_PATH:
+            continue
+        if isinstance(value, dict) and value:
+            values.update(flatten(value, path))
+        else:
+            values[path] = json.dumps(encode_value(value), separators=(',', ':'))
+    return values
+
+
+def get_families(data):
+    families = data
+    for key in FAMILIES_PATH:
+        families = families.setdefault(key, {})
+    return families
+
+
+def apply_record(data, record):
+    """Update document data in place with the changes in a journal record."""
+    for path in record.get('delete', []):
+        parent = data
+        for key in path[:-1]:
+            parent = parent.get(key, {})
+        parent.pop(path[-1], None)
+    for path, value in record.get('set', []):
+        parent = data
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+        parent[path[-1]] = decode_value(value)
+    families = record.get('families')
+    if families:
+        if families['clear']:
+            set_families(data, {})
+        target = get_families(data)
+        for family_id in families['removed']:
+            del target[family_id]
+        for family in families['set']:
+            target[family['id']] = decode_family(family)
+
+
+def write_record(f, record):
+    payload = pack(record)
+    f.write(struct.pack(RECORD_LENGTH_FORMAT, len(payload)))
+    f.write(payload)
+
+
+def read_records(path, end=None):
+    """Return a list of (record, offset of the end of the record) of the journal at path,
+    up to offset end if given. A record cut short, as by a crash while appending it, ends
+    the list."""
+    records = []
+    length_size = struct.calcsize(RECORD_LENGTH_FORMAT)
+    with open(path, 'rb') as f:
+        data = f.read() if end is None else f.read(end)
+    offset = 0
+    while offset + length_size <= len(data):
+        length, = struct.unpack_from(RECORD_LENGTH_FORMAT, data, offset)
+        record_end = offset + length_size + length
+        if record_end > len(data):
+            break
+        try:
+            record = unpack(data[offset + length_size:record_end])
+        except ValueError:  # zlib.error and json.JSONDecodeError are both ValueErrors
+            break
+        records.append((record, record_end))
+        offset = record_end
+    if offset < len(data):
+        logger.warning(f'Ignoring {len(data) - offset} bytes of incomplete record at end of {path}')
+    return records
+
+
+def compact_document(path, journal_path, journal_id, journal_start, journal_end, tmp_path):
+    """Write to tmp_path the document at path with the records of its journal between
+    offsets journal_start and journal_end applied. Returns (document ID, index entries)."""
+    data, _info = load_document(path)
+    for record, end in read_records(journal_path, journal_end):
+        if end > journal_start:
+            apply_record(data, record)
+    return write_document_file(tmp_path, data, folded=(journal_id, journal_end))
+
+
+class Journal:
+    """Log of the changes made to a saved document since it was written, kept next to it in
+    a file named like the document plus JOURNAL_SUFFIX.
+
+    Instead of rewriting the whole document, saving appends a record of only what changed
+    since the previous record: the values of the document data that differ, and the
+    families added, removed or changed. Autosave appends records too, but those only count
+    as saved once a later save record follows them; until then, they are recovered if the
+    application exits without discarding them, as in a crash. Once the journal grows large,
+    compaction folds its saved records into a new copy of the document in a background
+    thread, and then replaces the document and starts a new journal.
+
+    The journal starts with a header record with its own ID and the ID of the document it
+    applies to. A compacted document records the journal ID and offset it folded in, so if
+    the application stops between replacing the document and the journal, the records
+    already folded in are skipped."""
+
+    def __init__(self, path, document_id):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.document_id = document_id
+        self.journal_id = None
+        # Start of the records still to be applied to the document, after the header
+        self.start = 0
+        # Offset just past the last saved record, and of the end of the journal
+        self.saved_size = 0
+        self.size = 0
+        # JSON of the document values as of the last record, from flatten()
+        self.values = {}
+        self.compaction = None
+        self.compaction_result = None
+
+    @classmethod
+    def create(cls, path, document_id, data):
+        """Start a new, empty journal for the document data just saved to path."""
+        journal = cls(path, document_id)
+        journal.reset(data)
+        return journal
+
+    def reset(self, data):
+        with open(self.journal_path, 'wb') as f:
+            self.write_header(f)
+        self.values = flatten(data)
+
+    def write_header(self, f):
+        """Start a new journal with its header record in f, a file opened for writing."""
+        self.journal_id = uuid.uuid4().hex
+        write_record(f, {'journal': self.journal_id, 'document': self.document_id})
+        self.start = self.saved_size = self.size = f.tell()
+
+    def replay(self, data, folded=None):
+        """Apply the journal of the document to its data, as read from the document, whose
+        'folded' journal info is given. Returns True if any autosaved records not saved
+        since were applied.
+
+        This only reads the journal, so it is safe from a background thread, and to drop
+        the result. A journal not for this document is replaced by the first append()."""
+        try:
+            records = read_records(self.journal_path)
+        except FileNotFoundError:
+            records = []
+        header = records[0][0] if records else {}
+        if header.get('document') == self.document_id:
+            self.start = records[0][1]
+        elif folded and header.get('journal') == folded[0]:
+            self.start = folded[1]
+        else:
+            if records:
+                logger.warning(f'Ignoring journal {self.journal_path},'
+                               f' which is not for this document')
+            self.journal_id = None
+            self.start = self.saved_size = self.size = 0
+            self.values = flatten(data)
+            return False
+        self.journal_id = header['journal']
+        self.saved_size = self.start
+        for record, end in records[1:]:
+            if end > self.start:
+                apply_record(data, record)
+                if record['saved']:
+                    self.saved_size = end
+        self.size = records[-1][1]
+        self.values = flatten(data)
+        logger.info(f'Replayed {self.size - self.start} bytes of journal {self.journal_path}')
+        return self.size > self.saved_size
+
+    def make_record(self, data, family_changes, saved):
+        """Return a record of the changes to document data since the last record, or None if
+        there are none. family_changes is a FamilyChanges of the families, or None if they
+        were all replaced."""
+        record = {'saved': saved}
+        values = flatten(data)
+        changed = [[list(path), json.loads(value)] for path, value in values.items()
+                   if self.values.get(path) != value]
+        if changed:
+            record['set'] = changed
+        deleted = [list(path) for path in self.values if path not in values]
+        if deleted:
+            record['delete'] = deleted
+        families = get_families(data)
+        if family_changes is None:
+            record['families'] = {
+                'clear': True,
+                'removed': [],
+                'set': [encode_family(family) for family in families.values()],
+            }
+        elif family_changes:
+            record['families'] = {
+                'clear': False,
+                'removed': list(family_changes.removed),
+                'set': [encode_family(families[family_id])
+                        for updated in (family_changes.changed, family_changes.added)
+                        for family_id in updated],
+            }
+        self.values = values
+        if len(record) == 1 and (not saved or self.saved_size == self.size):
+            return None
+        return record
+
+    def append(self, data, family_changes, saved=True):
+        """Append a record of the changes to document data since the last record, as in
+        make_record(). Autosave passes saved=False. Returns True if a record was appended."""
+        record = self.make_record(data, family_changes, saved)
+        if record is None:
+            return False
+        with open(self.journal_path, 'r+b' if self.journal_id is not None else 'wb') as f:
+            if self.journal_id is None:
+                # No journal for this document yet, see replay()
+                self.write_header(f)
+            else:
+                # Drop anything past the last good record, like a record cut short by a crash
+                f.seek(self.size)
+                f.truncate()
+            write_record(f, record)
+            f.flush()
+            os.fsync(f.fileno())
+            self.size = f.tell()
+        if saved:
+            self.saved_size = self.size
+        return True
+
+    def discard_unsaved(self):
+        """Remove the autosaved records not followed by a save record."""
+        if self.size > self.saved_size:
+            os.truncate(self.journal_path, self.saved_size)
+            self.size = self.saved_size
+
+    def needs_compaction(self):
+        size = self.saved_size - self.start
+        return size > COMPACT_MIN_BYTES and size > COMPACT_RATIO * os.path.getsize(self.path)
+
+    def start_compaction(self, on_done=None):
+        """Compact the saved records into the document in a background thread, which calls
+        on_done when it is finished. finish_compaction() must then be called from the thread
+        that appends records, to replace the document and journal."""
+        if self.compaction is not None:
+            return
+        args = (self.path, self.journal_path, self.journal_id, self.start, self.saved_size,
+                self.path + '.compact')
+
+        def compact():
+            try:
+                self.compaction_result = compact_document(*args) + (args[4],)
+            except Exception as e:
+                logger.exception(f'Error compacting {self.path}')
+                self.compaction_result = e
+            if on_done is not None:
+                on_done()
+
+        logger.debug(f'compacting {self.saved_size - self.start} bytes of journal into {self.path}')
+        self.compaction = threading.Thread(target=compact, daemon=True)
+        self.compaction.start()
+
+    def finish_compaction(self, families=None, wait=False):
+        """Replace the document with the compacted copy, and start a new journal with the
+        records appended since compaction started. families, if read lazily from the
+        document, are switched to reading from the new file. Does nothing unless a
+        compaction has finished, or wait is True and one is running."""
+        if self.compaction is None or (self.compaction.is_alive() and not wait):
+            return
+        self.compaction.join()
+        self.compaction = None
+        tmp_path = self.path + '.compact'
+        if isinstance(self.compaction_result, Exception):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        document_id, entries, journal_end = self.compaction_result
+        with open(self.journal_path, 'rb') as f:
+            f.seek(journal_end)
+            tail = f.read(self.size - journal_end)
+        os.replace(tmp_path, self.path)
+        self.document_id = document_id
+        if isinstance(families, LazyFamilies) and families.path == self.path:
+            families.relocate(self.path, entries)
+        self.journal_id = uuid.uuid4().hex
+        with open(self.journal_path + '.tmp', 'wb') as f:
+            write_record(f, {'journal': self.journal_id, 'document': self.document_id})
+            self.start = f.tell()
+            f.write(tail)
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+        self.saved_size += self.start - journal_end
+        self.size += self.start - journal_end
+        logger.info(f'Compacted journal into {self.path}')
+
+    def close(self, families=None, discard_unsaved=True):
+        """Finish any compaction, as in finish_compaction(), and remove autosaved records
+        unless discard_unsaved is False."""
+        self.finish_compaction(families, wait=True)
+        if discard_unsaved:
+            self.discard_unsaved()
+
+
+def open_document(path):
+    """Read the document at path and apply its journal. Returns (data, journal, recovered),
+    where recovered is True if autosaved changes that were never saved were applied.
+    journal is None for documents of format version 1.0, which have no journal."""
+    data, info = load_document(path)
+    if not info:
+        return data, None, False
+    journal = Journal(path, info['id'])
+    recovered = journal.replay(data, info['folded'])
+    return data, journal, recovered
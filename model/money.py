@@ -0,0 +1,32 @@
+from decimal import Decimal, InvalidOperation
+
+CENTS_PER_UNIT = 100
+
+
+def to_cents(amount):
+    """Return an amount of money, a Decimal (e.g. from validate_currency()) or str, as an
+    int number of cents. Raises ValueError if it is not a number, is infinite or NaN, or
+    has fractions of a cent, rather than rounding, so that the conversion is always exact."""
+    try:
+        cents = Decimal(amount) * CENTS_PER_UNIT
+    except InvalidOperation:
+        raise ValueError(f'Amount is not a number: {amount}')
+    if not cents.is_finite():
+        raise ValueError(f'Amount is not a finite number: {amount}')
+    if cents != cents.to_integral_value():
+        raise ValueError(f'Amount has fractions of a cent: {amount}')
+    return int(cents)
+
+
+def is_cents(value):
+    """Return whether value is an amount in cents, as from to_cents()."""
+    return type(value) == int
+
+
+def format_cents(cents):
+    """Format an amount in cents with two digits after the decimal point, e.g. 1050 as
+    '10.50', like str() of a Decimal with two places."""
+    sign = '-' if cents < 0 else ''
+    units, cents = divmod(abs(cents), CENTS_PER_UNIT)
+    return f'{sign}{units}.{cents:02d}'
+
@@ -0,0 +1,131 @@
+import csv
+import io
+import locale
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from model.family import load_families, parse_headers, parse_person
+
+# Files smaller than this are not worth the cost of starting worker processes
+PARALLEL_LOAD_MIN_BYTES = 8 * 1024 * 1024
+
+# Number of chunks to split the file into per worker, to even out the work between workers
+CHUNKS_PER_WORKER = 4
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+def find_row_end(f, pos, quotes):
+    """Return the offset just past the first newline at or after pos that ends a CSV row,
+    i.e. is not inside a quoted field. quotes is the number of '"' characters before pos,
+    so its parity tells whether pos itself is inside a quoted field. Returns the end of the
+    file if there is no such newline."""
+    f.seek(pos)
+    while True:
+        block = f.read(READ_BLOCK_SIZE)
+        if not block:
+            return f.tell()
+        start = 0
+        while True:
+            newline = block.find(b'\n', start)
+            if newline < 0:
+                quotes += block.count(b'"', start)
+                break
+            quotes += block.count(b'"', start, newline)
+            if quotes % 2 == 0:
+                return pos + newline + 1
+            start = newline + 1
+        pos += len(block)
+
+
+def count_quotes(f, start, end):
+    f.seek(start)
+    quotes = 0
+    while start < end:
+        block = f.read(min(READ_BLOCK_SIZE, end - start))
+        if not block:
+            break
+        quotes += block.count(b'"')
+        start += len(block)
+    return quotes
+
+
+def split_rows(path, num_chunks):
+    """Split the CSV at path into byte ranges of whole rows.
+    Returns (header_end, boundaries), where the header row is bytes [0, header_end), and the
+    data rows are split into ranges [boundaries[n], boundaries[n + 1]). Rows may contain
+    quoted newlines; a range only ends at a newline outside of any quoted field."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header_end = find_row_end(f, 0, 0)
+        boundaries = [header_end]
+        quotes = count_quotes(f, 0, header_end)
+        for n in range(1, num_chunks):
+            target = header_end + (size - header_end) * n // num_chunks
+            if target <= boundaries[-1]:
+                continue
+            quotes += count_quotes(f, boundaries[-1], target)
+            boundary = find_row_end(f, target, quotes)
+            if boundary >= size:
+                break
+            quotes += count_quotes(f, target, boundary)
+            boundaries.append(boundary)
+        boundaries.append(size)
+    return header_end, boundaries
+
+
+def read_text(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # Decode as open() would by default, translating newlines as it would too
+    return io.StringIO(data.decode(locale.getpreferredencoding(False)), newline=None)
+
+
+def parse_chunk(path, header_end, start, end):
+    """Parse rows in bytes [start, end) of the CSV at path into a map of family ID to Family,
+    with families and people in the order they appear in the chunk."""
+    header = next(csv.reader(read_text(path, 0, header_end)))
+    parse_row = parse_headers(header)
+    families = {}
+    for row in csv.reader(read_text(path, start, end)):
+        parse_person(row, parse_row, families)
+    return families
+
+
+def merge_families(chunks):
+    """Merge per-chunk family maps, given in file order, into one map. People of a family
+    found in several chunks stay in file order, as do the families themselves."""
+    families = {}
+    for chunk in chunks:
+        for family_id, family in chunk.items():
+            try:
+                merged = families[family_id]
+            except KeyError:
+                families[family_id] = family
+            else:
+                merged.parents.extend(family.parents)
+                merged.students.extend(family.students)
+    return families
+
+
+def load_families_parallel(path, max_workers=None):
+    """Same as load_families(), but parse the file in chunks in several worker processes.
+    max_workers defaults to the number of CPUs."""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers <= 1 or os.path.getsize(path) < PARALLEL_LOAD_MIN_BYTES:
+        return load_families(path)
+    header_end, boundaries = split_rows(path, max_workers * CHUNKS_PER_WORKER)
+    num_chunks = len(boundaries) - 1
+    logger.debug(f'parsing {path} in {num_chunks} chunks with {max_workers} workers')
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        chunks = executor.map(parse_chunk,
+                              [path] * num_chunks,
+                              [header_end] * num_chunks,
+                              boundaries[:-1],
+                              boundaries[1:])
+        return merge_families(chunks)
@@ -0,0 +1,47 @@
+import logging
+import os
+
+# The backends are imported here, not by name when selected, so that PyInstaller finds both
+# of them for the frozen app
+from pdf import generate, platypus_generate
+
+RML_BACKEND = 'rml'
+PLATYPUS_BACKEND = 'platypus'
+
+# Modules rendering the PDFs, each with generate_master(), generate_invoices(),
+# generate_one_invoice(), generate_invoice_pdf(), generate_invoices_pdf() and InvoiceRenderer
+BACKEND_MODULES = {
+    RML_BACKEND: generate,
+    PLATYPUS_BACKEND: platypus_generate,
+}
+
+# Environment variable selecting the backend, set by select_backend() from the application's
+# config unless already set. Being in the environment, it is also seen by the worker
+# processes of pdf.parallel_render.
+BACKEND_ENV_VAR = 'CLASSINVOICES_PDF_BACKEND'
+DEFAULT_BACKEND = RML_BACKEND
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+def get_backend_name():
+    return os.environ.get(BACKEND_ENV_VAR, DEFAULT_BACKEND)
+
+
+def select_backend(name):
+    """Render PDFs with the named backend, e.g. from the app_config.PDF_BACKEND_KEY setting,
+    unless the environment already selects one."""
+    get_backend(name)  # Check the name
+    if os.environ.setdefault(BACKEND_ENV_VAR, name) != name:
+        logger.info(f'{BACKEND_ENV_VAR} overrides the {name} PDF backend setting')
+
+
+def get_backend(name=None):
+    """Return the module of the named PDF backend, by default the one selected by the
+    environment."""
+    if name is None:
+        name = get_backend_name()
+    try:
+        return BACKEND_MODULES[name]
+    except KeyError:
+        raise RuntimeError(f'Unknown PDF backend: {name}')
@@ -0,0 +1,157 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import app_config
+from pdf.backend import get_backend, get_backend_name
+from pdf.generate import INVOICE_TEMPLATE_VERSION
+
+CACHE_SUFFIX = '.pdf'
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+invoice_cache = None
+# True once the invoice cache could not be created, so it isn't tried again
+invoice_cache_failed = False
+
+
+def invoice_key(invoice, term):
+    """Return a digest of everything that goes into rendering an invoice object: the invoice
+    itself (which includes the note), the term, the template version and the backend
+    rendering it. Any change to the fees or enrollment of the family changes the invoice
+    object, so the key. The date printed on the invoice is not part of it, so an invoice
+    that did not change keeps the date it was first rendered on."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([INVOICE_TEMPLATE_VERSION, get_backend_name(), term, invoice],
+                        default=str).encode())
+    return h.hexdigest()
+
+
+class InvoiceCache:
+    """Directory of rendered invoice PDFs, each in a file named by its invoice_key().
+
+    Once the files add up to more than max_bytes, the least recently used ones are removed.
+    Entries are never stale, since their inputs are in their key; invoices of families whose
+    fees or enrollment changed just stop being used, and are eventually removed."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Only the user may read the invoices, which have the families' names and fees
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        os.chmod(path, 0o700)
+        # Key -> size of each file, least recently used first
+        self.sizes = OrderedDict()
+        entries = []
+        for entry in os.scandir(path):
+            if entry.name.endswith(CACHE_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(CACHE_SUFFIX)], stat.st_size))
+        for _mtime, key, size in sorted(entries):
+            self.sizes[key] = size
+        self.total_bytes = sum(self.sizes.values())
+
+    def get_path(self, key):
+        return os.path.join(self.path, key + CACHE_SUFFIX)
+
+    def get(self, key):
+        """Return the PDF data cached for key, or None."""
+        with self.lock:
+            if key not in self.sizes:
+                return None
+            path = self.get_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # The modification time records the use, for ordering the files when reopened
+                os.utime(path)
+            except FileNotFoundError:
+                self.total_bytes -= self.sizes.pop(key)
+                return None
+            self.sizes.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        path = self.get_path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes += len(data) - self.sizes.pop(key, 0)
+            self.sizes[key] = len(data)
+            self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.sizes) > 1:
+            key, size = self.sizes.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+
+
+def get_invoice_cache():
+    """Return the application's InvoiceCache, or None if its directory can't be created."""
+    global invoice_cache, invoice_cache_failed
+    if invoice_cache is None and not invoice_cache_failed:
+        path = app_config.get_invoice_cache_path()
+        try:
+            invoice_cache = InvoiceCache(path, app_config.INVOICE_CACHE_MAX_BYTES)
+        except OSError:
+            logger.exception(f'Cannot use invoice cache {path}')
+            invoice_cache_failed = True
+    return invoice_cache
+
+
+def find_invoice_pdf(invoice, term, cache=None, pages=None):
+    """Return the PDF data of an invoice object from the cache, if the same invoice was
+    rendered before, or else from pages, the pdf.slicing.InvoicePages of a PDF of many
+    invoices, adding it to the cache. Returns None if the invoice must be rendered."""
+    if cache is None and pages is None:
+        return None
+    key = invoice_key(invoice, term)
+    if cache is not None:
+        data = cache.get(key)
+        if data is not None:
+            return data
+    if pages is not None:
+        data = pages.get_pdf(invoice['family_id'], key)
+        if data is not None:
+            put_invoice_pdf(invoice, term, data, cache)
+            return data
+    return None
+
+
+def put_invoice_pdf(invoice, term, data, cache=None):
+    """Add the PDF data of an invoice object to the cache, if any."""
+    if cache is None:
+        return
+    key = invoice_key(invoice, term)
+    try:
+        cache.put(key, data)
+    except OSError:
+        logger.exception(f'Error caching invoice of family {invoice["last_name"]}')
+
+
+def get_invoice_pdf(invoice, term, cache=None, renderer=None, pages=None):
+    """Return the PDF data of an invoice object, like generate_invoice_pdf(), but from the
+    cache or pages if there (see find_invoice_pdf()). For many families, pass the backend's
+    InvoiceRenderer for the term, which renders faster than starting over each time."""
+    data = find_invoice_pdf(invoice, term, cache, pages)
+    if data is not None:
+        return data
+    pdf_buffer = io.BytesIO()
+    if renderer is None:
+        get_backend().generate_invoice_pdf(invoice, term, pdf_buffer)
+    else:
+        renderer.render(invoice, pdf_buffer)
+    data = pdf_buffer.getvalue()
+    put_invoice_pdf(invoice, term, data, cache)
+    return data
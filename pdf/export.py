@@ -0,0 +1,174 @@
+import csv
+import json
+import logging
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from model.money import format_cents
+from pdf.backend import get_backend
+from pdf.cache import invoice_key
+from pdf.generate import create_invoice_objects
+from pdf.parallel_render import PROGRESS_INTERVAL, SHARDS_PER_WORKER, split_shards
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+MANIFEST_JSON = 'manifest.json'
+MANIFEST_CSV = 'manifest.csv'
+MANIFEST_FIELDS = ['file', 'family_id', 'last_name', 'total', 'pages', 'hash']
+
+# Fewer invoices than this are rendered faster in one process than by starting worker processes
+EXPORT_PARALLEL_MIN_INVOICES = 50
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+def invoice_file_name(family):
+    """Return the file name of a family's invoice: its last name and id, with any characters
+    that are not safe in file names replaced."""
+    name = f'{family["last_name"]}-{family["id"]}'
+    return re.sub(r'[^\w.-]+', '_', name).strip('._') + '.pdf'
+
+
+def count_pages(path):
+    """Return the number of pages of a PDF file, or None without PyMuPDF."""
+    if pymupdf is None:
+        return None
+    with pymupdf.open(path) as document:
+        return document.page_count
+
+
+def render_invoice_file(renderer, invoice, directory, file_name):
+    """Render an invoice object to a file in directory, written to a temporary file first,
+    so that an interrupted export leaves no partial files. Returns its page count."""
+    path = os.path.join(directory, file_name)
+    tmp_path = path + '.tmp'
+    renderer.render(invoice, tmp_path)
+    os.replace(tmp_path, path)
+    return count_pages(path)
+
+
+def render_invoice_files(jobs, term, directory):
+    """Render a list of (file name, invoice object) to files in directory, in a worker
+    process. Returns the page count of each file."""
+    renderer = get_backend().InvoiceRenderer(term)
+    return [render_invoice_file(renderer, invoice, directory, file_name)
+            for file_name, invoice in jobs]
+
+
+def read_manifest(directory):
+    """Return the entries of the manifest of a previous export to directory by file name,
+    or {} if there is none."""
+    try:
+        with open(os.path.join(directory, MANIFEST_JSON)) as f:
+            return {entry['file']: entry for entry in json.load(f)}
+    except FileNotFoundError:
+        return {}
+    except (ValueError, KeyError, TypeError):
+        logger.exception(f'Ignoring unreadable manifest in {directory}')
+        return {}
+
+
+def write_manifest(directory, entries):
+    """Write the manifest as JSON, which later exports read to resume, and as CSV."""
+    json_path = os.path.join(directory, MANIFEST_JSON)
+    with open(json_path + '.tmp', 'w') as f:
+        json.dump(entries, f, indent=2)
+    os.replace(json_path + '.tmp', json_path)
+    csv_path = os.path.join(directory, MANIFEST_CSV)
+    with open(csv_path + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(entries)
+    os.replace(csv_path + '.tmp', csv_path)
+
+
+def export_invoices(progress, families, class_map, note, term, directory, max_workers=None,
+                    index=None):
+    """Render the invoice of each family with students to its own PDF file in directory,
+    in worker processes, and write a manifest of the files with the family id, invoice
+    total, page count and invoice_key() hash of each. Files whose manifest entry from a
+    previous export has the same hash, and which still exist, are not rendered again. The
+    progress is updated with the number of families done, and if cancelled, the manifest
+    lists the files finished so far. max_workers defaults to the number of CPUs. index is
+    passed on to create_invoice_objects().
+    Returns (number of files rendered, number of files kept from the previous export)."""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    os.makedirs(directory, exist_ok=True)
+    previous = read_manifest(directory)
+
+    entries = {}
+    file_names = []
+    jobs = []
+    for family_id, invoice in create_invoice_objects(families, class_map, note, index).items():
+        family = families[family_id]
+        file_name = invoice_file_name(family)
+        file_names.append(file_name)
+        entry = {
+            'file': file_name,
+            'family_id': family['id'],
+            'last_name': family['last_name'],
+            'total': format_cents(invoice['total']),
+            'pages': None,
+            'hash': invoice_key(invoice, term),
+        }
+        old_entry = previous.get(file_name)
+        if (old_entry is not None and old_entry.get('hash') == entry['hash']
+                and os.path.exists(os.path.join(directory, file_name))):
+            entry['pages'] = old_entry.get('pages')
+            entries[file_name] = entry
+        else:
+            jobs.append((file_name, invoice, entry))
+    num_kept = len(entries)
+    logger.debug(f'exporting {len(jobs)} invoices to {directory}, keeping {num_kept}')
+
+    def finish_shard(shard, pages):
+        for (file_name, _invoice, entry), num_pages in zip(shard, pages):
+            entry['pages'] = num_pages
+            entries[file_name] = entry
+
+    def update_progress(num_rendered):
+        progress.Update(min(num_kept + num_rendered, len(families) - 1),
+                        newmsg='Please wait...\n\n'
+                               f'Exported {num_rendered} of {len(jobs)} invoices'
+                               f' ({num_kept} unchanged)')
+
+    num_rendered = 0
+    try:
+        if max_workers <= 1 or len(jobs) < EXPORT_PARALLEL_MIN_INVOICES:
+            renderer = get_backend().InvoiceRenderer(term)
+            for file_name, invoice, entry in jobs:
+                if progress.WasCancelled():
+                    break
+                update_progress(num_rendered)
+                entry['pages'] = render_invoice_file(renderer, invoice, directory, file_name)
+                entries[file_name] = entry
+                num_rendered += 1
+        else:
+            shards = split_shards(jobs, max_workers * SHARDS_PER_WORKER)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(render_invoice_files,
+                                           [job[:2] for job in shard], term, directory): shard
+                           for shard in shards}
+                pending = set(futures)
+                while pending:
+                    if progress.WasCancelled():
+                        for future in pending:
+                            future.cancel()
+                        break
+                    done, pending = wait(pending, timeout=PROGRESS_INTERVAL,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        shard = futures[future]
+                        finish_shard(shard, future.result())
+                        num_rendered += len(shard)
+                    update_progress(num_rendered)
+    finally:
+        # In family order, with the files done so far if cancelled or failed
+        write_manifest(directory, [entries[file_name] for file_name in file_names
+                                   if file_name in entries])
+    return num_rendered, num_kept
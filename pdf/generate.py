@@ -1,12 +1,21 @@
+import contextlib
 import datetime
 import io
 import logging
-from decimal import Decimal
+from xml.sax.saxutils import escape
 
-from z3c.rml import rml2pdf
+import reportlab.rl_config
+from lxml import etree
+from reportlab.lib import colors
+from z3c.rml import document, rml2pdf, template
 
 from model.columns import Column
 from model.family import get_parents, get_students
+from model.money import format_cents
+
+# Increment when the invoice templates or their formatting change, so that invoice PDFs
+# cached by pdf.cache are rendered again
+INVOICE_TEMPLATE_VERSION = 2
 
 RML_BEGIN_TEMPLATE_PORTRAIT = """<!DOCTYPE document SYSTEM "rml_1_0.dtd">
 <document filename="master.pdf" invariant="1">
@@ -125,6 +134,8 @@ RML_HORIZONTAL_LINE = """\
 
 RML_PARAGRAPH_TEMPLATE = '<para style="{style}">{msg}</para>'
 
+RML_OUTLINE_TEMPLATE = '<outlineAdd key="{key}">{title}</outlineAdd>\n'
+
 RML_MASTER_FAMILY_TEMPLATE = """\
     <keepTogether>
     <para style="header"><b>{last_name}</b>, <font size="10">{parents}</font></para>
@@ -137,7 +148,12 @@ RML_MASTER_FAMILY_TEMPLATE = """\
 logger = logging.getLogger(f'classinvoices.{__name__}')
 
 
-def generate_master_rml_for_family(family, class_map, rml_file):
+def create_master_entry(family, class_map, teacher_totals=None):
+    """Collect the master list entry for a family. If given, teacher_totals is the family's
+    map of teacher to total fees, e.g. from EnrollmentIndex.teacher_totals(), which saves
+    collecting the teacher columns and totals again here.
+    Fees are summed in cents, and formatted in the table rows returned.
+    Returns (last names, parent first names, table rows)."""
     # Set of all last names in family. Normally just one.
     last_names = set()
 
@@ -146,27 +162,33 @@ def generate_master_rml_for_family(family, class_map, rml_file):
     for parent in family['parents']:
         last_names.add(parent[Column.LAST_NAME].strip())
         parents.append(parent[Column.FIRST_NAME].strip())
-    parents_rml = ', '.join(sorted(parents))
 
     # Create map of teacher name to column number
     teacher_map = {}
     columns = ['']
     num_cols = 1
-    for student in family['students']:
-        for class_name in student[Column.CLASSES]:
-            teacher, fee = class_map[class_name]
-            if not teacher:
-                continue
-            if teacher not in teacher_map:
-                words = teacher.strip().split()
-                teacher_wrapped = words[0].strip() + '\n' + ' '.join(words[1:]).strip()
-                columns.append(teacher_wrapped)
-                teacher_map[teacher] = num_cols
-                num_cols += 1
+    if teacher_totals is not None:
+        teachers = teacher_totals
+    else:
+        teachers = (class_map[class_name][0]
+                    for student in family['students']
+                    for class_name in student[Column.CLASSES])
+    for teacher in teachers:
+        if not teacher:
+            continue
+        if teacher not in teacher_map:
+            words = teacher.strip().split()
+            teacher_wrapped = words[0].strip() + '\n' + ' '.join(words[1:]).strip()
+            columns.append(teacher_wrapped)
+            teacher_map[teacher] = num_cols
+            num_cols += 1
 
     # Create student class table rows
-    students_rml = generate_table_row_rml(columns)
-    totals = ['Total'] + [Decimal(0.00)] * (len(columns) - 1)
+    rows = [columns]
+    if teacher_totals is not None:
+        totals = ['Total'] + list(teacher_totals.values())
+    else:
+        totals = ['Total'] + [0] * (len(columns) - 1)
     for student in family['students']:
         row = [''] * len(columns)
         row[0] = student[Column.FIRST_NAME].strip()
@@ -179,38 +201,100 @@ def generate_master_rml_for_family(family, class_map, rml_file):
                 row[col] = fee
             else:
                 row[col] += fee
-            totals[col] += fee
-        students_rml += generate_table_row_rml(row)
-    students_rml += generate_table_row_rml(totals)
-
-    # Format the data collected above into RML
-    rml = RML_MASTER_FAMILY_TEMPLATE.format(last_name=', '.join(sorted(last_names)),
-                                            parents=parents_rml,
-                                            students=students_rml)
+            if teacher_totals is None:
+                totals[col] += fee
+        rows.append([row[0]] + [fee if fee == '' else format_cents(fee) for fee in row[1:]])
+    rows.append(totals[:1] + [format_cents(fee) for fee in totals[1:]])
+    return ', '.join(sorted(last_names)), ', '.join(sorted(parents)), rows
+
+
+def generate_master_rml_for_family(family, class_map, rml_file, teacher_totals=None):
+    """Write the master list entry for a family, as collected by create_master_entry()."""
+    last_names, parents, rows = create_master_entry(family, class_map, teacher_totals)
+    students_rml = []
+    for row in rows:
+        write_table_row_rml(row, students_rml.append)
+    rml = RML_MASTER_FAMILY_TEMPLATE.format(last_name=last_names,
+                                            parents=parents,
+                                            students=''.join(students_rml))
     rml_file.write(rml)
 
 
-def generate_master(families, class_map, term, output_file):
+class RenderCancelled(Exception):
+    """Raised by progress callbacks to stop rendering a document that was cancelled."""
+
+
+def generate_master(families, class_map, term, output_file, index=None, progress=None):
+    """Generate the master list PDF. If given, index is an EnrollmentIndex of the families,
+    already updated with class_map, to look up each family's teacher totals in.
+
+    If given, progress is updated from 0 to 2 * len(families), like the dialog of
+    generate_invoices(): first family by family while the RML is assembled, and then as
+    ReportLab lays out the families on pages. If it was cancelled, generating stops, the
+    output is incomplete, and False is returned. Otherwise returns True."""
     rml = io.StringIO()
     start_rml(rml,
               template=RML_BEGIN_TEMPLATE_PORTRAIT,
               title='Class Enrollment Master List',
               term=term,
               footer='Page <pageNumber/>')
-    for family in families.values():
+    for n, family in enumerate(families.values()):
+        if progress is not None:
+            if progress.WasCancelled():
+                return False
+            progress.Update(n, newmsg='Please wait...\n\n'
+                                      f'Listing family: {family["last_name"]}')
         if get_students(family):
-            generate_master_rml_for_family(family, class_map, rml)
+            teacher_totals = None
+            if index is not None:
+                teacher_totals = index.teacher_totals(family['id'])
+            generate_master_rml_for_family(family, class_map, rml, teacher_totals)
     finish_rml(rml)
     # logger.debug('rml: %s', rml.getvalue())
-    rml.seek(0)
-    rml2pdf.go(rml, outputFileName=output_file)
-
-
-def create_invoice_object(family, class_map, note):
+    root = etree.fromstring(rml.getvalue().encode())
+    del rml
+    on_progress = None
+    if progress is not None:
+        on_progress = make_layout_progress(progress, len(families), 'Laying out families on pages')
+    try:
+        build_rml_story(start_rml_document(root), root.find('story'), output_file, on_progress)
+    except RenderCancelled:
+        return False
+    return True
+
+
+def make_layout_progress(progress, offset, msg):
+    """Return a callback for the progress events of ReportLab's document templates, which
+    updates progress from offset to 2 * offset as the flowables of a story are laid out,
+    and raises RenderCancelled if progress was cancelled."""
+    num_flowables = 1
+    last_value = None
+
+    def on_progress(event, value):
+        nonlocal num_flowables, last_value
+        if event == 'SIZE_EST':
+            num_flowables = max(value, 1)
+        elif event in ('PROGRESS', 'PAGE'):
+            if progress.WasCancelled():
+                raise RenderCancelled()
+            if event == 'PROGRESS':
+                update_value = min(offset + offset * value // num_flowables, 2 * offset - 1)
+                # Only when the value changes, not for every flowable
+                if update_value != last_value:
+                    last_value = update_value
+                    progress.Update(update_value, newmsg=f'Please wait...\n\n{msg}'
+                                                         f' ({value} of {num_flowables})')
+
+    return on_progress
+
+
+def create_invoice_object(family, class_map, note, teacher_totals=None):
     """Create an invoice object from a family object.
     Formats names and emails, collates classes by teacher, and sums
-    class fees by teacher."""
-    invoice = {}
+    class fees by teacher. Fees and totals are in cents, as in the class map.
+    If given, teacher_totals are the family's fees by teacher from an EnrollmentIndex,
+    which are used instead of summing them again."""
+    invoice = {'family_id': family['id'], 'last_name': family['last_name']}
     parents = get_parents(family)
     students = get_students(family)
     invoice['parent'] = []
@@ -220,39 +304,97 @@ def create_invoice_object(family, class_map, note):
             parent[Column.EMAIL]])
     payable = {}
     invoice['students'] = {}
-    invoice['total'] = Decimal(0.00)
+    invoice['total'] = 0
     invoice['note'] = note
     for student in students:
         name = student[Column.LAST_NAME] + ', ' + student[Column.FIRST_NAME]
         invoice['students'][name] = []
         for class_name in student[Column.CLASSES]:
             teacher, fee = class_map[class_name]
-            # Ensure fee has two digits after the decimal:
-            fee += Decimal('0.00')
             invoice['students'][name].append([class_name, teacher, fee])
             invoice['total'] += fee
-            try:
-                payable[teacher] += fee
-            except KeyError:
-                payable[teacher] = fee
-    invoice['payable'] = payable
+            if teacher_totals is None:
+                try:
+                    payable[teacher] += fee
+                except KeyError:
+                    payable[teacher] = fee
+    invoice['payable'] = payable if teacher_totals is None else dict(teacher_totals)
     return invoice
 
 
+def create_invoice_objects(families, class_map, note, index=None):
+    """Return a map of family ID to the invoice object of each family with students, in the
+    order of the families. Computed once per operation, e.g. when emailing the invoices, and
+    passed to everything that needs them, rather than each step creating them again.
+    If given, index is an EnrollmentIndex of the families, already updated with class_map,
+    whose teacher totals are the payables, as on the master list."""
+    if index is None:
+        return {family['id']: create_invoice_object(family, class_map, note)
+                for family in families.values() if get_students(family)}
+    return {family['id']: create_invoice_object(family, class_map, note,
+                                                index.teacher_totals(family['id']))
+            for family in families.values() if get_students(family)}
+
+
 def generate_one_invoice(family, class_map, note, term, output_file):
+    invoice = create_invoice_object(family, class_map, note)
+    generate_invoice_pdf(invoice, term, output_file)
+
+
+def generate_invoice_pdf(invoice, term, output_file):
+    """Render an invoice object from create_invoice_object() to PDF."""
+    generate_invoices_pdf([invoice], term, output_file)
+
+
+def generate_invoices_pdf(invoices, term, output_file):
+    """Render invoice objects from create_invoice_object() to PDF, one page each."""
     rml = io.StringIO()
     start_rml(rml,
               template=RML_BEGIN_TEMPLATE_PORTRAIT,
               title='Class Enrollment Invoice',
               term=term)
-    invoice = create_invoice_object(family, class_map, note)
-    generate_invoice_page_rml(invoice, rml)
+    for invoice in invoices:
+        generate_invoice_page_rml(invoice, rml)
     finish_rml(rml)
     rml.seek(0)
     rml2pdf.go(rml, outputFileName=output_file)
 
 
-def generate_invoices(progress, families, class_map, note, term, output_file):
+class InvoiceRenderer:
+    """Renders invoice objects to PDF one at a time, like generate_invoice_pdf(), but with
+    the stylesheet parsed only once, for bulk sends of many single-invoice documents.
+
+    rml2pdf.go() parses and processes the whole document for every invoice, after resetting
+    ReportLab's global state, which reloads its fonts. Here the template and stylesheet are
+    processed once, by a z3c.rml Document that is kept, and each render only processes the
+    story of its invoice and builds it with the document's page template.
+    Not thread safe: use one renderer per thread."""
+
+    def __init__(self, term):
+        rml = io.StringIO()
+        start_rml(rml,
+                  template=RML_BEGIN_TEMPLATE_PORTRAIT,
+                  title='Class Enrollment Invoice',
+                  term=term)
+        finish_rml(rml)
+        self.document = start_rml_document(etree.fromstring(rml.getvalue().encode()))
+
+    def render(self, invoice, output_file):
+        """Render an invoice object from create_invoice_object() to output_file, a path or
+        binary file."""
+        rml = io.StringIO()
+        rml.write('<story>')
+        generate_invoice_page_rml(invoice, rml)
+        rml.write('</story>')
+        build_rml_story(self.document, etree.fromstring(rml.getvalue()), output_file)
+
+
+def generate_invoices(progress, families, class_map, note, term, output_file, invoices=None):
+    """Render the invoices of the families with students to one PDF, one page each, updating
+    the progress family by family. If given, invoices are the families' invoice objects from
+    create_invoice_objects(), which are otherwise created here."""
+    if invoices is None:
+        invoices = create_invoice_objects(families, class_map, note)
     rml = io.StringIO()
     start_rml(rml,
               template=RML_BEGIN_TEMPLATE_PORTRAIT,
@@ -265,10 +407,10 @@ def generate_invoices(progress, families, class_map, note, term, output_file):
               f"Generating invoice for family: {family['last_name']}"
         # logger.debug(f'updating progress {n}: {msg}')
         progress.Update(n, newmsg=msg)
-        students = get_students(family)
-        if students:
-            logger.debug(f'processing {len(students)} students in family {n}: {family["last_name"]}')
-            invoice = create_invoice_object(family, class_map, note)
+        invoice = invoices.get(family['id'])
+        if invoice is not None:
+            logger.debug(f'processing {len(invoice["students"])} students in family {n}:'
+                         f' {family["last_name"]}')
             generate_invoice_page_rml(invoice, rml)
     finish_rml(rml)
     # logger.debug('rml: %s', rml.getvalue())
@@ -292,36 +434,121 @@ def finish_rml(rml_file):
     rml_file.write(RML_END_TEMPLATE)
 
 
-def generate_invoice_page_rml(invoice, rml_file):
-    parents_rml = ''
-    for parent in invoice['parent']:
-        parents_rml += generate_table_row_rml(parent)
+# start_rml_document() and build_rml_story() split z3c.rml's Document.process() in two,
+# which has no public way to process the stylesheet once for many stories, or to report
+# layout progress. They follow Document.process() of z3c.rml 5.2 for documents with a
+# template, using the same internals of z3c.rml and ReportLab, which is why requirements.txt
+# pins z3c.rml. Check them against Document.process() when upgrading it.
+
+def start_rml_document(root):
+    """Return a z3c.rml Document of the RML element tree root, with its stylesheet processed,
+    for build_rml_story(). Resets ReportLab's global state, like Document.process() does for
+    each document."""
+    rml_document = document.Document(root)
+    reportlab.rl_config._reset()
+    with rml_document_state(rml_document):
+        rml_document.processSubDirectives(select=('docinit', 'stylesheet'))
+    return rml_document
+
+
+@contextlib.contextmanager
+def rml_document_state(rml_document):
+    """Set ReportLab's global state for processing rml_document, as Document.process() does:
+    shape checking off unless the document has debug set, and the document's colors known
+    by name. Both are restored on exit."""
+    debug = rml_document.getAttributeValues(select=('debug',), valuesOnly=True)[0]
+    if not debug:
+        reportlab.rl_config.shapeChecking = 0
+    colors.toColor.setExtraColorsNameSpace(rml_document.colors)
+    try:
+        yield
+    finally:
+        colors.toColor.setExtraColorsNameSpace({})
+        reportlab.rl_config.shapeChecking = 1
+
+
+def build_rml_story(rml_document, story, output_file, on_progress=None):
+    """Lay out a story element on the page template of a Document from start_rml_document(),
+    and write the PDF to output_file, a path or binary file. This is the part of
+    Document.process() that depends on the story, so a Document can be used for many
+    stories, and it passes on ReportLab's progress events to on_progress(event, value), if
+    given."""
+    # Like Document.process(), build into a buffer for the post-processors to rework. Those
+    # the story adds (e.g. for includePdfPages) are dropped afterwards, for the next story.
+    temp_output = io.BytesIO()
+    post_processors = list(rml_document.postProcessors)
+    # The template directive creates the document template writing to outputFile
+    rml_document.outputFile = temp_output
+    try:
+        with rml_document_state(rml_document):
+            rml_document.processSubDirectives(select=('template',))
+            template.Story(story, rml_document).process()
+            doc = rml_document.doc
+            doc.beforeDocument = rml_document._beforeDocument
+
+            def callback(event, value):
+                # Paragraphs with page numbers need the pass being built, as set by
+                # Document.process()
+                if event == 'PASS':
+                    doc.current_pass = value
+                if on_progress is not None:
+                    on_progress(event, value)
+
+            doc.setProgressCallBack(callback)
+            doc.multiBuild(rml_document.flowables, maxPasses=2,
+                           canvasmaker=rml_document.canvasClass)
+            for _name, processor in rml_document.postProcessors:
+                temp_output.seek(0)
+                temp_output = processor.process(temp_output)
+    finally:
+        rml_document.outputFile = rml_document.doc = rml_document.flowables = None
+        rml_document.postProcessors = post_processors
+    if isinstance(output_file, str):
+        with open(output_file, 'wb') as f:
+            f.write(temp_output.getvalue())
+    else:
+        output_file.write(temp_output.getvalue())
 
-    column_headers = ['Student', 'Class', 'Instructor', 'Fee']
-    students_rml = generate_table_row_rml(column_headers)
-    num_classes = 0
+
+def create_invoice_tables(invoice):
+    """Return the rows of the parents, students and payables tables of an invoice object."""
+    parents = list(invoice['parent'])
+
+    students = [['Student', 'Class', 'Instructor', 'Fee']]
     for student_name, classes in invoice['students'].items():
         for class_entry in classes:
-            students_rml += generate_table_row_rml([student_name]
-                                                   + class_entry[:-1]
-                                                   + ['$' + str(class_entry[-1])])
+            students.append([student_name] + class_entry[:-1] + ['$' + format_cents(class_entry[-1])])
             student_name = ''  # Only print student on first row
-            num_classes += 1
-    students_rml += generate_table_row_rml(['Total',
-                                            '',
-                                            '',
-                                            '$' + str(invoice['total'])])
+    students.append(['Total', '', '', '$' + format_cents(invoice['total'])])
+
+    payables = [[teacher, '$' + format_cents(fee)]
+                for teacher, fee in sorted(invoice['payable'].items()) if fee]
+    return parents, students, payables
+
 
-    payables_rml = ''
-    for teacher, fee in sorted(invoice['payable'].items()):
-        if fee:
-            payables_rml += generate_table_row_rml([teacher, '$' + str(fee)])
+def get_invoice_outline_entry(invoice):
+    """Return the key and title of the outline entry (bookmark) of an invoice, which starts
+    its page(s), for finding the invoice of each family in a PDF of many (see pdf.slicing)."""
+    return f'invoice-{invoice["family_id"]}', f'{invoice["last_name"]} ({invoice["family_id"]})'
+
+
+def generate_invoice_page_rml(invoice, rml_file):
+    key, title = get_invoice_outline_entry(invoice)
+    rml_file.write(RML_OUTLINE_TEMPLATE.format(key=escape(key, {'"': '&quot;'}), title=escape(title)))
+    parents, students, payables = create_invoice_tables(invoice)
+    tables_rml = []
+    for rows in (parents, students, payables):
+        fragments = []
+        for row in rows:
+            write_table_row_rml(row, fragments.append)
+        tables_rml.append(''.join(fragments))
+    parents_rml, students_rml, payables_rml = tables_rml
 
     rml = RML_INVOICE_TEMPLATE.format(parents=parents_rml,
                                       students=students_rml,
                                       payables=payables_rml,
                                       note=invoice['note'],
-                                      num_classes=num_classes + 1,
+                                      num_classes=len(students) - 1,
                                       filename='invoice.pdf')
     rml_file.write(rml)
 
@@ -333,14 +560,20 @@ def generate_invoice_page_rml(invoice, rml_file):
 
 
 def generate_table_row_rml(elements, style=None):
-    style_open = ''
-    style_close = ''
-    if style is not None:
-        style_open = f'<para style="{style}">'
-        style_close = '</para>'
-
-    row = '<tr>\n'
-    for elt in elements:
-        row += f'<td>{style_open}{elt}{style_close}</td>\n'
-    row += '</tr>\n'
-    return row
+    fragments = []
+    write_table_row_rml(elements, fragments.append, style)
+    return ''.join(fragments)
+
+
+def write_table_row_rml(elements, write, style=None):
+    """Write the RML of a table row by calling write, e.g. the append method of a list of
+    fragments to join once the whole table is written, or the write method of a file.
+    Building tables this way takes time linear in their size, unlike adding up strings."""
+    write('<tr>\n')
+    if style is None:
+        for elt in elements:
+            write(f'<td>{elt}</td>\n')
+    else:
+        for elt in elements:
+            write(f'<td><para style="{style}">{elt}</para></td>\n')
+    write('</tr>\n')
@@ -0,0 +1,146 @@
+import datetime
+import functools
+import io
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from pdf.backend import get_backend, get_backend_name
+from pdf.generate import create_invoice_objects
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+# Fewer families than this are rendered faster in one process than by starting worker processes
+PARALLEL_RENDER_MIN_FAMILIES = 200
+
+# Number of shards to split the families into per worker, to even out the work between
+# workers and update the progress more often
+SHARDS_PER_WORKER = 4
+
+# How often, in seconds, to update the progress while waiting for shards
+PROGRESS_INTERVAL = 0.1
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+def render_invoice_shard(invoices, term, path):
+    """Render a list of invoice objects to a PDF file at path."""
+    get_backend().generate_invoices_pdf(invoices, term, path)
+
+
+@functools.lru_cache(maxsize=1)
+def get_worker_renderer(backend_name, term, date):
+    """Return the InvoiceRenderer of a worker for the backend and term, kept for its next
+    tasks. date is that of the invoices, so a renderer is not reused after midnight."""
+    return get_backend(backend_name).InvoiceRenderer(term)
+
+
+def render_invoice_pdfs(invoices, term):
+    """Render a list of invoice objects to one PDF each, in a worker process or thread,
+    with a warm InvoiceRenderer. Returns the PDF data of each."""
+    renderer = get_worker_renderer(get_backend_name(), term, datetime.date.today())
+    pdfs = []
+    for invoice in invoices:
+        pdf = io.BytesIO()
+        renderer.render(invoice, pdf)
+        pdfs.append(pdf.getvalue())
+    return pdfs
+
+
+def split_shards(items, num_shards):
+    """Split a list into up to num_shards contiguous lists of nearly equal length."""
+    num_shards = max(1, min(num_shards, len(items)))
+    return [items[len(items) * n // num_shards:len(items) * (n + 1) // num_shards]
+            for n in range(num_shards)]
+
+
+def merge_pdfs(paths, output_file):
+    """Concatenate the PDF files at paths, reading one at a time, and write the result to
+    output_file, which is a path or a binary file object. The outlines of the documents are
+    concatenated too, since insert_pdf() drops them, and pdf.slicing finds the invoices by
+    their outline."""
+    merged = pymupdf.open()
+    toc = []
+    for path in paths:
+        with pymupdf.open(path) as document:
+            offset = merged.page_count
+            toc.extend([level, title, page + offset]
+                       for level, title, page in document.get_toc(simple=True))
+            merged.insert_pdf(document)
+    merged.set_toc(toc)
+    if isinstance(output_file, str):
+        merged.save(output_file, deflate=True)
+    else:
+        output_file.write(merged.tobytes(deflate=True))
+    merged.close()
+
+
+def generate_invoices_parallel(progress, families, class_map, note, term, output_file,
+                               max_workers=None, invoices=None):
+    """Same as generate_invoices(), but render shards of the families in several worker
+    processes, and then merge their PDFs in family order. The progress is updated as each
+    shard finishes. If cancelled, the invoices of the shards finished before the first
+    unfinished one are still written. max_workers defaults to the number of CPUs. If given,
+    invoices are the families' invoice objects from create_invoice_objects().
+
+    Falls back to generate_invoices() for few families, one worker, or without PyMuPDF."""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if invoices is None:
+        invoices = create_invoice_objects(families, class_map, note)
+    invoiced = list(invoices.values())
+    if pymupdf is None or max_workers <= 1 or len(invoiced) < PARALLEL_RENDER_MIN_FAMILIES:
+        get_backend().generate_invoices(progress, families, class_map, note, term, output_file,
+                                        invoices)
+        return
+    shards = split_shards(invoiced, max_workers * SHARDS_PER_WORKER)
+    logger.debug(f'rendering {len(invoiced)} invoices in {len(shards)} shards'
+                 f' with {max_workers} workers')
+    progress.Update(0, newmsg='Please wait...\n\n'
+                              f'Generating invoices in {len(shards)} parts')
+    # Shards are written to files, so that only the merged document is held in memory
+    shard_dir = tempfile.mkdtemp(prefix='ClassInvoices-shards-')
+    paths = [os.path.join(shard_dir, f'shard-{n}.pdf') for n in range(len(shards))]
+    rendered = [False] * len(shards)
+    try:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        try:
+            futures = {executor.submit(render_invoice_shard, shard, term, path): n
+                       for n, (shard, path) in enumerate(zip(shards, paths))}
+            pending = set(futures)
+            num_rendered = 0
+            while pending:
+                if progress.WasCancelled():
+                    break
+                done, pending = wait(pending, timeout=PROGRESS_INTERVAL,
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    n = futures[future]
+                    future.result()
+                    rendered[n] = True
+                    num_rendered += len(shards[n])
+                    logger.debug(f'rendered shard {n + 1} of {len(shards)}')
+                # Progress counts families, to use the same range as generate_invoices()
+                progress.Update(min(num_rendered, len(families) - 1),
+                                newmsg='Please wait...\n\n'
+                                       f'Generated {len(shards) - len(pending)} of'
+                                       f' {len(shards)} parts ({num_rendered} invoices)')
+        finally:
+            # If cancelled or failed, don't wait for the shards being rendered, whose files
+            # are removed with the directory
+            executor.shutdown(wait=False, cancel_futures=True)
+        if False in rendered:
+            paths = paths[:rendered.index(False)]
+        if paths:
+            merge_pdfs(paths, output_file)
+        else:
+            # Cancelled before any shard finished: the same empty document generate_invoices()
+            # writes
+            get_backend().generate_invoices_pdf([], term, output_file)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
@@ -0,0 +1,224 @@
+import datetime
+import logging
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import landscape, letter, portrait
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.platypus import (BaseDocTemplate, Frame, KeepTogether, PageBreak, PageTemplate,
+                                Paragraph, Table, TableStyle)
+from reportlab.platypus.flowables import Flowable, HRFlowable
+
+from model.family import get_students
+from pdf.generate import (RenderCancelled, create_invoice_object, create_invoice_objects,
+                          create_invoice_tables, create_master_entry, get_invoice_outline_entry,
+                          make_layout_progress)
+
+# The same layouts as the RML templates and stylesheet of pdf.generate, built directly as
+# ReportLab flowables, which skips writing RML text and having z3c.rml parse it.
+
+# Page templates: page size, (x, y) of the title and date lines, x of the footer, frame
+PAGE_TEMPLATES = {
+    'portrait': (portrait(letter), (35, 760), (35, 740), 35, (35, 45, 525, 675)),
+    'landscape': (landscape(letter), (45, 576), (45, 556), 35, (45, 35, 705, 495)),
+}
+
+PARAGRAPH_STYLES = {
+    name: ParagraphStyle(name, parent=getSampleStyleSheet()['Normal'], **attributes)
+    for name, attributes in {
+        'title': dict(fontName='Times-Bold', fontSize=14, leading=12, spaceBefore=10, spaceAfter=10),
+        'header': dict(fontName='Times-Roman', fontSize=14, leading=12, spaceBefore=12, spaceAfter=12),
+        'normal': dict(fontName='Times-Roman', fontSize=10, leading=12),
+        'bold': dict(fontName='Times-Bold', fontSize=10, leading=12),
+        'medium': dict(fontName='Times-Roman', fontSize=10, leading=12, spaceBefore=10),
+        'small': dict(fontName='Times-Roman', fontSize=8, leading=12),
+    }.items()
+}
+
+TABLE_PADDING = [
+    ('TOPPADDING', (0, 0), (-1, -1), 0),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+]
+
+TABLE_STYLES = {
+    'studentsMaster': TableStyle([
+        ('FONT', (0, 0), (-1, 0), 'Times-Roman', 8),
+        ('FONT', (0, 1), (-1, -1), 'Times-Roman', 10),
+        ('FONT', (0, -1), (-1, -1), 'Times-Bold', 10),
+        ('LINEBEFORE', (1, 0), (-1, -1), 1, colors.black),
+        ('LINEBELOW', (0, 0), (-1, -2), 1, colors.black),
+        ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
+        ('ALIGN', (1, 1), (-1, -1), 'RIGHT'),
+    ] + TABLE_PADDING),
+    'studentsInvoice': TableStyle([
+        ('FONT', (0, 0), (-1, 0), 'Times-Bold', 10),
+        ('FONT', (0, 1), (-1, -1), 'Times-Roman', 10),
+        ('FONT', (0, -1), (-1, -1), 'Times-Bold', 10),
+        ('LINEBELOW', (0, 0), (-1, 0), 1, colors.black),
+        ('LINEABOVE', (0, -1), (-1, -1), 1, colors.black),
+        ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+    ] + TABLE_PADDING),
+    'payables': TableStyle([
+        ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+        ('FONT', (0, 0), (-1, -1), 'Times-Roman', 10),
+    ] + TABLE_PADDING),
+    'basic': TableStyle([
+        ('FONT', (0, 0), (-1, -1), 'Times-Roman', 10),
+    ] + TABLE_PADDING),
+}
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+class OutlineEntry(Flowable):
+    """Adds an outline entry (bookmark) for the page it is on, like the outlineAdd of RML."""
+
+    def __init__(self, key, title):
+        super().__init__()
+        self.key = key
+        self.title = title
+
+    def wrap(self, *args):
+        return 0, 0
+
+    def draw(self):
+        self.canv.bookmarkPage(self.key)
+        self.canv.addOutlineEntry(title=self.title, key=self.key)
+
+
+def make_table(rows, style):
+    """Return a left aligned table of rows, or None if there are no rows."""
+    if not rows:
+        return None
+    return Table([[str(cell) for cell in row] for row in rows],
+                 style=TABLE_STYLES[style], hAlign='LEFT')
+
+
+def make_page_template(title, term, footer='', orientation='portrait'):
+    """Return the page template of documents with the given title, the term and date, and
+    a footer in which '{page}' is replaced by the page number, and its page size."""
+    page_size, title_pos, date_pos, footer_x, frame = PAGE_TEMPLATES[orientation]
+    if term:
+        title += f' ({term})'
+    date = datetime.datetime.now().strftime('%a %b %d, %Y')
+
+    def draw_page(canvas, doc):
+        canvas.saveState()
+        canvas.setFont('Times-Roman', 24)
+        canvas.drawString(*title_pos, title)
+        canvas.setFont('Times-Roman', 12)
+        canvas.drawString(*date_pos, f'Generated on {date}')
+        canvas.drawString(footer_x, 30, footer.format(page=canvas.getPageNumber()))
+        canvas.restoreState()
+
+    # RML frames have no padding
+    frame = Frame(*frame, leftPadding=0, bottomPadding=0, rightPadding=0, topPadding=0)
+    return PageTemplate(id='main', frames=[frame], onPage=draw_page), page_size
+
+
+def build_document(output_file, story, page_template, page_size, on_progress=None):
+    """Render story to output_file, a path or binary file. If given, on_progress is called
+    with ReportLab's progress events."""
+    doc = BaseDocTemplate(output_file, pagesize=page_size, invariant=1)
+    doc.addPageTemplates([page_template])
+    if on_progress is not None:
+        doc.setProgressCallBack(on_progress)
+    doc.build(story)
+
+
+def master_family_flowables(family, class_map, teacher_totals=None):
+    last_names, parents, rows = create_master_entry(family, class_map, teacher_totals)
+    header = Paragraph(f'<b>{escape(last_names)}</b>, <font size="10">{escape(parents)}</font>',
+                       PARAGRAPH_STYLES['header'])
+    return [KeepTogether([header, make_table(rows, 'studentsMaster')])]
+
+
+def generate_master(families, class_map, term, output_file, index=None, progress=None):
+    """Same as pdf.generate.generate_master()."""
+    story = []
+    for n, family in enumerate(families.values()):
+        if progress is not None:
+            if progress.WasCancelled():
+                return False
+            progress.Update(n, newmsg='Please wait...\n\n'
+                                      f'Listing family: {family["last_name"]}')
+        if get_students(family):
+            teacher_totals = None
+            if index is not None:
+                teacher_totals = index.teacher_totals(family['id'])
+            story.extend(master_family_flowables(family, class_map, teacher_totals))
+    on_progress = None
+    if progress is not None:
+        on_progress = make_layout_progress(progress, len(families), 'Laying out families on pages')
+    page_template, page_size = make_page_template(title='Class Enrollment Master List',
+                                                  term=term,
+                                                  footer='Page {page}')
+    try:
+        build_document(output_file, story, page_template, page_size, on_progress)
+    except RenderCancelled:
+        return False
+    return True
+
+
+def invoice_page_flowables(invoice):
+    parents, students, payables = create_invoice_tables(invoice)
+    flowables = [OutlineEntry(*get_invoice_outline_entry(invoice))]
+    for title, rows, style in (('Parents', parents, 'basic'),
+                               ('Students', students, 'studentsInvoice'),
+                               ('Make checks payable to:', payables, 'payables')):
+        flowables.append(Paragraph(escape(title), PARAGRAPH_STYLES['title']))
+        table = make_table(rows, style)
+        if table is not None:
+            flowables.append(table)
+    flowables.append(HRFlowable(width='80%', thickness=1, color=colors.black,
+                                spaceBefore=10, spaceAfter=5, hAlign='LEFT'))
+    for line in invoice['note'].split('\n'):
+        flowables.append(Paragraph(line, PARAGRAPH_STYLES['medium']))
+    flowables.append(PageBreak())
+    return flowables
+
+
+def generate_invoices_pdf(invoices, term, output_file):
+    """Same as pdf.generate.generate_invoices_pdf()."""
+    story = []
+    for invoice in invoices:
+        story.extend(invoice_page_flowables(invoice))
+    build_document(output_file, story, *make_page_template(title='Class Enrollment Invoice',
+                                                           term=term))
+
+
+class InvoiceRenderer:
+    """Same as pdf.generate.InvoiceRenderer: renders invoice objects one at a time, with
+    the page template made only once."""
+
+    def __init__(self, term):
+        self.page_template, self.page_size = make_page_template(title='Class Enrollment Invoice',
+                                                                term=term)
+
+    def render(self, invoice, output_file):
+        build_document(output_file, invoice_page_flowables(invoice),
+                       self.page_template, self.page_size)
+
+
+def generate_invoice_pdf(invoice, term, output_file):
+    generate_invoices_pdf([invoice], term, output_file)
+
+
+def generate_one_invoice(family, class_map, note, term, output_file):
+    generate_invoice_pdf(create_invoice_object(family, class_map, note), term, output_file)
+
+
+def generate_invoices(progress, families, class_map, note, term, output_file, invoices=None):
+    """Same as pdf.generate.generate_invoices()."""
+    if invoices is None:
+        invoices = create_invoice_objects(families, class_map, note)
+    rendered = []
+    for n, family in enumerate(families.values()):
+        if progress.WasCancelled():
+            break
+        msg = "Please wait...\n\n" \
+              f"Generating invoice for family: {family['last_name']}"
+        progress.Update(n, newmsg=msg)
+        if family['id'] in invoices:
+            rendered.append(invoices[family['id']])
+    generate_invoices_pdf(rendered, term, output_file)
@@ -0,0 +1,70 @@
+import logging
+import threading
+
+from pdf.cache import invoice_key
+from pdf.generate import get_invoice_outline_entry
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+logger = logging.getLogger(f'classinvoices.{__name__}')
+
+
+class InvoicePages:
+    """The pages of each family's invoice in a PDF of many invoices rendered by
+    generate_invoices() or generate_invoices_parallel(), to copy out the invoice of a family
+    instead of rendering it again, e.g. to email the invoices after previewing them.
+
+    Every invoice starts with an outline entry (see get_invoice_outline_entry()), in the
+    order of the invoice objects from create_invoice_objects() that were rendered, so the
+    n-th outline entry starts the n-th invoice, and it ends before the next one. If
+    rendering was cancelled, only the families before that have pages. The invoice_key() of
+    each family's invoice is kept, so that pages are only used for the same invoice, from the
+    same fees, note and term."""
+
+    def __init__(self, path, invoices, term):
+        self.path = path
+        self.document = pymupdf.open(path)
+        self.lock = threading.Lock()
+        outline = [(title, page - 1) for level, title, page in self.document.get_toc()
+                   if level == 1]
+        ends = [start - 1 for _title, start in outline[1:]] + [self.document.page_count - 1]
+        # Family id -> (invoice_key(), first page, last page)
+        self.pages = {}
+        for invoice, (title, start), end in zip(invoices.values(), outline, ends):
+            if title != get_invoice_outline_entry(invoice)[1]:
+                logger.warning(f'{path} does not have the invoices of the families')
+                break
+            self.pages[invoice['family_id']] = (invoice_key(invoice, term), start, end)
+
+    def get_pdf(self, family_id, key):
+        """Return the PDF data of the pages of the family's invoice, as a document of its own,
+        or None if the PDF doesn't have the invoice with the given invoice_key()."""
+        try:
+            page_key, start, end = self.pages[family_id]
+        except KeyError:
+            return None
+        if page_key != key:
+            return None
+        with self.lock:
+            with pymupdf.open() as invoice_document:
+                invoice_document.insert_pdf(self.document, from_page=start, to_page=end)
+                return invoice_document.tobytes(deflate=True, garbage=3)
+
+    def close(self):
+        self.document.close()
+
+
+def read_invoice_pages(path, invoices, term):
+    """Return the InvoicePages of an invoices PDF rendered from the invoice objects, or None
+    without PyMuPDF or if the file can't be read."""
+    if pymupdf is None:
+        return None
+    try:
+        return InvoicePages(path, invoices, term)
+    except (RuntimeError, OSError, ValueError):
+        # PyMuPDF raises subclasses of RuntimeError for unreadable files
+        logger.exception(f'Cannot read the invoice pages of {path}')
+        return None
@@ -0,0 +1,135 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip('wx')
+httplib2 = pytest.importorskip('httplib2')
+pytest.importorskip('googleapiclient')
+
+from googleapiclient.errors import HttpError  # noqa: E402
+
+from mail import gmail  # noqa: E402
+from mail.rate_limit import TokenBucket  # noqa: E402
+
+
+def make_http_error(status, reason):
+    content = json.dumps({'error': {'code': status, 'message': reason,
+                                    'errors': [{'reason': reason}]}})
+    return HttpError(httplib2.Response({'status': status}), content.encode())
+
+
+class FakeBatch:
+    """Stand-in for a googleapiclient BatchHttpRequest, calling back with the outcome the
+    FakeService has next for each call."""
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.calls = []
+
+    def add(self, request, request_id):
+        self.calls.append((request, request_id))
+
+    def execute(self):
+        self.service.batch_sizes.append(len(self.calls))
+        if self.service.batch_errors:
+            raise self.service.batch_errors.pop(0)
+        for request, request_id in self.calls:
+            outcomes = self.service.outcomes.get(request)
+            outcome = outcomes.pop(0) if outcomes else {'id': f'result-{request}'}
+            if isinstance(outcome, Exception):
+                self.callback(request_id, None, outcome)
+            else:
+                self.callback(request_id, outcome, None)
+
+
+class FakeService:
+    """Stand-in for a Gmail service. Requests are names, and outcomes maps a name to the
+    results or exceptions of its calls in turn, after which calls succeed."""
+
+    def __init__(self, outcomes=None, batch_errors=None):
+        self.outcomes = outcomes or {}
+        self.batch_errors = batch_errors or []
+        self.batch_sizes = []
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+def no_quota():
+    return TokenBucket(1e9, 1e9)
+
+
+def no_wait(waits):
+    def wait(seconds):
+        waits.append(seconds)
+        return True
+    return wait
+
+
+def test_results_map_to_calls_in_batches_of_the_api_limit():
+    requests = [f'call-{n}' for n in range(120)]
+    service = FakeService()
+    results = gmail.execute_batches(service, requests, no_quota(),
+                                    gmail.DRAFTS_SEND_QUOTA_UNITS)
+    assert results == [{'id': f'result-{request}'} for request in requests]
+    assert service.batch_sizes == [gmail.GMAIL_BATCH_SIZE, gmail.GMAIL_BATCH_SIZE, 20]
+
+
+def test_rate_limited_calls_are_retried():
+    requests = ['ok', 'limited', 'server-error', 'bad']
+    bad = make_http_error(400, 'invalidArgument')
+    service = FakeService({
+        'limited': [make_http_error(403, 'userRateLimitExceeded')],
+        'server-error': [make_http_error(503, 'backendError'),
+                         make_http_error(503, 'backendError')],
+        'bad': [bad],
+    })
+    waits = []
+    results = gmail.execute_batches(service, requests, no_quota(), gmail.DRAFTS_SEND_QUOTA_UNITS,
+                                    no_wait(waits))
+    assert results[:3] == [{'id': 'result-ok'}, {'id': 'result-limited'},
+                           {'id': 'result-server-error'}]
+    assert results[3] is bad
+    assert service.batch_sizes == [4, 2, 1]
+    assert waits == [gmail.BATCH_RETRY_DELAY, 2 * gmail.BATCH_RETRY_DELAY]
+
+
+def test_failed_batches_are_reported_per_call():
+    requests = [f'call-{n}' for n in range(gmail.GMAIL_BATCH_SIZE + 1)]
+    failure = RuntimeError('cannot refresh the access token')
+    service = FakeService(batch_errors=[failure])
+    results = gmail.execute_batches(service, requests, no_quota(),
+                                    gmail.DRAFTS_SEND_QUOTA_UNITS, no_wait([]))
+    assert results[:-1] == [failure] * gmail.GMAIL_BATCH_SIZE
+    assert results[-1] == {'id': f'result-{requests[-1]}'}
+    assert gmail.get_error_reason(failure) == 'cannot refresh the access token'
+
+
+def test_network_errors_are_retried():
+    service = FakeService(batch_errors=[ConnectionResetError()])
+    results = gmail.execute_batches(service, ['call'], no_quota(),
+                                    gmail.DRAFTS_SEND_QUOTA_UNITS, no_wait([]))
+    assert results == [{'id': 'result-call'}]
+    assert service.batch_sizes == [1, 1]
+
+
+def test_quota_paces_calls():
+    # A second's worth of units to start with, then one call per 0.1 s
+    quota = TokenBucket(1000, 100)
+    service = FakeService()
+    start = time.monotonic()
+    results = gmail.execute_batches(service, [f'call-{n}' for n in range(6)], quota, 100)
+    assert time.monotonic() - start >= 0.45
+    assert len(results) == 6 and None not in results
+    assert service.batch_sizes == [6]
+
+
+def test_cancelling_stops_calls():
+    quota = TokenBucket(100, 200)
+    service = FakeService()
+    results = gmail.execute_batches(service, ['first', 'second', 'third'], quota, 100,
+                                    wait=lambda seconds: False)
+    assert results == [{'id': 'result-first'}, {'id': 'result-second'}, None]
+    assert service.batch_sizes == [2]
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+pytest.importorskip('wx')
+pytest.importorskip('googleapiclient')
+
+from benchmarks.bench_gmail_send import Progress  # noqa: E402
+from benchmarks.fake_gmail_server import FakeGmailServer  # noqa: E402
+from benchmarks.synthetic import write_registration_csv  # noqa: E402
+from mail import gmail  # noqa: E402
+from model.columns import Column  # noqa: E402
+from model.family import get_classes, load_families  # noqa: E402
+
+NOTE = 'Thank you!'
+
+
+@pytest.fixture(scope='module')
+def enrollment(tmp_path_factory):
+    csv_path = os.path.join(tmp_path_factory.mktemp('enrollment'), 'registrations.csv')
+    write_registration_csv(csv_path, 30)
+    families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+    return families, class_map
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with FakeGmailServer(latency=0.05) as server:
+        monkeypatch.setattr(gmail, 'get_invoice_cache', lambda: None)
+        monkeypatch.setattr(gmail, 'get_gmail_credentials', lambda: None)
+        monkeypatch.setattr(gmail, 'build_gmail_service',
+                            lambda credentials: server.build_service())
+        monkeypatch.setattr(gmail, 'BATCH_RETRY_DELAY', 0.01)
+        yield server
+
+
+def send(families, class_map, max_workers=gmail.GMAIL_WORKERS):
+    errors = []
+    gmail.send_emails('Invoice', 'Please find your invoice attached.', 'bcc', families,
+                      class_map, NOTE, 'Fall', Progress(), errors=errors,
+                      max_workers=max_workers)
+    return errors
+
+
+def get_num_emails(families, class_map):
+    return len(gmail.get_invoice_jobs(families, class_map, NOTE, []))
+
+
+def test_sends_with_several_threads(enrollment, server, monkeypatch):
+    families, class_map = enrollment
+    monkeypatch.setattr(gmail, 'GMAIL_QUOTA_UNITS_PER_SECOND', 1e9)
+    errors = send(families, class_map, max_workers=4)
+    assert len(server.sent) == get_num_emails(families, class_map)
+    assert all('has no parents with email' in error for error in errors)
+    assert server.max_active > 1
+
+
+def test_sends_within_the_quota(enrollment, server):
+    families, class_map = enrollment
+    families = dict(list(families.items())[:8])
+    send(families, class_map)
+    num_emails = get_num_emails(families, class_map)
+    assert len(server.sent) == num_emails >= 4
+    # The quota allows a second's worth of units at once, and then its rate
+    units_per_second = gmail.GMAIL_QUOTA_UNITS_PER_SECOND
+    sends_per_second = units_per_second / gmail.MESSAGES_SEND_QUOTA_UNITS
+    times = server.send_times
+    assert times[-1] - times[0] >= (num_emails - 2 * sends_per_second) / sends_per_second
+    assert max(sum(1 for t in times if start <= t < start + 1)
+               for start in times) <= 2 * sends_per_second
+
+
+def test_reports_failures_per_family(enrollment, server, monkeypatch):
+    families, class_map = enrollment
+    monkeypatch.setattr(gmail, 'GMAIL_QUOTA_UNITS_PER_SECOND', 1e9)
+    server.fail_every = 4
+    jobs = gmail.get_invoice_jobs(families, class_map, NOTE, [])
+    rejected = [family for family, _invoice in jobs[3:5]]
+    server.reject = {parent[Column.EMAIL] for family in rejected for parent in family['parents']}
+    errors = send(families, class_map)
+    assert len(server.sent) == len(jobs) - len(rejected)
+    assert server.failed
+    send_errors = [error for error in errors if 'has no parents with email' not in error]
+    assert sorted(send_errors) == sorted(
+        f'Could not send email to family {family["last_name"]}: Invalid To header'
+        for family in rejected)
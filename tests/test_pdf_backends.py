@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+pymupdf = pytest.importorskip('pymupdf')
+
+from benchmarks.compare_backends import page_differences, render  # noqa: E402
+from benchmarks.synthetic import write_registration_csv  # noqa: E402
+from model.family import get_classes, load_families  # noqa: E402
+from pdf.backend import PLATYPUS_BACKEND, RML_BACKEND, get_backend  # noqa: E402
+
+NUM_FAMILIES = 40
+
+# Most pixels of a page that may differ between the backends, for antialiasing and kerning
+MAX_DIFFERING_PIXELS = 0.01
+
+
+@pytest.fixture(scope='module')
+def enrollment(tmp_path_factory):
+    csv_path = os.path.join(tmp_path_factory.mktemp('enrollment'), 'registrations.csv')
+    write_registration_csv(csv_path, NUM_FAMILIES)
+    families = load_families(csv_path)
+    class_map = {class_name: (f'Teacher {n % 7} Name', (10 + n % 40) * 100)
+                 for n, class_name in enumerate(sorted(get_classes(families)))}
+    return families, class_map
+
+
+@pytest.mark.parametrize('kind', ['invoices', 'master'])
+def test_backends_look_the_same(enrollment, kind):
+    families, class_map = enrollment
+    note = 'Please pay by the first class.\nThank you!'
+    rml_pdf, _elapsed = render(get_backend(RML_BACKEND), kind, families, class_map, note, 'Fall')
+    platypus_pdf, _elapsed = render(get_backend(PLATYPUS_BACKEND), kind, families, class_map,
+                                    note, 'Fall')
+    differences = page_differences(rml_pdf, platypus_pdf)
+    assert differences
+    assert max(differences) <= MAX_DIFFERING_PIXELS
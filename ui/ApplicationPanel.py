@@ -62,6 +62,9 @@ class ApplicationPanel(wx.Panel):
         self.enrollment_panel.clear_is_modified()
         self.fee_schedule_panel.clear_is_modified()
 
+    def take_family_changes(self):
+        return self.enrollment_panel.take_family_changes()
+
     def close_sub_window(self):
         return self.enrollment_panel.close_sub_window()
 
@@ -90,8 +93,11 @@ class ApplicationPanel(wx.Panel):
         return position
 
     def on_enrollment_change(self, event=None):
-        self.fee_schedule_panel.populate_fee_schedule(
-            self.enrollment_panel.get_families())
+        if event is None:
+            families = self.enrollment_panel.get_families()
+        else:
+            families = event.families
+        self.fee_schedule_panel.populate_fee_schedule(families)
         self.enable_buttons()
 
     def enable_buttons(self):
@@ -106,17 +112,26 @@ class ApplicationPanel(wx.Panel):
         }
 
     def load_data(self, data):
+        for _step in self.load_data_steps(data):
+            pass
+
+    def load_data_steps(self, data):
+        """Same as load_data(), but a generator that loads one part of data each time it is
+        advanced, yielding the name of the part it loaded, so the UI stays responsive."""
         if 'sash_proportion' in data:
             self.sash_proportion = data['sash_proportion']
         else:
             self.sash_proportion = DEFAULT_SASH_PROPORTION
         self.on_resize()
-        if 'enrollment' in data:
-            self.enrollment_panel.load_data(data['enrollment'])
-        else:
-            self.enrollment_panel.load_data({})
+        # The fee schedule goes first: classes of the enrollment missing from it are added
+        # once the enrollment is loaded
         if 'fee_schedule' in data:
             self.fee_schedule_panel.load_data(data['fee_schedule'])
         else:
             self.fee_schedule_panel.load_data([])
+        yield 'fee schedule'
+        if 'enrollment' in data:
+            yield from self.enrollment_panel.load_data_steps(data['enrollment'])
+        else:
+            yield from self.enrollment_panel.load_data_steps({})
         self.Refresh()
@@ -1,17 +1,24 @@
 import logging
 import os
 import tempfile
+import time
 
 import wx
 import wx.lib.newevent
 
-from model.family import load_families, export_families
+from model.changes import FamilyChanges, apply_changes, diff_families, hash_families, merge_changes
+from model.enrollment_index import EnrollmentIndex
+from model.family import export_families, get_family_summary, iter_families
+from model.parallel_ingest import PARALLEL_LOAD_MIN_BYTES, load_families_parallel
 from ui.EmailSetupPanel import EmailSetupPanel
 from ui.FamilyListFrame import FamilyListFrame
 from ui.PdfPanel import PdfPanel
 
 DEFAULT_BORDER = 5
 
+# How often, in seconds, to let the UI handle events while reading an enrollment file
+LOAD_REFRESH_INTERVAL = 0.1
+
 logger = logging.getLogger(f'classinvoices.{__name__}')
 
 
@@ -46,6 +53,10 @@ class EnrollmentPanel(wx.Panel):
         self.SetMinSize((500, 400))
 
         self.families = {}
+        self.enrollment_index = None
+        self.family_hashes = None  # Content hash of each family, for re-importing
+        # Family changes not yet recorded in the document journal; None if all families were replaced
+        self.family_changes = FamilyChanges({}, {}, {})
         self.class_map = {}
         self.modified = False
         self.error_msg = None
@@ -108,6 +119,19 @@ class EnrollmentPanel(wx.Panel):
     def get_families(self):
         return self.families
 
+    def take_family_changes(self):
+        """Return the FamilyChanges since the last call, or None if the families were
+        replaced entirely since then, as by loading a new enrollment file."""
+        changes = self.family_changes
+        self.family_changes = FamilyChanges({}, {}, {})
+        return changes
+
+    def get_enrollment_index(self):
+        """Return the EnrollmentIndex of the current families, building it if needed."""
+        if self.enrollment_index is None:
+            self.enrollment_index = EnrollmentIndex(self.families)
+        return self.enrollment_index
+
     def on_load(self, _event=None):
         """Load a new class enrollment CSV file."""
         dirname = ''
@@ -122,15 +146,33 @@ class EnrollmentPanel(wx.Panel):
             dirname = file_dialog.GetDirectory()
             path = os.path.join(dirname, filename)
             try:
-                self.load_enrollment_data(path)
-                self.pdf_tab_panel.populate_family_list()
-                self.modified = True
+                response = self.ask_reimport() if self.families else wx.ID_NO
+                if response == wx.ID_YES:
+                    if self.reimport_enrollment_data(path):
+                        self.modified = True
+                elif response == wx.ID_NO:
+                    self.load_enrollment_data(path)
+                    self.modified = True
             except Exception as e:
                 self.error_msg = f'Error while loading enrollment file: {e}'
                 logger.exception(self.error_msg)
         file_dialog.Destroy()
         self.check_error()
 
+    def ask_reimport(self):
+        """Ask whether to update the loaded families from a new enrollment file, or replace
+        them with it. Returns wx.ID_YES to update, wx.ID_NO to replace, or wx.ID_CANCEL."""
+        msg = 'Do you wish to update the loaded families with the families added, removed' \
+              ' or changed in this file, or replace all of them with the families in it?'
+        dlg = wx.MessageDialog(parent=self,
+                               message=msg,
+                               caption='Load Enrollment File',
+                               style=wx.YES | wx.NO | wx.CANCEL | wx.YES_DEFAULT)
+        dlg.SetYesNoLabels('Update', 'Replace')
+        response = dlg.ShowModal()
+        dlg.Destroy()
+        return response
+
     def get_export_path(self):
         path = None
         suffix = '.csv'
@@ -159,9 +201,50 @@ class EnrollmentPanel(wx.Panel):
         self.check_error()
 
     def load_enrollment_data(self, path):
-        self.families = load_families(path)
+        """Read the enrollment CSV at path, replacing the current enrollment only once the
+        whole file is read, so that an error in the file leaves it as it was. Large files are
+        parsed by several processes at once; otherwise, the UI keeps handling events while
+        the file is read."""
+        if os.path.getsize(path) >= PARALLEL_LOAD_MIN_BYTES:
+            families = load_families_parallel(path)
+        else:
+            families = {}
+            self.button_load_enrollment.Disable()
+            try:
+                last_yield = time.monotonic()
+                for family in iter_families(path):
+                    families[family['id']] = family
+                    if time.monotonic() - last_yield > LOAD_REFRESH_INTERVAL:
+                        wx.YieldIfNeeded()
+                        last_yield = time.monotonic()
+            finally:
+                self.button_load_enrollment.Enable()
+        self.families = families
+        self.family_hashes = None
+        self.family_changes = None
+        self.enrollment_index = None
+        self.pdf_tab_panel.populate_family_list()
         self.refresh()
 
+    def reimport_enrollment_data(self, path):
+        """Read the enrollment CSV at path, and update only the families that were added,
+        removed or changed compared to the current enrollment. Returns the FamilyChanges."""
+        new_families = load_families_parallel(path)
+        if self.family_hashes is None:
+            self.family_hashes = hash_families(self.families)
+        changes = diff_families(self.families, new_families, self.family_hashes)
+        logger.info(f'Re-imported {path}: {len(changes.added)} families added,'
+                    f' {len(changes.removed)} removed, {len(changes.changed)} changed')
+        if changes:
+            apply_changes(self.families, changes, self.family_hashes)
+            if self.family_changes is not None:
+                self.family_changes = merge_changes(self.family_changes, changes)
+            if self.enrollment_index is not None:
+                self.enrollment_index.apply_changes(changes)
+            self.pdf_tab_panel.update_family_list(changes)
+            self.refresh(changes.updated(), changes=changes)
+        return changes
+
     def export_enrollment_data(self, path):
         try:
             export_families(path, self.families)
@@ -169,18 +252,24 @@ class EnrollmentPanel(wx.Panel):
             self.error_msg = f'Error while loading enrollment file: {e}'
             logger.exception(self.error_msg)
 
-    def refresh(self):
+    def refresh(self, families=None, changes=None):
+        """Update the stats and notify listeners that enrollment data has changed.
+        If given, families are the only families that were added or changed, and changes
+        is the FamilyChanges of a re-import."""
         self.set_stats()
-        event = self.EnrollmentDataEvent()
+        if families is None:
+            families = self.families
+        event = self.EnrollmentDataEvent(families=families, changes=changes)
         wx.PostEvent(self.GetEventHandler(), event)
 
     def set_stats(self):
         num_families = len(self.families)
         num_parents = 0
         num_students = 0
-        for family in self.families.values():
-            num_parents += len(family['parents'])
-            num_students += len(family['students'])
+        for family_id in self.families:
+            _name, family_parents, family_students = get_family_summary(self.families, family_id)
+            num_parents += family_parents
+            num_students += family_students
         self.label_num_families.SetLabelText(str(num_families))
         self.label_num_parents.SetLabelText(str(num_parents))
         self.label_num_students.SetLabelText(str(num_students))
@@ -231,15 +320,26 @@ class EnrollmentPanel(wx.Panel):
         }
 
     def load_data(self, data):
+        for _step in self.load_data_steps(data):
+            pass
+
+    def load_data_steps(self, data):
+        """Same as load_data(), but a generator loading one part at a time, like
+        ApplicationPanel.load_data_steps()."""
+        self.family_hashes = None
+        self.family_changes = FamilyChanges({}, {}, {})
+        self.enrollment_index = None
         if 'families' in data:
             self.families = data['families']
         else:
             self.families = {}
         self.refresh()
+        yield 'enrollment'
         if 'pdf_tab' in data:
             self.pdf_tab_panel.load_data(data['pdf_tab'])
         else:
             self.pdf_tab_panel.load_data({})
+        yield 'family list'
         if 'email_tab' in data:
             self.email_tab_panel.load_data(data['email_tab'])
         else:
@@ -248,3 +348,4 @@ class EnrollmentPanel(wx.Panel):
             self.action_tabs.SetSelection(data['selected_tab'])
         else:
             self.action_tabs.SetSelection(0)
+        yield 'email settings'
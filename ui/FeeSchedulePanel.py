@@ -9,6 +9,7 @@ import wx.lib.newevent
 from model.columns import Column
 from model.family import get_classes
 from model.fee_schedule import read_fee_schedule
+from model.money import is_cents, to_cents
 from ui.ListSorterPanel import ListSorterPanel
 
 DEFAULT_BORDER = 5
@@ -155,27 +156,37 @@ class FeeSchedulePanel(ListSorterPanel):
         self.Refresh()
 
     def generate_class_map(self):
-        """Create and return a map from class name to 2-tuple (teacher(str), fee(Decimal))."""
+        """Create and return a map from class name to 2-tuple (teacher(str), fee(int cents)).
+        Raise RuntimeError if a fee, which may have been edited, is not an amount of money."""
         class_map = {}
         for r in range(self.GetListCtrl().GetItemCount()):
             class_name = self.GetListCtrl().GetItem(r, 0).GetText().strip()
             teacher = self.GetListCtrl().GetItem(r, 1).GetText().strip()
             fee = self.GetListCtrl().GetItem(r, 2).GetText().strip()
-            class_map[class_name] = (teacher, Decimal(fee))
+            try:
+                class_map[class_name] = (teacher, to_cents(fee))
+            except ValueError as e:
+                raise RuntimeError(f'invalid fee for class {class_name}: {e}')
         return class_map
 
-    def validate_fee_schedule(self, families):
+    def validate_fee_schedule(self, families, index=None):
+        """Raise RuntimeError if any class of the given families lacks a teacher or fee.
+        If given, index is an EnrollmentIndex holding at least the given families."""
         class_map = self.generate_class_map()
-        missing_fees = set()  # Use a set to de-dup
-        for family in families.values():
-            for student in family['students']:
-                for class_name in student[Column.CLASSES]:
-                    try:
-                        teacher, fee = class_map[class_name]
-                        if (fee and not teacher) or not type(fee) == Decimal:
+        if index is not None:
+            index.update_class_map(class_map)
+            missing_fees = index.missing_fee_classes(families.keys())
+        else:
+            missing_fees = set()  # Use a set to de-dup
+            for family in families.values():
+                for student in family['students']:
+                    for class_name in student[Column.CLASSES]:
+                        try:
+                            teacher, fee = class_map[class_name]
+                            if (fee and not teacher) or not is_cents(fee):
+                                missing_fees.add(class_name)
+                        except KeyError:
                             missing_fees.add(class_name)
-                    except KeyError:
-                        missing_fees.add(class_name)
         if missing_fees:
             max_missing = 10
             if len(missing_fees) > max_missing:
@@ -1,5 +1,6 @@
 import logging
-import pickle
+import threading
+import time
 
 import wx
 
@@ -8,10 +9,15 @@ import ui.ApplicationPanel
 import ui.menu.EditMenu
 import ui.menu.FileMenu
 import ui.menu.HelpMenu
+from model.document import DOCUMENT_VERSION, write_document
+from model.journal import Journal, open_document
 
 SAVE_SUFFIX = '.classinvoice'
 
-SAVE_FORMAT_VERSION = 1.0
+SAVE_FORMAT_VERSION = DOCUMENT_VERSION
+
+# How often to record unsaved changes in the document journal, in milliseconds
+AUTOSAVE_INTERVAL = 60 * 1000
 
 logger = logging.getLogger(f'classinvoices.{__name__}')
 
@@ -21,14 +27,19 @@ class MainFrame(wx.Frame):
 
     DEFAULT_SIZE = (1080, 700)
 
-    def __init__(self, *args, **kwargs):
-        """Create the Frame."""
+    def __init__(self, *args, start_time=None, **kwargs):
+        """Create the Frame. start_time is the time.monotonic() the application started, for
+        logging how long it takes to show the window and the last document."""
         wx.Frame.__init__(self, *args, **kwargs)
+        self.start_time = time.monotonic() if start_time is None else start_time
 
         # Add the Widget Panel
         self.application_panel = ui.ApplicationPanel(self, wx.ID_ANY)
         self.SetBackgroundColour('white')
         self.saved_filename = None
+        self.journal = None  # Journal of the saved document, if any
+        self.load_count = 0  # Incremented for each document opened or created
+        self.loading_path = None  # Document being opened in the background, if any
 
         # Build the menu bar
         menu_bar = wx.MenuBar()
@@ -48,17 +59,28 @@ class MainFrame(wx.Frame):
 
         self.Bind(wx.EVT_CLOSE, self.on_close)
 
+        self.autosave_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_autosave, self.autosave_timer)
+        self.autosave_timer.Start(AUTOSAVE_INTERVAL)
+
         self.error_msg = None
         self.modified = False
         self.clear_is_modified()
 
+        self.Bind(wx.EVT_IDLE, self.on_first_idle)
         if self.file_menu.file_history.GetCount() > 0:
-            path = self.file_menu.file_history.GetHistoryFile(0)
-            try:
-                self.load_file(path)
-            except (OSError, FileNotFoundError) as e:
-                self.error_msg = f'Could not load file {path}: {e}'
-        self.check_error()
+            self.load_file_in_background(self.file_menu.file_history.GetHistoryFile(0))
+
+    def on_first_idle(self, event):
+        """The window has been shown and painted for the first time."""
+        self.Unbind(wx.EVT_IDLE, handler=self.on_first_idle)
+        logger.info(f'Time to first paint: {time.monotonic() - self.start_time:.3f} s')
+        if self.loading_path is None:
+            self.log_time_to_interactive()
+        event.Skip()
+
+    def log_time_to_interactive(self):
+        logger.info(f'Time to interactive: {time.monotonic() - self.start_time:.3f} s')
 
     def is_modified(self):
         return self.modified or self.application_panel.is_modified()
@@ -71,6 +93,8 @@ class MainFrame(wx.Frame):
         if not self.is_safe_to_close():
             return
         self.error_msg = None
+        self.cancel_background_load()
+        self.close_journal()
         self.saved_filename = None
         self.SetTitle(app_config.APP_NAME)
         self.SetSize(self.DEFAULT_SIZE)
@@ -99,32 +123,115 @@ class MainFrame(wx.Frame):
         self.load_file(path)
 
     def load_file(self, path):
+        self.cancel_background_load()
         try:
-            with open(path, 'rb') as f:
-                data = pickle.load(f)
+            data, journal, recovered = open_document(path)
+            self.close_journal()
+            self.journal = journal
             self.update_file_history(path)
             self.load_data(data)
             self.saved_filename = path
             self.SetTitle(path)
+            if recovered:
+                self.modified = True
+                self.SetStatusText(f'Recovered unsaved changes to {path}')
         except Exception as e:
             self.error_msg = f'Could not load file: {e}'
         self.check_error()
 
+    def load_file_in_background(self, path):
+        """Open the document at path like load_file(), but read it in a worker thread, and
+        then fill in the panels one at a time, so the window can be used meanwhile."""
+        self.load_count += 1
+        load_id = self.load_count
+        self.loading_path = path
+        self.SetStatusText(f'Opening {path}...')
+
+        def read():
+            try:
+                result = open_document(path)
+            except Exception as e:
+                logger.exception(f'Error reading {path}')
+                result = e
+            wx.CallAfter(self.on_document_read, load_id, path, result)
+
+        threading.Thread(target=read, name='DocumentReader', daemon=True).start()
+
+    def cancel_background_load(self):
+        """Stop showing the document being opened by load_file_in_background(), if any."""
+        self.load_count += 1
+        if self.loading_path is not None:
+            self.loading_path = None
+            self.SetStatusText('Ready to open registration CSV file')
+
+    def on_document_read(self, load_id, path, result):
+        if load_id != self.load_count:
+            return  # Another document was opened or created meanwhile
+        if isinstance(result, Exception):
+            self.loading_path = None
+            self.SetStatusText('Ready to open registration CSV file')
+            self.error_msg = f'Could not load file {path}: {result}'
+            self.check_error()
+            return
+        data, journal, recovered = result
+        logger.info(f'Read {path} in {time.monotonic() - self.start_time:.3f} s after start')
+        steps = self.load_data_steps(data)
+        wx.CallAfter(self.load_next_step, load_id, path, steps, journal, recovered)
+
+    def load_next_step(self, load_id, path, steps, journal, recovered):
+        """Load the next part of the document being opened in the background, and schedule
+        the part after that, so events are handled between parts."""
+        if load_id != self.load_count:
+            steps.close()
+            return
+        try:
+            step = next(steps)
+        except StopIteration:
+            self.loading_path = None
+            self.close_journal()
+            self.journal = journal
+            self.update_file_history(path)
+            self.saved_filename = path
+            self.SetTitle(path)
+            if recovered:
+                self.modified = True
+                self.SetStatusText(f'Recovered unsaved changes to {path}')
+            else:
+                self.SetStatusText(f'Opened {path}')
+            self.log_time_to_interactive()
+            return
+        except Exception as e:
+            self.loading_path = None
+            self.error_msg = f'Could not load file {path}: {e}'
+            logger.exception(self.error_msg)
+            self.check_error()
+            return
+        logger.debug(f'loaded {step} of {path}')
+        wx.CallAfter(self.load_next_step, load_id, path, steps, journal, recovered)
+
     def load_data(self, data):
+        for _step in self.load_data_steps(data):
+            pass
+
+    def load_data_steps(self, data):
+        """Same as load_data(), but a generator loading one part at a time, like
+        ApplicationPanel.load_data_steps()."""
         if data['version'] <= SAVE_FORMAT_VERSION:
-            self.SetPosition(data['position'])
-            self.SetSize(data['size'])
-            self.application_panel.load_data(data['application_panel'])
+            self.SetPosition(tuple(data['position']))
+            self.SetSize(tuple(data['size']))
+            yield from self.application_panel.load_data_steps(data['application_panel'])
             self.clear_is_modified()
 
     def on_save(self, event=None):
+        if self.loading_path is not None:
+            self.SetStatusText(f'Still opening {self.loading_path}, not saved')
+            return
         path = None
         try:
             doc = self.get_data()
             path = self.get_save_path(event.GetId())
             if path is not None:
-                with open(path, 'wb') as f:
-                    pickle.dump(doc, f)
+                self.save_document(path, doc)
                 self.update_file_history(path)
                 self.clear_is_modified()
                 self.saved_filename = path
@@ -138,11 +245,60 @@ class MainFrame(wx.Frame):
             logger.exception('Save error')
         self.check_error()
 
+    def save_document(self, path, doc):
+        """Save doc to path. Saving again to the same document only records the changes in
+        its journal; otherwise, the whole document is written and a new journal started."""
+        family_changes = self.application_panel.take_family_changes()
+        if path == self.saved_filename and self.journal is not None:
+            try:
+                self.journal.append(doc, family_changes, saved=True)
+            except Exception:
+                logger.exception(f'Error appending to journal of {path}, saving whole document')
+                self.close_journal(discard_unsaved=False)
+            else:
+                if self.journal.needs_compaction():
+                    self.journal.start_compaction(on_done=lambda: wx.CallAfter(self.on_compacted))
+                return
+        self.close_journal()
+        document_id = write_document(path, doc)
+        self.journal = Journal.create(path, document_id, doc)
+
+    def on_autosave(self, event=None):
+        """Record unsaved changes in the journal, so they can be recovered after a crash."""
+        if self.journal is None or not self.is_modified():
+            return
+        try:
+            if self.journal.append(self.get_data(), self.application_panel.take_family_changes(),
+                                   saved=False):
+                logger.debug(f'autosaved changes to {self.saved_filename}')
+        except Exception:
+            # The changes taken are no longer tracked, so the next save must write everything
+            logger.exception('Autosave error')
+            self.close_journal(discard_unsaved=False)
+
+    def on_compacted(self):
+        if self.journal is not None:
+            try:
+                self.journal.finish_compaction(self.application_panel.enrollment_panel.get_families())
+            except Exception:
+                logger.exception('Error compacting journal')
+                self.close_journal(discard_unsaved=False)
+
+    def close_journal(self, discard_unsaved=True):
+        """Stop journaling the current document, by default removing autosaved changes."""
+        if self.journal is not None:
+            journal = self.journal
+            self.journal = None
+            try:
+                journal.close(self.application_panel.enrollment_panel.get_families(), discard_unsaved)
+            except Exception:
+                logger.exception(f'Error closing journal of {journal.path}')
+
     def get_data(self):
         return {
             'version': SAVE_FORMAT_VERSION,
-            'position': self.GetPosition(),
-            'size': self.GetSize(),
+            'position': self.GetPosition().Get(),
+            'size': self.GetSize().Get(),
             'application_panel': self.application_panel.get_data()
         }
 
@@ -191,6 +347,8 @@ class MainFrame(wx.Frame):
         # Make sure any log window is closed, ore else it will prevent the app from exiting
         self.help_menu.on_close_log()
         if self.is_safe_to_close():
+            self.autosave_timer.Stop()
+            self.close_journal()
             self.application_panel.close()
             self.Destroy()
 
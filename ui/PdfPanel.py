@@ -1,4 +1,5 @@
 import logging
+import os
 import tempfile
 
 import wx
@@ -7,9 +8,15 @@ import wx.lib.newevent
 from mail import gmail
 from mail.gmail import check_credentials
 from model.columns import Column
-from pdf.generate import generate_invoices, generate_master
+from model.document import LazyFamilies
+from model.family import get_family_summary, summarize_family
+from pdf.backend import get_backend
+from pdf.export import export_invoices
+from pdf.generate import create_invoice_objects
+from pdf.parallel_render import generate_invoices_parallel
+from pdf.slicing import read_invoice_pages
 from ui.PdfViewer import PdfViewer
-from util import MyBytesIO, PROGRESS_STYLE
+from util import PROGRESS_STYLE, ThreadProgress, start_thread
 
 DEFAULT_BORDER = 5
 
@@ -51,6 +58,7 @@ class PdfPanel(wx.Panel):
         self.family_listctrl = wx.ListCtrl(parent=self, style=wx.LC_REPORT)
         self.button_generate_master = wx.Button(self, label='Preview Master PDF...')
         self.button_generate_invoices = wx.Button(self, label='Preview Invoices...')
+        self.button_export_invoices = wx.Button(self, label='Export Invoices...')
         self.button_email_invoices = wx.Button(self, label='Email Invoices...')
 
         # Create temp files here. The temp dir will be deleted when the application closes.
@@ -63,6 +71,9 @@ class PdfPanel(wx.Panel):
         # Keep reference to all opened PDF viewers so we can close the windows on exit
         self.pdf_viewers = set()
 
+        # InvoicePages of the last invoices previewed, to email them without rendering again
+        self.invoice_pages = None
+
         # Map row number in family table to family_id, which indexes families map
         self.row_to_family_id = {}
 
@@ -100,6 +111,8 @@ class PdfPanel(wx.Panel):
         self.Bind(wx.EVT_BUTTON, self.on_generate_master, self.button_generate_master)
         sizer_pdf_buttons.Add(self.button_generate_invoices, 0, wx.ALL, border)
         self.Bind(wx.EVT_BUTTON, self.on_generate_invoices, self.button_generate_invoices)
+        sizer_pdf_buttons.Add(self.button_export_invoices, 0, wx.ALL, border)
+        self.Bind(wx.EVT_BUTTON, self.on_export_invoices, self.button_export_invoices)
         sizer_pdf_buttons.Add(self.button_email_invoices, 0, wx.ALL, border)
         self.Bind(wx.EVT_BUTTON, self.on_email, self.button_email_invoices)
         sizer_pdf_tab.Add(sizer_pdf_buttons, 0, wx.ALL, border)
@@ -108,9 +121,11 @@ class PdfPanel(wx.Panel):
 
         self.button_generate_master.Disable()
         self.button_generate_invoices.Disable()
+        self.button_export_invoices.Disable()
         self.button_email_invoices.Disable()
 
     def close(self):
+        self.set_invoice_pages(None)
         for viewer in self.pdf_viewers:
             try:
                 viewer.Destroy()
@@ -132,6 +147,7 @@ class PdfPanel(wx.Panel):
     def enable_buttons(self, enable=True):
         self.button_generate_master.Enable()
         self.button_generate_invoices.Enable()
+        self.button_export_invoices.Enable()
         self.button_email_invoices.Enable(enable)
 
     def on_close_sub_window(self, event=None):
@@ -149,33 +165,63 @@ class PdfPanel(wx.Panel):
     ################################################################################################
 
     def on_generate_master(self, event=None):
+        """Generate the master list PDF on a worker thread, with a progress dialog, and open
+        it in the viewer when done, in on_master_generated()."""
         try:
-            pdf_buffer = MyBytesIO()
             families = self.get_selected_families()
             if families:
                 try:
-                    self.fee_provider.validate_fee_schedule(families)
+                    self.validate_fee_schedule(families)
                 except Exception as e:
                     self.error_msg = f'Warning: {e}'
                 class_map = self.fee_provider.generate_class_map()
                 term = self.text_ctrl_term.GetValue()
-                generate_master(families, class_map, term, pdf_buffer)
-                self.open_pdf_viewer(pdf_buffer)
+                index = self.get_enrollment_index(class_map)
+                # Read all the families here, so that the worker thread doesn't read them from
+                # the document file while its journal may be compacted, in one pass over it
+                families = dict(families.items())
+                path = self.make_pdf_path()
+                dialog = wx.ProgressDialog('Generating Master List',
+                                           'Please wait...\n\n'
+                                           'Listing family:',
+                                           maximum=2 * len(families),
+                                           style=PROGRESS_STYLE)
+                progress = ThreadProgress(dialog)
+
+                def generate():
+                    try:
+                        result = get_backend().generate_master(families, class_map, term, path,
+                                                               index=index, progress=progress)
+                    except Exception as e:
+                        logger.exception('error generating master PDF')
+                        result = e
+                    wx.CallAfter(self.on_master_generated, dialog, path, result)
+
+                start_thread(generate)
         except RuntimeError as e:
             logger.exception('error generating master PDF')
             self.error_msg = f'error generating master PDF: {e}'
         self.check_error()
 
+    def on_master_generated(self, dialog, path, result):
+        """Called on the UI thread when the worker thread of on_generate_master() is done,
+        with True if it finished, False if cancelled, or the exception that stopped it."""
+        dialog.Destroy()
+        if isinstance(result, Exception):
+            self.error_msg = f'error generating master PDF: {result}'
+        elif result:
+            self.open_pdf_viewer(path)
+        self.check_error()
+
     def on_generate_invoices(self, event=None):
         """
         Called by wxPython when the generate invoices button is clicked.
         Args:
           event (wx.Event): wxPython event
         """
-        pdf_buffer = MyBytesIO()
         try:
             families = self.get_selected_families()
-            self.fee_provider.validate_fee_schedule(families)
+            self.validate_fee_schedule(families)
             class_map = self.fee_provider.generate_class_map()
             note = self.text_ctrl_pdf_note.GetValue()
             term = self.text_ctrl_term.GetValue()
@@ -185,29 +231,72 @@ class PdfPanel(wx.Panel):
                                          'Generating invoice for family:',
                                          maximum=len(families),
                                          style=PROGRESS_STYLE)
-            generate_invoices(progress, families, class_map, note, term, pdf_buffer)
+            path = self.make_pdf_path()
+            invoices = create_invoice_objects(families, class_map, note,
+                                              self.get_enrollment_index(class_map))
+            generate_invoices_parallel(progress, families, class_map, note, term, path,
+                                       invoices=invoices)
             progress.Update(progress.GetRange())  # Make sure progress dialog closes
-            self.open_pdf_viewer(pdf_buffer)
+            self.set_invoice_pages(read_invoice_pages(path, invoices, term))
+            self.open_pdf_viewer(path)
         except RuntimeError as e:
             logger.exception('error generating invoices')
             self.error_msg = f'error generating invoices: {e}'
         self.check_error()
 
-    def open_pdf_viewer(self, pdf_buffer):
-        """Display the given pdf_buffer in a new PDF viewer window.
+    def on_export_invoices(self, event=None):
+        """Export the invoice of each selected family to its own PDF file, in a directory
+        chosen by the user, with a manifest of the files. Exporting again to the same
+        directory only renders the invoices that changed."""
+        dir_dialog = wx.DirDialog(parent=self,
+                                  message='Choose a folder to export the invoices to')
+        if dir_dialog.ShowModal() == wx.ID_OK:
+            directory = dir_dialog.GetPath()
+            try:
+                families = self.get_selected_families()
+                self.validate_fee_schedule(families)
+                class_map = self.fee_provider.generate_class_map()
+                note = self.text_ctrl_pdf_note.GetValue()
+                term = self.text_ctrl_term.GetValue()
+
+                progress = wx.ProgressDialog('Exporting Invoices',
+                                             'Please wait...\n\n'
+                                             'Exporting invoices',
+                                             maximum=len(families),
+                                             style=PROGRESS_STYLE)
+                num_rendered, num_kept = export_invoices(
+                    progress, families, class_map, note, term, directory,
+                    index=self.get_enrollment_index(class_map))
+                progress.Update(progress.GetRange())  # Make sure progress dialog closes
+                wx.MessageBox(f'Exported {num_rendered} invoices to {directory}'
+                              f' ({num_kept} unchanged since the last export).',
+                              caption='Export Invoices')
+            except (RuntimeError, OSError) as e:
+                logger.exception('error exporting invoices')
+                self.error_msg = f'error exporting invoices: {e}'
+        dir_dialog.Destroy()
+        self.check_error()
+
+    def set_invoice_pages(self, invoice_pages):
+        if self.invoice_pages is not None:
+            self.invoice_pages.close()
+        self.invoice_pages = invoice_pages
+
+    def make_pdf_path(self):
+        """Return the path of a new temporary file to render a PDF into for the viewer,
+        which needs a file, or else its "Save As" button does not work. The files are kept
+        until the temporary directory is removed, so that they outlive the viewer windows."""
+        (fd, path) = tempfile.mkstemp(dir=self.tempdir, suffix='.PDF')
+        os.close(fd)
+        return path
+
+    def open_pdf_viewer(self, path):
+        """Display the given PDF file in a new PDF viewer window.
         Uses wxPython's lib.pdfviewer module.
         Args:
-            pdf_buffer (io.BytesIO): A buffer containing the PDF data.
+            path (str): Path of the PDF file, e.g. from make_pdf_path().
         """
-
-        # Need to write to temporary file instead of passing the buffer object directly, or
-        # else the PdfViewer "Save As" button does not work. Also, keep them open so they don't
-        # get deleted until we close the window.
-        (fd, path) = tempfile.mkstemp(dir=self.tempdir, suffix='.PDF')
-        logger.debug(f'pdf size: {len(pdf_buffer.getvalue())}')
-        with open(fd, 'wb') as tmp_file:
-            tmp_file.write(pdf_buffer.getvalue())
-            tmp_file.flush()
+        logger.debug(f'pdf size: {os.path.getsize(path)}')
 
         height = wx.DisplaySize()[1] - 70
         width = int(height * 8 / 10)
@@ -283,7 +372,7 @@ class PdfPanel(wx.Panel):
             style=PROGRESS_STYLE)
         errors = []
         try:
-            self.fee_provider.validate_fee_schedule(families)
+            self.validate_fee_schedule(families)
             note = self.text_ctrl_pdf_note.GetValue()
             term = self.text_ctrl_term.GetValue()
             class_map = self.fee_provider.generate_class_map()
@@ -295,7 +384,9 @@ class PdfPanel(wx.Panel):
                               note,
                               term,
                               progress,
-                              errors=errors)
+                              errors=errors,
+                              invoice_pages=self.invoice_pages,
+                              index=self.get_enrollment_index(class_map))
             progress.Update(progress.GetRange())  # Make sure progress dialog closes
             self.error_msg = '\n'.join(errors)
         except KeyError as e:
@@ -319,7 +410,7 @@ class PdfPanel(wx.Panel):
         self.drafts = []
         errors = []
         try:
-            self.fee_provider.validate_fee_schedule(families)
+            self.validate_fee_schedule(families)
             note = self.text_ctrl_pdf_note.GetValue()
             term = self.text_ctrl_term.GetValue()
             class_map = self.fee_provider.generate_class_map()
@@ -331,7 +422,9 @@ class PdfPanel(wx.Panel):
                                               note,
                                               term,
                                               progress,
-                                              errors=errors)
+                                              errors=errors,
+                                              invoice_pages=self.invoice_pages,
+                                              index=self.get_enrollment_index(class_map))
             progress.Update(progress.GetRange())  # Make sure progress dialog closes
             self.error_msg = '\n'.join(errors)
         except KeyError as e:
@@ -351,9 +444,11 @@ class PdfPanel(wx.Panel):
                     'Sending draft',
             maximum=len(drafts),
             style=PROGRESS_STYLE)
+        errors = []
         try:
-            gmail.send_drafts(drafts, progress)
+            gmail.send_drafts(drafts, progress, errors=errors)
             progress.Update(progress.GetRange())  # Make sure progress dialog closes
+            self.error_msg = '\n'.join(errors)
         except Exception as e:
             self.error_msg = f'Error while sending drafts: {e}'
             logger.exception('could not send drafts')
@@ -379,6 +474,16 @@ class PdfPanel(wx.Panel):
     # Other methods
     ################################################################################################
 
+    def get_enrollment_index(self, class_map):
+        """Return the EnrollmentIndex of the families, updated with class_map."""
+        index = self.family_provider.get_enrollment_index()
+        index.update_class_map(class_map)
+        return index
+
+    def validate_fee_schedule(self, families):
+        self.fee_provider.validate_fee_schedule(
+            families, index=self.family_provider.get_enrollment_index())
+
     def check_error(self):
         if self.error_msg:
             caption = 'Error'
@@ -415,20 +520,43 @@ class PdfPanel(wx.Panel):
         self.family_listctrl.InsertColumn(1, 'Parents')
         self.family_listctrl.InsertColumn(2, 'Students')
         self.row_to_family_id = {}
-        for r, family in enumerate(self.family_provider.get_families().values()):
-            self.row_to_family_id[r] = family['id']
-            last_names = set()
-            num_parents = 0
-            num_students = 0
-            for parent in family['parents']:
-                num_parents += 1
-                last_names.add(parent[Column.LAST_NAME])
-            for student in family['students']:
-                num_students += 1
-                last_names.add(student[Column.LAST_NAME])
-            self.family_listctrl.InsertItem(r, '/'.join(sorted(last_names)))
-            self.family_listctrl.SetItem(r, 1, str(num_parents))
-            self.family_listctrl.SetItem(r, 2, str(num_students))
+        self.append_to_family_list(self.family_provider.get_families())
+
+    def append_to_family_list(self, families, family_ids=None):
+        """Add rows to the end of the family list for the given IDs of families in the
+        families map, or all of them if family_ids is None."""
+        if family_ids is None:
+            family_ids = families.keys()
+        for family_id in family_ids:
+            r = self.family_listctrl.GetItemCount()
+            self.row_to_family_id[r] = family_id
+            self.family_listctrl.InsertItem(r, '')
+            self.set_family_list_row(r, get_family_summary(families, family_id))
+        self.resize_family_list()
+
+    def update_family_list(self, changes):
+        """Update the family list for the families added, removed or changed in the given
+        FamilyChanges, without redisplaying the other families."""
+        family_id_to_row = {family_id: r for r, family_id in self.row_to_family_id.items()}
+        for r in sorted((family_id_to_row[family_id] for family_id in changes.removed),
+                        reverse=True):
+            self.family_listctrl.DeleteItem(r)
+        if changes.removed:
+            family_ids = [family_id for r, family_id in sorted(self.row_to_family_id.items())
+                          if family_id not in changes.removed]
+            self.row_to_family_id = dict(enumerate(family_ids))
+            family_id_to_row = {family_id: r for r, family_id in self.row_to_family_id.items()}
+        for family_id, family in changes.changed.items():
+            self.set_family_list_row(family_id_to_row[family_id], summarize_family(family))
+        self.append_to_family_list(changes.added)
+
+    def set_family_list_row(self, r, summary):
+        name, num_parents, num_students = summary
+        self.family_listctrl.SetItem(r, 0, name)
+        self.family_listctrl.SetItem(r, 1, str(num_parents))
+        self.family_listctrl.SetItem(r, 2, str(num_students))
+
+    def resize_family_list(self):
         self.family_listctrl.SetColumnWidth(0, wx.LIST_AUTOSIZE_USEHEADER)
         self.family_listctrl.SetColumnWidth(1, 75)
         self.family_listctrl.SetColumnWidth(2, 75)
@@ -446,10 +574,12 @@ class PdfPanel(wx.Panel):
         all_families = self.family_provider.get_families()
         if self.family_listctrl.SelectedItemCount == 0:
             return all_families
-        families = {}
+        family_ids = []
         r = self.family_listctrl.GetFirstSelected()
         while r != -1:
-            family_id = self.row_to_family_id[r]
-            families[family_id] = all_families[family_id]
+            family_ids.append(self.row_to_family_id[r])
             r = self.family_listctrl.GetNextSelected(r)
-        return families
+        if isinstance(all_families, LazyFamilies):
+            # Read the selected families not read yet from the document file in one pass
+            all_families.load_all(family_ids)
+        return {family_id: all_families[family_id] for family_id in family_ids}
@@ -13,6 +13,27 @@ def start_thread(func, *args):
     return thread
 
 
+class ThreadProgress:
+    """Progress of work on a worker thread, with the WasCancelled() and Update() methods of
+    wx.ProgressDialog that the PDF generating functions use. Updates are passed on to the
+    dialog on the UI thread, which is also where it is found whether it was cancelled."""
+
+    def __init__(self, dialog):
+        self.dialog = dialog
+        self.cancelled = False
+
+    def WasCancelled(self):
+        return self.cancelled
+
+    def Update(self, value, newmsg=''):
+        wx.CallAfter(self.update_dialog, value, newmsg)
+
+    def update_dialog(self, value, newmsg):
+        if not self.cancelled and self.dialog:
+            keep_going, _skip = self.dialog.Update(value, newmsg=newmsg)
+            self.cancelled = not keep_going or self.dialog.WasCancelled()
+
+
 class MyBytesIO(io.BytesIO):
     """BytesIO wrapper to keep buffer after close() is called."""
 